@@ -0,0 +1,89 @@
+"""
+Compares average step occupancy (share of batch rows that are still
+generating on every decode step) of FIFO and length-aware batch formation.
+
+Contexts arrive faster than batches are formed, so the batcher always
+has a full pool of candidates to choose from.
+
+    python etc/benchmarking/batching.py --csv etc/data/horoscopes.csv
+    python etc/benchmarking/batching.py --synthetic
+"""
+import argparse
+import random
+import string
+from pathlib import Path
+
+from horoscoper.api.batcher import group_by_length
+from horoscoper.horoscope import HoroscopeIndex
+from horoscoper.llm import LLMContext
+from horoscoper.settings import settings
+
+
+def get_random_text(length: int = 12):
+    return "".join(random.choice(string.ascii_lowercase) for i in range(length))
+
+
+def step_occupancy(batches: list[list[int]]) -> float:
+    generated = sum(sum(batch) for batch in batches)
+    allocated = sum(len(batch) * max(batch) for batch in batches)
+    return generated / allocated
+
+
+def fifo_batches(lengths: list[int], batch_size: int) -> list[list[int]]:
+    return [lengths[i : i + batch_size] for i in range(0, len(lengths), batch_size)]
+
+
+def length_aware_batches(
+    lengths: list[int], batch_size: int, lookahead: int
+) -> list[list[int]]:
+    arrivals = [(0.0, LLMContext(prefix=str(length))) for length in lengths]
+    pool_size = batch_size * lookahead
+    candidates = []
+    batches = []
+
+    while arrivals or candidates:
+        while arrivals and len(candidates) < pool_size:
+            candidates.append(arrivals.pop(0))
+
+        batch, candidates = group_by_length(
+            candidates, batch_size, lambda ctx: int(ctx.prefix)
+        )
+        batches.append([int(ctx.prefix) for _, ctx in batch])
+
+    return batches
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--csv", type=Path, default=settings.horoscope_csv_file)
+    parser.add_argument(
+        "--synthetic",
+        action="store_true",
+        help="Use uniformly distributed lengths instead of the horoscopes CSV",
+    )
+    parser.add_argument("-n", type=int, default=10_000, help="Number of contexts")
+    parser.add_argument("--batch-size", type=int, default=settings.batcher_batch_size)
+    parser.add_argument("--lookahead", type=int, default=settings.batcher_lookahead)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    if args.synthetic:
+        lengths = [random.randint(5, 60) for _ in range(args.n)]
+    else:
+        index = HoroscopeIndex.load_from_csv(args.csv)
+        lengths = [index.predict_length(get_random_text()) for _ in range(args.n)]
+
+    fifo = fifo_batches(lengths, args.batch_size)
+    print(f"FIFO:         {step_occupancy(fifo):.1%} ({len(fifo)} batches)")
+
+    for lookahead in sorted({2, args.lookahead}):
+        length_aware = length_aware_batches(lengths, args.batch_size, lookahead)
+        print(
+            f"Length-aware: {step_occupancy(length_aware):.1%} "
+            f"({len(length_aware)} batches, lookahead={lookahead})"
+        )
+
+
+if __name__ == "__main__":
+    main()
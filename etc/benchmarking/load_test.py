@@ -0,0 +1,317 @@
+"""
+Open-loop load test of the streaming infer API.
+
+Requests arrive as a Poisson process at `--rate` per second (regardless of
+how fast they are served) or as recorded in the `--replay` file, and every
+response stream is consumed to measure time to the first chunk (TTFT),
+gaps between the chunks, total completion time and chunks per second.
+
+    python etc/benchmarking/load_test.py --host http://localhost:8000 \\
+        --rate 8 --duration 60 --prefixes zipf --output report.json
+
+Prefixes are unique random strings (`random`), drawn uniformly (`uniform`)
+or by Zipf's law (`zipf`, a few prefixes are very popular) from the pool
+of `--pool-size` prefixes. The replay file is JSON lines with the `prefix`
+field (or `--prefix-field`) and optional `time` in seconds since the start,
+e.g. `--replay traces.jsonl --prefix-field title`.
+
+The report is JSON, so runs of different commits can be compared:
+
+    python etc/benchmarking/load_test.py --compare before.json after.json
+"""
+import argparse
+import asyncio
+import json
+import math
+import random
+import string
+import subprocess
+import sys
+import time
+from dataclasses import asdict, dataclass, field
+from typing import Iterator, Optional
+
+import httpx
+
+# Metrics compared across the reports, the lower the better
+COMPARED_METRICS = [
+    "ttft.p50",
+    "ttft.p99",
+    "chunk_gap.p50",
+    "chunk_gap.p99",
+    "total.p50",
+    "total.p99",
+    "error_rate",
+    "timeout_rate",
+]
+
+
+@dataclass
+class RequestResult:
+    prefix: str
+    # Seconds since the start of the test
+    started_at: float
+    # "ok", "error", "timeout" (inference timeout or the client one),
+    # "rejected" (429) or "http_error"
+    outcome: str = "ok"
+    ttft: Optional[float] = None
+    total: Optional[float] = None
+    chunk_gaps: list[float] = field(default_factory=list)
+    chunks: int = 0
+    chars: int = 0
+
+
+def get_random_text(length: int = 12) -> str:
+    return "".join(random.choice(string.ascii_lowercase) for _ in range(length))
+
+
+def generate_prefixes(kind: str, pool_size: int, zipf_s: float) -> Iterator[str]:
+    if kind == "random":
+        while True:
+            yield get_random_text()
+
+    pool = [get_random_text() for _ in range(pool_size)]
+    if kind == "uniform":
+        weights = None
+    elif kind == "zipf":
+        weights = [1 / rank**zipf_s for rank in range(1, pool_size + 1)]
+    else:
+        raise ValueError(f"Unknown prefix distribution: {kind}")
+
+    while True:
+        yield from random.choices(pool, weights=weights, k=1024)
+
+
+def generate_arrivals(args: argparse.Namespace) -> Iterator[tuple[float, str]]:
+    """Yields `(seconds since the start, prefix)` of every request"""
+    if args.replay:
+        offset = 0.0
+        with open(args.replay) as replay_file:
+            for line in replay_file:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                if "time" in record:
+                    offset = float(record["time"]) / args.speedup
+                else:
+                    offset += random.expovariate(args.rate)
+                yield offset, str(record[args.prefix_field])[: args.max_prefix]
+        return
+
+    offset = 0.0
+    prefixes = generate_prefixes(args.prefixes, args.pool_size, args.zipf_s)
+    while True:
+        offset += random.expovariate(args.rate)
+        if offset >= args.duration:
+            return
+        yield offset, next(prefixes)
+
+
+async def run_request(
+    client: httpx.AsyncClient, result: RequestResult, timeout: float
+) -> RequestResult:
+    start = time.monotonic()
+    last_chunk_at = None
+
+    try:
+        async with client.stream(
+            "POST", "/api/v1/infer", json={"prefix": result.prefix}, timeout=timeout
+        ) as response:
+            if response.status_code == 429:
+                result.outcome = "rejected"
+                return result
+            if response.status_code != 200:
+                result.outcome = "http_error"
+                return result
+
+            async for line in response.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                message = json.loads(line[len("data:") :])
+                now = time.monotonic()
+
+                if message["status"] == "ERROR":
+                    is_timeout = "Timeout" in (message.get("error") or "")
+                    result.outcome = "timeout" if is_timeout else "error"
+                    break
+
+                result.chunks += 1
+                result.chars += len(message["text"])
+                if last_chunk_at is None:
+                    result.ttft = now - start
+                else:
+                    result.chunk_gaps.append(now - last_chunk_at)
+                last_chunk_at = now
+
+                if message["status"] == "FINISHED":
+                    result.total = now - start
+                    break
+            else:
+                # Stream is over without the last chunk
+                result.outcome = "error"
+    except httpx.TimeoutException:
+        result.outcome = "timeout"
+    except httpx.HTTPError:
+        result.outcome = "http_error"
+    return result
+
+
+async def run_load(args: argparse.Namespace) -> list[RequestResult]:
+    limits = httpx.Limits(max_connections=args.max_connections)
+    tasks = []
+    async with httpx.AsyncClient(base_url=args.host, limits=limits) as client:
+        start = time.monotonic()
+        for offset, prefix in generate_arrivals(args):
+            # Open loop: requests are sent on schedule, even if the API lags
+            await asyncio.sleep(max(start + offset - time.monotonic(), 0.0))
+            result = RequestResult(prefix=prefix, started_at=offset)
+            tasks.append(asyncio.create_task(run_request(client, result, args.timeout)))
+
+        return list(await asyncio.gather(*tasks))
+
+
+def percentiles(values: list[float]) -> dict[str, Optional[float]]:
+    if not values:
+        return {"mean": None, "p50": None, "p90": None, "p99": None, "max": None}
+
+    values = sorted(values)
+
+    def percentile(q: float) -> float:
+        return values[min(math.ceil(q * len(values)) - 1, len(values) - 1)]
+
+    return {
+        "mean": sum(values) / len(values),
+        "p50": percentile(0.5),
+        "p90": percentile(0.9),
+        "p99": percentile(0.99),
+        "max": values[-1],
+    }
+
+
+def get_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            text=True,
+            stderr=subprocess.DEVNULL,
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def build_report(
+    args: argparse.Namespace, results: list[RequestResult], elapsed: float
+) -> dict:
+    completed = [result for result in results if result.outcome == "ok"]
+    outcomes = {}
+    for result in results:
+        outcomes[result.outcome] = outcomes.get(result.outcome, 0) + 1
+
+    def rate(outcome: str) -> float:
+        return outcomes.get(outcome, 0) / len(results) if results else 0.0
+
+    return {
+        "commit": get_commit(),
+        "created_at": time.time(),
+        "config": {
+            key: value
+            for key, value in vars(args).items()
+            if key not in ("output", "compare", "raw")
+        },
+        "requests": len(results),
+        "elapsed": elapsed,
+        "outcomes": outcomes,
+        "error_rate": rate("error") + rate("http_error"),
+        "timeout_rate": rate("timeout"),
+        "rejected_rate": rate("rejected"),
+        "ttft": percentiles([result.ttft for result in completed]),
+        "chunk_gap": percentiles(
+            [gap for result in completed for gap in result.chunk_gaps]
+        ),
+        "total": percentiles([result.total for result in completed]),
+        # Chunks are words, so it's close to tokens per second
+        "chunks_per_second": percentiles(
+            [
+                (result.chunks - 1) / (result.total - result.ttft)
+                for result in completed
+                if result.chunks > 1 and result.total > result.ttft
+            ]
+        ),
+        "throughput": {
+            "requests_per_second": len(completed) / elapsed,
+            "chunks_per_second": sum(result.chunks for result in completed) / elapsed,
+            "chars_per_second": sum(result.chars for result in completed) / elapsed,
+        },
+    }
+
+
+def get_metric(report: dict, metric: str) -> Optional[float]:
+    value = report
+    for key in metric.split("."):
+        value = value.get(key) if isinstance(value, dict) else None
+    return value
+
+
+def compare_reports(before: dict, after: dict):
+    print(f"{'metric':<16} {before['commit'] or '?':>10} {after['commit'] or '?':>10}")
+    for metric in COMPARED_METRICS:
+        old, new = get_metric(before, metric), get_metric(after, metric)
+        change = ""
+        if old and new is not None:
+            change = f"{(new - old) / old:+.1%}"
+        old_str = f"{old:.4f}" if old is not None else "-"
+        new_str = f"{new:.4f}" if new is not None else "-"
+        print(f"{metric:<16} {old_str:>10} {new_str:>10} {change:>8}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--host", default="http://localhost:8000")
+    parser.add_argument("--rate", type=float, default=4.0, help="Requests per second")
+    parser.add_argument("--duration", type=float, default=60.0, help="Seconds")
+    parser.add_argument(
+        "--prefixes", choices=["random", "uniform", "zipf"], default="random"
+    )
+    parser.add_argument("--pool-size", type=int, default=100)
+    parser.add_argument("--zipf-s", type=float, default=1.1)
+    parser.add_argument("--replay", help="JSON lines with the recorded requests")
+    parser.add_argument("--prefix-field", default="prefix")
+    parser.add_argument("--max-prefix", type=int, default=1024)
+    parser.add_argument(
+        "--speedup", type=float, default=1.0, help="Replay time is divided by it"
+    )
+    parser.add_argument("--timeout", type=float, default=60.0)
+    parser.add_argument("--max-connections", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--output", help="Report file, printed to stdout otherwise")
+    parser.add_argument("--raw", action="store_true", help="Include every request")
+    parser.add_argument(
+        "--compare", nargs=2, metavar=("BEFORE", "AFTER"), help="Compare reports"
+    )
+    args = parser.parse_args()
+
+    if args.compare:
+        before, after = (json.load(open(path)) for path in args.compare)
+        compare_reports(before, after)
+        return
+
+    random.seed(args.seed)
+    start = time.monotonic()
+    results = asyncio.run(run_load(args))
+    report = build_report(args, results, time.monotonic() - start)
+    if args.raw:
+        report["results"] = [asdict(result) for result in results]
+
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2)
+        print(f"Report is written to {args.output}", file=sys.stderr)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    main()
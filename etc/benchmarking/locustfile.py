@@ -1,5 +1,7 @@
+import json
 import random
 import string
+import time
 
 from locust import HttpUser, task
 
@@ -9,6 +11,47 @@ def get_random_text(length: int = 12):
 
 
 class InfersUser(HttpUser):
+    """
+    Reads the whole response stream. Besides the request itself (time to
+    the headers), time to the first chunk and completion time are reported
+    as `SSE ttft` and `SSE total`. Failed or timed out inferences fail the latter.
+    For the open-loop load and the JSON report see `load_test.py`.
+    """
+
+    def fire(self, name: str, start: float, exception=None):
+        self.environment.events.request.fire(
+            request_type="SSE",
+            name=name,
+            response_time=(time.perf_counter() - start) * 1000,
+            response_length=0,
+            exception=exception,
+            context={},
+        )
+
     @task
     def post_infer(self):
-        self.client.post("/api/v1/infer", json={"prefix": get_random_text()})
+        start = time.perf_counter()
+        with self.client.post(
+            "/api/v1/infer",
+            json={"prefix": get_random_text()},
+            stream=True,
+            catch_response=True,
+        ) as response:
+            first_chunk = True
+            for line in response.iter_lines(decode_unicode=True):
+                if not line or not line.startswith("data:"):
+                    continue
+
+                message = json.loads(line[len("data:") :])
+                if message["status"] == "ERROR":
+                    self.fire("total", start, exception=Exception(message["error"]))
+                    return
+
+                if first_chunk:
+                    self.fire("ttft", start)
+                    first_chunk = False
+                if message["status"] == "FINISHED":
+                    self.fire("total", start)
+                    return
+
+            self.fire("total", start, exception=Exception("Stream is not finished"))
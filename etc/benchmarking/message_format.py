@@ -0,0 +1,51 @@
+"""
+Measures messages per second per core for worker-to-API chunk messages
+in "json" and "binary" formats: encoding on the worker side
+and rendering into SSE payload on the API side.
+
+    python etc/benchmarking/message_format.py
+"""
+import argparse
+import time
+
+from horoscoper.tasks.infer import InferMessageStatus, encode_message, render_message
+
+WORDS = "Today the stars align in your favour, so take a chance".split(" ")
+
+
+def measure(message_format: str, messages: int) -> tuple[float, float]:
+    chunks = [
+        (WORDS[i % len(WORDS)] + " ", InferMessageStatus.IN_PROGRESS, i + 1)
+        for i in range(messages)
+    ]
+
+    start = time.perf_counter()
+    raw_messages = [
+        encode_message(text, status, seq, message_format)
+        for text, status, seq in chunks
+    ]
+    encode_elapsed = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for raw_message in raw_messages:
+        render_message(raw_message)
+    render_elapsed = time.perf_counter() - start
+
+    return messages / encode_elapsed, messages / render_elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--messages", type=int, default=200_000)
+    args = parser.parse_args()
+
+    for message_format in ("json", "binary"):
+        encode_rate, render_rate = measure(message_format, args.messages)
+        print(
+            f"{message_format:>6}: worker {encode_rate:,.0f} msg/s, "
+            f"API {render_rate:,.0f} msg/s"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""
+Per-prefix cost of `predict_by_prefix` against `predict_batch`
+(NumPy-backed, if it's installed) at different batch sizes.
+
+    python etc/benchmarking/predict_batch.py --csv etc/data/horoscopes.csv
+
+Without `--csv` the index is generated: 2000 texts per sign.
+"""
+import argparse
+import random
+import string
+import tempfile
+import timeit
+from pathlib import Path
+
+import horoscoper.horoscope
+from horoscoper.horoscope import SIGNS, CompiledHoroscopeIndex, HoroscopeIndex
+
+BATCH_SIZES = [1, 4, 16, 64, 256, 1024]
+
+
+def generate_index(texts_per_sign: int) -> HoroscopeIndex:
+    words = ["".join(random.choices(string.ascii_lowercase, k=6)) for _ in range(1000)]
+    return HoroscopeIndex(
+        {
+            sign: [
+                " ".join(random.choices(words, k=random.randint(20, 60)))
+                for _ in range(texts_per_sign)
+            ]
+            for sign in SIGNS
+        }
+    )
+
+
+def measure_us(func, prefixes: list[str], repeat: int) -> float:
+    """Best per-prefix time in microseconds"""
+    number = max(2048 // len(prefixes), 1)
+    timer = timeit.Timer(lambda: func(prefixes))
+    return (
+        min(timer.repeat(repeat=repeat, number=number)) / number / len(prefixes) * 1e6
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--csv", type=Path)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    random.seed(0)
+    index = HoroscopeIndex.load_from_csv(args.csv) if args.csv else generate_index(2000)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        index_path = Path(tmp_dir) / "horoscopes.idx"
+        index.compile(index_path)
+        compiled_index = CompiledHoroscopeIndex.load(index_path)
+
+        print(f"NumPy: {'yes' if horoscoper.horoscope.np is not None else 'no'}")
+        print(f"{'batch':>5} | {'index, us/prefix':^25} | {'compiled, us/prefix':^25}")
+        print(f"{'':>5} | {'scalar':>8} {'batch':>8} {'speedup':>7}" * 2)
+
+        for batch_size in BATCH_SIZES:
+            prefixes = [
+                "".join(random.choices(string.ascii_letters, k=12))
+                for _ in range(batch_size)
+            ]
+            row = f"{batch_size:>5}"
+            for horoscope_index in (index, compiled_index):
+                expected = [horoscope_index.predict_by_prefix(p) for p in prefixes]
+                assert horoscope_index.predict_batch(prefixes) == expected
+
+                scalar = measure_us(
+                    lambda batch: [horoscope_index.predict_by_prefix(p) for p in batch],
+                    prefixes,
+                    args.repeat,
+                )
+                batch = measure_us(horoscope_index.predict_batch, prefixes, args.repeat)
+                row += f" | {scalar:>8.2f} {batch:>8.2f} {scalar / batch:>6.2f}x"
+            print(row)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+"""
+Compares queueing latency (from the request to the start of its batch)
+and batch sizes of the API-side `ContextBatcher` path and "pull" worker mode,
+where free workers pull batches straight from the context list.
+
+Redis, RQ and the model are simulated in-process: contexts arrive as
+a Poisson process, and every batch takes `--service-ms` to generate.
+
+    python etc/benchmarking/pull_latency.py --rates 2 8 16
+"""
+import argparse
+import asyncio
+import random
+import statistics
+import time
+
+import horoscoper.api.batcher
+from horoscoper.api.batcher import ContextBatcher
+from horoscoper.llm import LLMContext
+
+
+class SimulatedQueue:
+    """Stands for the RQ queue and the Redis context list"""
+
+    def __init__(self):
+        self.items: asyncio.Queue = asyncio.Queue()
+
+    async def enqueue_many_async(
+        self, redis_client, batches: list[list[LLMContext]], **kwargs
+    ):
+        for batch in batches:
+            self.items.put_nowait(batch)
+
+    async def get_queue_depth_async(self, redis_client) -> int:
+        return self.items.qsize()
+
+
+class Stats:
+    def __init__(self):
+        self.arrivals: dict = {}
+        self.waits: list[float] = []
+        self.batch_sizes: list[int] = []
+
+    def record_batch(self, batch: list[LLMContext]):
+        now = time.monotonic()
+        self.waits.extend(now - self.arrivals[ctx.id] for ctx in batch)
+        self.batch_sizes.append(len(batch))
+
+    def report(self, name: str, rate: float):
+        p95 = statistics.quantiles(self.waits, n=20)[-1]
+        print(
+            f"{name:>8} @ {rate:>4g}/s: wait mean {statistics.mean(self.waits):.3f}s"
+            f" p95 {p95:.3f}s, batch size {statistics.mean(self.batch_sizes):.2f}"
+        )
+
+
+async def rq_worker(queue: SimulatedQueue, stats: Stats, service_time: float):
+    while True:
+        batch = await queue.items.get()
+        stats.record_batch(batch)
+        await asyncio.sleep(service_time)
+
+
+async def pull_worker(
+    queue: SimulatedQueue, stats: Stats, service_time: float, batch_size: int
+):
+    while True:
+        # Blocking pop of the first context, then whatever is there
+        batch = [await queue.items.get()]
+        while len(batch) < batch_size and not queue.items.empty():
+            batch.append(queue.items.get_nowait())
+        stats.record_batch(batch)
+        await asyncio.sleep(service_time)
+
+
+async def generate(add_context, stats: Stats, rate: float, contexts: int):
+    for _ in range(contexts):
+        await asyncio.sleep(random.expovariate(rate))
+        context = LLMContext()
+        stats.arrivals[context.id] = time.monotonic()
+        await add_context(context)
+
+
+async def run(mode: str, args: argparse.Namespace, rate: float) -> Stats:
+    stats = Stats()
+    queue = SimulatedQueue()
+    service_time = args.service_ms / 1000
+
+    if mode == "batcher":
+        horoscoper.api.batcher.infer = queue
+        workers = [
+            asyncio.create_task(rq_worker(queue, stats, service_time))
+            for _ in range(args.workers)
+        ]
+        async with ContextBatcher(
+            # Redis is simulated by the queue
+            redis=None,
+            batch_size=args.batch_size,
+            window_size_ms=args.window_ms,
+        ) as batcher:
+            await generate(batcher.add_context_to_batch, stats, rate, args.contexts)
+            while len(stats.waits) < args.contexts:
+                await asyncio.sleep(0.01)
+    else:
+        workers = [
+            asyncio.create_task(
+                pull_worker(queue, stats, service_time, args.batch_size)
+            )
+            for _ in range(args.workers)
+        ]
+        await generate(queue.items.put, stats, rate, args.contexts)
+        while len(stats.waits) < args.contexts:
+            await asyncio.sleep(0.01)
+
+    for worker in workers:
+        worker.cancel()
+    return stats
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rates", type=float, nargs="+", default=[2, 8, 16])
+    parser.add_argument("--contexts", type=int, default=40)
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--batch-size", type=int, default=4)
+    parser.add_argument("--window-ms", type=int, default=250)
+    parser.add_argument("--service-ms", type=int, default=500)
+    args = parser.parse_args()
+
+    for rate in args.rates:
+        for mode in ("batcher", "pull"):
+            random.seed(0)
+            stats = await run(mode, args, rate)
+            stats.report(mode, rate)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,413 @@
+"""
+Discrete-event simulation of the serving pipeline for capacity planning.
+
+The real `ContextBatcher` (and its batching policy) and `HoroscopeLLM`
+(with the configured latency model) run on an event loop with virtual time:
+sleeping advances the clock at once, so hours of traffic take seconds.
+RQ queue, workers and API timeouts are simulated in-process:
+
+    * jobs not picked up within `--job-ttl` are discarded (RQ TTL);
+    * API gives up on the context, if there is no chunk for `--job-ttl`
+      and cancels it, as well as after the `--deadline`;
+    * workers prune the contexts given up between steps.
+
+Every combination of the swept values is simulated on the same arrivals:
+
+    python etc/benchmarking/simulator.py --csv etc/data/horoscopes.csv \\
+        --rate 10 --duration 600 --batch-size 4 8 --window-ms 50 250 --workers 2 4
+
+Arrivals are Poisson at `--rate` or replayed from the `--trace` file
+(JSON lines with `time` and `prefix`, like `load_test.py --replay`).
+Model time is used as is, so keep `TIME_SCALE` at 1.
+"""
+import argparse
+import asyncio
+import contextlib
+import copy
+import itertools
+import json
+import math
+import random
+import selectors
+import string
+from collections import deque
+from dataclasses import dataclass
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Optional
+from uuid import UUID
+
+import horoscoper.api.batcher
+import horoscoper.llm
+from horoscoper.api.batcher import AdaptiveBatchingPolicy, ContextBatcher
+from horoscoper.horoscope import HoroscopeLLM
+from horoscoper.latency import get_latency_model
+from horoscoper.llm import LLMContext
+from horoscoper.settings import settings
+from horoscoper.utils import spawn
+
+
+class VirtualSelector(selectors.SelectSelector):
+    """Instead of waiting for the next timer, advances the clock to it"""
+
+    def __init__(self):
+        super().__init__()
+        self.now = 0.0
+
+    def select(self, timeout: Optional[float] = None):
+        if timeout is not None and timeout > 0:
+            self.now += timeout
+        return super().select(0)
+
+
+class VirtualTimeLoop(asyncio.SelectorEventLoop):
+    def __init__(self):
+        self._virtual_selector = VirtualSelector()
+        super().__init__(selector=self._virtual_selector)
+
+    def time(self) -> float:
+        return self._virtual_selector.now
+
+
+@dataclass
+class Request:
+    context: LLMContext
+    arrival: float
+    first_chunk: Optional[float] = None
+    last_chunk: Optional[float] = None
+    finished: Optional[float] = None
+    # "ok", "timeout" (API gave up), "expired" (after the deadline)
+    # or "job_ttl" (job expired in the queue)
+    outcome: Optional[str] = None
+
+
+class SimulatedLLM(HoroscopeLLM):
+    """Accumulates the delays of the steps instead of sleeping"""
+
+    elapsed = 0.0
+
+    def _sleep(self, delay_ms: float):
+        self.elapsed += delay_ms / 1000 / self._time_scale
+
+    def take_elapsed(self) -> float:
+        elapsed, self.elapsed = self.elapsed, 0.0
+        return elapsed
+
+
+class Simulation:
+    def __init__(self, model: HoroscopeLLM, config: argparse.Namespace):
+        self._config = config
+        self._model = model
+        self._loop = asyncio.get_running_loop()
+        self._jobs: asyncio.Queue[tuple[float, list[LLMContext]]] = asyncio.Queue()
+        self.requests: dict[UUID, Request] = {}
+        self.batch_sizes: list[int] = []
+        self.busy_time = 0.0
+        # Time of the last arrival or step, whichever is later
+        self.last_activity = 0.0
+
+    # Stands for `horoscoper.tasks.infer` in the batcher
+    async def enqueue_many_async(
+        self, redis_client, batches: list[list[LLMContext]], **kwargs
+    ):
+        for batch in batches:
+            self.batch_sizes.append(len(batch))
+            self._jobs.put_nowait((self._loop.time(), batch))
+
+    async def get_queue_depth_async(self, redis_client) -> int:
+        return self._jobs.qsize()
+
+    def _give_up(self, request: Request, outcome: str):
+        if request.outcome is None:
+            request.outcome = outcome
+
+    def _keep(self, contexts: list[LLMContext]) -> list[LLMContext]:
+        """Prunes contexts, that API has given up on, like `ContextPruner`"""
+        now = self._loop.time()
+        kept = []
+        for context in contexts:
+            request = self.requests[context.id]
+            if request.outcome is None and context.is_expired(now):
+                self._give_up(request, "expired")
+            elif request.outcome is None:
+                kept.append(context)
+        return kept
+
+    def _record(self, batch):
+        now = self._loop.time()
+        for context, result in batch:
+            request = self.requests[context.id]
+            if request.outcome is not None:
+                continue
+            if request.first_chunk is None:
+                request.first_chunk = now
+            request.last_chunk = now
+            if result.is_last_chunk:
+                request.finished = now
+                request.outcome = "ok"
+            else:
+                self._watch_timeout(request)
+
+    def _watch_timeout(self, request: Request):
+        """API waits for the next chunk at most `job_ttl`"""
+        last_chunk = request.last_chunk
+
+        def check():
+            if request.outcome is None and request.last_chunk == last_chunk:
+                self._give_up(request, "timeout")
+                spawn(self._batcher.cancel(request.context))
+
+        self._loop.call_later(self._config.job_ttl, check)
+
+    async def _pop_job(self, block: bool) -> Optional[list[LLMContext]]:
+        while block or not self._jobs.empty():
+            enqueued_at, contexts = await self._jobs.get()
+            if self._loop.time() - enqueued_at <= self._config.job_ttl:
+                return contexts
+
+            for context in contexts:
+                self._give_up(self.requests[context.id], "job_ttl")
+        return None
+
+    async def _run_steps(self, model: SimulatedLLM, steps):
+        for batch in steps:
+            elapsed = model.take_elapsed()
+            self.busy_time += elapsed
+            await asyncio.sleep(elapsed)
+            self._record(batch)
+            self.last_activity = max(self.last_activity, self._loop.time())
+
+    async def static_worker(self):
+        model = copy.copy(self._model)
+        while True:
+            contexts = await self._pop_job(block=True)
+            await self._run_steps(model, model.infer_batch(contexts, keep=self._keep))
+
+    async def continuous_worker(self):
+        model = copy.copy(self._model)
+        pending: deque[LLMContext] = deque()
+
+        def admit(free_slots: int) -> list[LLMContext]:
+            # Jobs are popped synchronously, as the step can't wait
+            while len(pending) < free_slots and not self._jobs.empty():
+                enqueued_at, contexts = self._jobs.get_nowait()
+                if self._loop.time() - enqueued_at > self._config.job_ttl:
+                    for context in contexts:
+                        self._give_up(self.requests[context.id], "job_ttl")
+                    continue
+                pending.extend(contexts)
+            return [pending.popleft() for _ in range(min(free_slots, len(pending)))]
+
+        while True:
+            pending.extend(await self._pop_job(block=True))
+            await self._run_steps(
+                model,
+                model.infer_continuous(
+                    admit=admit,
+                    max_batch_size=self._config.worker_batch_size,
+                    keep=self._keep,
+                ),
+            )
+
+    async def run(self, arrivals: list[tuple[float, str]]):
+        config = self._config
+        policy = None
+        if config.adaptive:
+            policy = AdaptiveBatchingPolicy(
+                min_batch_size=settings.batcher_min_batch_size,
+                max_batch_size=config.batch_size,
+                min_window_size_ms=settings.batcher_min_window_ms,
+                max_window_size_ms=config.window_ms,
+            )
+        self._batcher = ContextBatcher(
+            # Redis is simulated by this class
+            redis=None,
+            batch_size=config.batch_size,
+            window_size_ms=config.window_ms,
+            policy=policy,
+        )
+
+        worker = (
+            self.continuous_worker
+            if config.worker_mode == "continuous"
+            else self.static_worker
+        )
+        workers = [asyncio.create_task(worker()) for _ in range(config.workers)]
+
+        async with self._batcher:
+            for offset, prefix in arrivals:
+                await asyncio.sleep(max(offset - self._loop.time(), 0.0))
+                context = LLMContext(prefix=prefix, deadline=offset + config.deadline)
+                request = Request(context=context, arrival=offset)
+                self.requests[context.id] = request
+                self.last_activity = max(self.last_activity, offset)
+                self._watch_timeout(request)
+                await self._batcher.add_context_to_batch(context)
+
+            # Everything is over after the deadline of the last request
+            await asyncio.sleep(config.deadline)
+
+        for worker_task in workers:
+            worker_task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        for request in self.requests.values():
+            self._give_up(request, "expired")
+
+
+def percentiles(values: list[float]) -> dict[str, Optional[float]]:
+    if not values:
+        return {"p50": None, "p90": None, "p99": None}
+    values = sorted(values)
+    return {
+        f"p{round(q * 100)}": values[min(math.ceil(q * len(values)), len(values)) - 1]
+        for q in (0.5, 0.9, 0.99)
+    }
+
+
+def build_report(
+    simulation: Simulation, config: argparse.Namespace, duration: float
+) -> dict:
+    requests = list(simulation.requests.values())
+    completed = [request for request in requests if request.outcome == "ok"]
+    outcomes = {}
+    for request in requests:
+        outcomes[request.outcome] = outcomes.get(request.outcome, 0) + 1
+
+    batch_sizes = simulation.batch_sizes or [0]
+    return {
+        "config": {
+            "batch_size": config.batch_size,
+            "window_ms": config.window_ms,
+            "workers": config.workers,
+            "job_ttl": config.job_ttl,
+            "worker_mode": config.worker_mode,
+        },
+        "requests": len(requests),
+        "outcomes": outcomes,
+        "drop_rate": 1 - len(completed) / len(requests) if requests else 0.0,
+        "ttft": percentiles(
+            [request.first_chunk - request.arrival for request in completed]
+        ),
+        "completion": percentiles(
+            [request.finished - request.arrival for request in completed]
+        ),
+        "batch_size": sum(batch_sizes) / len(batch_sizes),
+        "batch_fill": sum(batch_sizes) / len(batch_sizes) / config.batch_size,
+        "worker_utilization": (
+            simulation.busy_time / (config.workers * duration) if duration else 0.0
+        ),
+    }
+
+
+def generate_arrivals(args: argparse.Namespace) -> list[tuple[float, str]]:
+    if args.trace:
+        with open(args.trace) as trace_file:
+            records = [json.loads(line) for line in trace_file if line.strip()]
+        return sorted((float(record["time"]), record["prefix"]) for record in records)
+
+    arrivals = []
+    offset = random.expovariate(args.rate)
+    while offset < args.duration:
+        prefix = "".join(random.choices(string.ascii_lowercase, k=12))
+        arrivals.append((offset, prefix))
+        offset += random.expovariate(args.rate)
+    return arrivals
+
+
+@contextlib.contextmanager
+def restored(*attributes: tuple[object, str]):
+    """Restores the attributes patched for the simulation"""
+    originals = [(target, name, getattr(target, name)) for target, name in attributes]
+    try:
+        yield
+    finally:
+        for target, name, value in originals:
+            setattr(target, name, value)
+
+
+def simulate(
+    model: HoroscopeLLM, config: argparse.Namespace, arrivals: list[tuple[float, str]]
+) -> dict:
+    loop = VirtualTimeLoop()
+
+    async def main() -> dict:
+        simulation = Simulation(model, config)
+        horoscoper.api.batcher.infer = simulation
+        await simulation.run(arrivals)
+        # The idle tail till the deadline of the last request isn't counted
+        return build_report(simulation, config, duration=simulation.last_activity)
+
+    with restored(
+        (horoscoper.api.batcher, "time"),
+        (horoscoper.api.batcher, "infer"),
+        (horoscoper.llm, "time"),
+        (settings, "infer_job_ttl"),
+    ):
+        # Batcher and contexts read the virtual clock
+        clock = SimpleNamespace(monotonic=loop.time, time=loop.time)
+        horoscoper.api.batcher.time = clock
+        horoscoper.llm.time = clock
+        settings.infer_job_ttl = config.job_ttl
+        try:
+            return loop.run_until_complete(main())
+        finally:
+            loop.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--csv", type=Path, default=settings.horoscope_csv_file)
+    parser.add_argument("--rate", type=float, default=4.0)
+    parser.add_argument("--duration", type=float, default=600.0)
+    parser.add_argument("--trace", help="JSON lines with `time` and `prefix`")
+    parser.add_argument("--batch-size", type=int, nargs="+", default=[4])
+    parser.add_argument("--window-ms", type=int, nargs="+", default=[250])
+    parser.add_argument("--workers", type=int, nargs="+", default=[2])
+    parser.add_argument("--job-ttl", type=int, nargs="+", default=[7])
+    parser.add_argument("--deadline", type=float, default=settings.infer_deadline)
+    parser.add_argument("--adaptive", action="store_true")
+    parser.add_argument(
+        "--worker-mode", choices=["static", "continuous"], default="static"
+    )
+    parser.add_argument("--worker-batch-size", type=int, default=8)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="JSON report of all the configurations")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    arrivals = generate_arrivals(args)
+    model = SimulatedLLM(args.csv, latency_model=get_latency_model())
+
+    reports = []
+    print(
+        f"{'batch':>5} {'window':>6} {'workers':>7} {'ttl':>4} | {'ttft p50':>8}"
+        f" {'p99':>7} | {'done p50':>8} {'p99':>7} | {'fill':>5} {'drop':>6}"
+    )
+    for batch_size, window_ms, workers, job_ttl in itertools.product(
+        args.batch_size, args.window_ms, args.workers, args.job_ttl
+    ):
+        config = argparse.Namespace(**vars(args))
+        config.batch_size, config.window_ms = batch_size, window_ms
+        config.workers, config.job_ttl = workers, job_ttl
+        # The same model randomness for every configuration
+        random.seed(args.seed)
+        report = simulate(model, config, arrivals)
+        reports.append(report)
+
+        ttft, completion = report["ttft"], report["completion"]
+        print(
+            f"{batch_size:>5} {window_ms:>6} {workers:>7} {job_ttl:>4} |"
+            f" {ttft['p50'] or 0:>8.3f} {ttft['p99'] or 0:>7.3f} |"
+            f" {completion['p50'] or 0:>8.3f} {completion['p99'] or 0:>7.3f} |"
+            f" {report['batch_fill']:>5.2f} {report['drop_rate']:>6.1%}"
+        )
+
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(reports, output, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+"""
+Measures per-job overhead of RQ workers: forking `rq.Worker`
+against fork-free `rq.SimpleWorker`.
+
+Empty jobs are processed in burst mode, while the worker process holds
+a heap of `--heap-mb` megabytes (emulating the cached model),
+so copy-on-write page faults are taken into account.
+
+    python etc/benchmarking/worker_overhead.py --redis-url redis://localhost:36379/0
+"""
+import argparse
+import time
+
+import rq
+from redis import Redis
+
+
+def measure(worker_class: type[rq.Worker], redis: Redis, jobs: int) -> float:
+    queue = rq.Queue(name=f"benchmark-{worker_class.__name__}", connection=redis)
+    for _ in range(jobs):
+        # Empty job, that is importable by the worker
+        queue.enqueue(time.sleep, 0)
+
+    worker = worker_class([queue], connection=queue.connection)
+    start = time.perf_counter()
+    worker.work(burst=True)
+    elapsed = time.perf_counter() - start
+
+    queue.delete()
+    return elapsed / jobs
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--redis-url", default="redis://localhost:6379/0")
+    parser.add_argument("--jobs", type=int, default=500)
+    parser.add_argument("--heap-mb", type=int, default=200)
+    args = parser.parse_args()
+
+    # Plenty of small objects, like the horoscopes index
+    heap = [str(i) * 10 for i in range(args.heap_mb * 1024 * 1024 // 64)]
+
+    redis = Redis.from_url(args.redis_url)
+    for worker_class in (rq.Worker, rq.SimpleWorker):
+        overhead = measure(worker_class, redis, args.jobs)
+        print(f"{worker_class.__name__:>12}: {overhead * 1000:.2f} ms per job")
+
+    del heap
+
+
+if __name__ == "__main__":
+    main()
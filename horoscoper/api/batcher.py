@@ -1,16 +1,24 @@
 import asyncio
 import contextlib
 import logging
+import math
+import pickle
 import time
+from typing import Callable, Optional
+from uuid import UUID, uuid4
 
 import async_timeout
-from prometheus_client import Gauge, Histogram
+from prometheus_client import Counter, Gauge, Histogram
+from redis.asyncio import Redis
+from redis.exceptions import WatchError
 
 from horoscoper.llm import LLMContext
 from horoscoper.settings import settings
 from horoscoper.tasks import infer
 from horoscoper.utils import spawn
 
+from .pubsub import PubSubMultiplexer
+
 logger = logging.getLogger(__name__)
 QueueObject = tuple[float, LLMContext]
 
@@ -20,44 +28,348 @@ batch_size = Histogram(
     "Size of the enqueued batch",
     buckets=list(range(1, 10)),
 )
+batch_fill_ratio = Histogram(
+    "context_batcher_fill_ratio",
+    "Size of the enqueued batch relative to the target batch size",
+    buckets=[0.25, 0.5, 0.75, 0.9, 1.0],
+)
+window_size_gauge = Gauge(
+    "context_batcher_window_ms", "Batching window chosen by the policy"
+)
+target_batch_size_gauge = Gauge(
+    "context_batcher_target_batch_size", "Target batch size chosen by the policy"
+)
+arrival_rate_gauge = Gauge(
+    "context_batcher_arrival_rate", "Estimated contexts arrival rate per second"
+)
+estimated_wait_gauge = Gauge(
+    "context_batcher_estimated_wait", "Estimated wait time for the new context"
+)
+rejected_contexts = Counter(
+    "context_batcher_rejected_contexts", "Contexts rejected by admission control"
+)
+expired_contexts = Counter(
+    "context_batcher_expired_contexts", "Contexts expired before they were enqueued"
+)
 
 
-class ContextBatcher:
-    def __init__(self, batch_size: int, window_size_ms: int):
-        self._queue: asyncio.Queue[QueueObject] = asyncio.Queue()
-        self._is_running = False
-        self._background_task = None
+class BatcherOverloaded(Exception):
+    """Context is rejected, because it won't be processed in time"""
+
+    def __init__(self, retry_after: int):
+        super().__init__(f"ContextBatcher is overloaded, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+class BatchingPolicy:
+    """
+    Decides how long the batcher waits for the batch to fill and how big
+    the batch is. This one uses fixed values from settings.
+    """
+
+    def __init__(self, batch_size: int, window_size_ms: float):
         self._batch_size = batch_size
         self._window_size = window_size_ms / 1000
+        self._update_gauges()
+
+    @property
+    def batch_size(self) -> int:
+        return self._batch_size
+
+    @property
+    def window_size(self) -> float:
+        """Window size in seconds"""
+        return self._window_size
+
+    def record_arrival(self, now: float):
+        """Called for every context added to the batcher"""
+
+    def record_queue_depth(self, depth: int):
+        """Called with the worker queue depth after every enqueued batch"""
+
+    def _update_gauges(self):
+        window_size_gauge.set(self._window_size * 1000)
+        target_batch_size_gauge.set(self._batch_size)
+
+
+class AdaptiveBatchingPolicy(BatchingPolicy):
+    """
+    Adapts batching to the load within configured bounds:
+        * Target batch size grows by one while workers have a backlog
+          (bigger batches drain it faster) and shrinks by one once
+          the queue is empty (smaller batches have lower latency).
+        * Window is the expected time to collect the target batch with
+          the current arrival rate. If not even one more context is expected
+          within the max window, waiting is pointless and the min window is used.
+    """
+
+    # Smoothing factor for the exponentially weighted inter-arrival time
+    ALPHA = 0.2
+
+    def __init__(
+        self,
+        min_batch_size: int,
+        max_batch_size: int,
+        min_window_size_ms: float,
+        max_window_size_ms: float,
+    ):
+        self._min_batch_size = min_batch_size
+        self._max_batch_size = max_batch_size
+        self._min_window_size = min_window_size_ms / 1000
+        self._max_window_size = max_window_size_ms / 1000
+        self._last_arrival: Optional[float] = None
+        self._arrival_interval: Optional[float] = None
+        super().__init__(batch_size=min_batch_size, window_size_ms=min_window_size_ms)
+
+    @property
+    def arrival_rate(self) -> float:
+        if not self._arrival_interval:
+            return 0.0
+        return 1 / self._arrival_interval
+
+    def record_arrival(self, now: float):
+        if self._last_arrival is not None:
+            interval = max(now - self._last_arrival, 0.0)
+            if self._arrival_interval is None:
+                self._arrival_interval = interval
+            else:
+                self._arrival_interval = (
+                    self.ALPHA * interval + (1 - self.ALPHA) * self._arrival_interval
+                )
+        self._last_arrival = now
+        self._update_window_size()
+
+    def record_queue_depth(self, depth: int):
+        if depth > 0:
+            self._batch_size = min(self._batch_size + 1, self._max_batch_size)
+        else:
+            self._batch_size = max(self._batch_size - 1, self._min_batch_size)
+        self._update_window_size()
+
+    def _update_window_size(self):
+        expected_arrivals = self._max_window_size * self.arrival_rate
+        if expected_arrivals < 1:
+            self._window_size = self._min_window_size
+        else:
+            fill_time = (self._batch_size - 1) / self.arrival_rate
+            self._window_size = min(
+                max(fill_time, self._min_window_size), self._max_window_size
+            )
+        self._update_gauges()
+
+    def _update_gauges(self):
+        super()._update_gauges()
+        arrival_rate_gauge.set(self.arrival_rate)
+
+
+def group_by_length(
+    candidates: list[QueueObject],
+    batch_size: int,
+    estimate_length: Callable[[LLMContext], int],
+) -> tuple[list[QueueObject], list[QueueObject]]:
+    """
+    Splits candidates into the batch and the rest.
+    The batch is built around the oldest candidate (so nobody starves)
+    from the candidates with the closest expected output length,
+    because the batch lasts as long as its longest answer.
+    """
+    lengths = [estimate_length(ctx) for _, ctx in candidates]
+    closest = sorted(
+        range(1, len(candidates)),
+        key=lambda i: (abs(lengths[i] - lengths[0]), i),
+    )
+    chosen = {0, *closest[: batch_size - 1]}
+
+    batch = [obj for i, obj in enumerate(candidates) if i in chosen]
+    rest = [obj for i, obj in enumerate(candidates) if i not in chosen]
+    return batch, rest
+
+
+class ContextBatcher:
+    # Smoothing factor for the exponentially weighted worker throughput
+    THROUGHPUT_ALPHA = 0.3
+    # How often the worker queue depth is sampled in the bounded mode
+    QUEUE_DEPTH_INTERVAL = 0.5
+    # Max number of batches enqueued in one round trip
+    MAX_BULK_SIZE = 16
+
+    def __init__(
+        self,
+        redis: Redis,
+        batch_size: int,
+        window_size_ms: float,
+        policy: Optional[BatchingPolicy] = None,
+        capacity: int = 0,
+        estimate_length: Optional[Callable[[LLMContext], int]] = None,
+        lookahead: int = 1,
+        pubsub: Optional[PubSubMultiplexer] = None,
+    ):
+        """
+        With non-zero `capacity` the batcher works in the bounded mode:
+        contexts are rejected when the queue is full, or when the estimated
+        wait time exceeds `infer_job_ttl` (the client would give up anyway).
+
+        With `estimate_length` the batcher is length-aware: it collects up to
+        `lookahead` batches worth of candidates and groups the contexts with
+        similar output length. Candidates left out go first to the next batch.
+
+        With `pubsub` every batch gets its own channel, which is subscribed
+        before the batch is enqueued. Workers publish chunks of all the
+        contexts there at once, instead of one message per context.
+        """
+        self._redis = redis
+        self._queue: asyncio.Queue[QueueObject] = asyncio.Queue(maxsize=capacity)
+        self._is_running = False
+        self._background_tasks: list[asyncio.Task] = []
+        self._policy = policy or BatchingPolicy(batch_size, window_size_ms)
+        self._capacity = capacity
+        self._estimate_length = estimate_length
+        self._lookahead = lookahead if estimate_length else 1
+        self._carry_over: list[QueueObject] = []
+        self._pubsub = pubsub
+        # Contexts waiting in the queue, and the ones cancelled among them
+        self._queued: set[UUID] = set()
+        self._cancelled: set[UUID] = set()
+        # Worker throughput is estimated from the RQ queue depth samples
+        self._queue_depth = 0
+        self._queue_depth_sampled_at: Optional[float] = None
+        self._jobs_enqueued_since_sample = 0
+        self._jobs_per_second: Optional[float] = None
 
     async def _run(self):
         try:
             while True:
-                batch = await self._fill_batch()
+                batches = [await self._fill_batch()]
+                # When contexts are piling up, next batches are ready
+                # right away, so they are enqueued in the same round trip
+                while self._has_full_pool() and len(batches) < self.MAX_BULK_SIZE:
+                    batches.append(await self._fill_batch())
+
+                if self._pubsub is not None:
+                    await self._subscribe_batches(batches)
+
+                now = time.time()
+                for batch in batches:
+                    for context in batch:
+                        context.mark("batched", now)
+
                 # TTL will discard stale jobs in case
                 # our system is overwhelmed with requests
-                await infer.enqueue_async(batch, ttl=settings.infer_job_ttl)
+                # RQ needs whole seconds
+                job_ttl = math.ceil(settings.scaled(settings.infer_job_ttl))
+                await infer.enqueue_many_async(self._redis, batches, ttl=job_ttl)
+                self._jobs_enqueued_since_sample += len(batches)
+                await self._sample_queue_depth()
 
                 queue_size_gauge.set(self._queue.qsize())
-                batch_size.observe(len(batch))
+                for batch in batches:
+                    batch_size.observe(len(batch))
+                    batch_fill_ratio.observe(len(batch) / self._policy.batch_size)
         finally:
             self._is_running = False
 
+    async def _subscribe_batches(self, batches: list[list[LLMContext]]):
+        for batch in batches:
+            batch_id = uuid4()
+            for context in batch:
+                context.batch_id = batch_id
+
+        # Subscriptions are confirmed by Redis in one round trip
+        await asyncio.gather(
+            *(
+                self._pubsub.subscribe_batch(
+                    batch[0].batch_key, [context.redis_key for context in batch]
+                )
+                for batch in batches
+            )
+        )
+
+    async def _watch_queue_depth(self):
+        try:
+            while True:
+                await asyncio.sleep(self.QUEUE_DEPTH_INTERVAL)
+                await self._sample_queue_depth()
+        finally:
+            self._is_running = False
+
+    async def _sample_queue_depth(self):
+        depth = await infer.get_queue_depth_async(self._redis)
+        now = time.monotonic()
+
+        # Workers are idle without a backlog, it says nothing about throughput
+        has_backlog = self._queue_depth + self._jobs_enqueued_since_sample > 0
+        if self._queue_depth_sampled_at is not None and has_backlog:
+            elapsed = now - self._queue_depth_sampled_at
+            drained = self._queue_depth + self._jobs_enqueued_since_sample - depth
+            if elapsed > 0 and drained >= 0:
+                jobs_per_second = drained / elapsed
+                if self._jobs_per_second is None:
+                    self._jobs_per_second = jobs_per_second
+                else:
+                    self._jobs_per_second = (
+                        self.THROUGHPUT_ALPHA * jobs_per_second
+                        + (1 - self.THROUGHPUT_ALPHA) * self._jobs_per_second
+                    )
+
+        self._queue_depth = depth
+        self._queue_depth_sampled_at = now
+        self._jobs_enqueued_since_sample = 0
+        self._policy.record_queue_depth(depth)
+
+    def estimate_wait_time(self, pending_contexts: Optional[int] = None) -> float:
+        """
+        Estimated time (in seconds) for the new context
+        to be picked up by a worker. `pending_contexts` are
+        the ones waiting in this batcher by default.
+        """
+        if pending_contexts is None:
+            pending_contexts = self._queue.qsize() + len(self._carry_over)
+        pending_jobs = self._queue_depth + pending_contexts / self._policy.batch_size
+        if pending_jobs == 0 or not self._jobs_per_second:
+            # Nothing to wait for, or no data to judge yet
+            return 0.0
+        return pending_jobs / self._jobs_per_second
+
+    def _check_admission(self, pending_contexts: Optional[int] = None):
+        estimated_wait = self.estimate_wait_time(pending_contexts)
+        estimated_wait_gauge.set(estimated_wait)
+        job_ttl = settings.scaled(settings.infer_job_ttl)
+
+        if pending_contexts is None:
+            is_full = self._queue.full()
+        else:
+            is_full = pending_contexts >= self._capacity
+
+        if is_full:
+            retry_after = estimated_wait
+        elif estimated_wait > job_ttl:
+            retry_after = estimated_wait - job_ttl
+        else:
+            return
+
+        rejected_contexts.inc()
+        raise BatcherOverloaded(retry_after=max(math.ceil(retry_after), 1))
+
+    def _has_full_pool(self) -> bool:
+        pending_contexts = self._queue.qsize() + len(self._carry_over)
+        return pending_contexts >= self._policy.batch_size * self._lookahead
+
     async def _fill_batch(self) -> list[LLMContext]:
-        batch = []
+        target_batch_size = self._policy.batch_size
+        pool_size = target_batch_size * self._lookahead
+        candidates, self._carry_over = self._carry_over, []
+
         with contextlib.suppress(asyncio.TimeoutError):
             # Our initial timeout is infinite (None),
             # until we receive the first message.
             async with async_timeout.timeout(None) as cm:
-                while len(batch) < self._batch_size:
-                    enqueued_time, ctx = await self._queue.get()
-                    batch.append(ctx)
-
+                while len(candidates) < pool_size:
                     # After we received the first message
                     # we have to set a deadline
-                    if cm.deadline is None:
+                    if candidates and cm.deadline is None:
+                        enqueued_time = candidates[0][0]
                         time_passed = max(time.monotonic() - enqueued_time, 0.0)
-                        time_left = self._window_size - time_passed
+                        time_left = self._policy.window_size - time_passed
 
                         if time_left > 0.0:
                             cm.update(asyncio.get_running_loop().time() + time_left)
@@ -66,47 +378,106 @@ class ContextBatcher:
                             # the best strategy would be:
                             #   * fill batch as full as possible
                             #   * exit immediately
-                            available_contexts = min(
-                                self._queue.qsize(), self._batch_size - 1
-                            )
-                            for _ in range(available_contexts):
-                                _, ctx = self._queue.get_nowait()
-                                batch.append(ctx)
-
-                            return batch
+                            while len(candidates) < pool_size:
+                                candidate = self._get_nowait()
+                                if candidate is None:
+                                    break
+                                candidates.append(candidate)
+                            break
+
+                    candidates.append(await self._get())
+
+        if self._estimate_length and len(candidates) > target_batch_size:
+            candidates, self._carry_over = group_by_length(
+                candidates, target_batch_size, self._estimate_length
+            )
+
+        # Some contexts might be dropped while waiting for the window
+        batch = [ctx for _, ctx in candidates if not self._drop(ctx)]
+        for context in batch:
+            self._queued.discard(context.id)
+
+        if not batch:
+            return await self._fill_batch()
         return batch
 
+    def _drop(self, context: LLMContext) -> bool:
+        """Drops the context if it's cancelled or expired"""
+        if context.id in self._cancelled:
+            logger.info("Dropping cancelled %r", context)
+        elif context.is_expired():
+            logger.info("Dropping expired %r", context)
+            expired_contexts.inc()
+        else:
+            return False
+
+        self._cancelled.discard(context.id)
+        self._queued.discard(context.id)
+        return True
+
+    def _get_nowait(self) -> Optional[QueueObject]:
+        while not self._queue.empty():
+            obj = self._queue.get_nowait()
+            if not self._drop(obj[1]):
+                return obj
+        return None
+
+    async def _get(self) -> QueueObject:
+        while True:
+            obj = await self._queue.get()
+            if not self._drop(obj[1]):
+                return obj
+
     async def start(self):
         if self._is_running:
             return
 
         self._is_running = True
-        self._background_task = spawn(self._run())
+        self._background_tasks = [spawn(self._run())]
+        if self._capacity:
+            self._background_tasks.append(spawn(self._watch_queue_depth()))
 
     async def stop(self):
         if not self._is_running:
             return
 
         logger.info("Gracefully stopping ContextBatcher")
-        self._background_task.cancel()
-        with contextlib.suppress(asyncio.CancelledError):
-            await self._background_task
+        for task in self._background_tasks:
+            task.cancel()
+        for task in self._background_tasks:
+            with contextlib.suppress(asyncio.CancelledError):
+                await task
 
     def is_running(self) -> bool:
         return self._is_running
 
     async def add_context_to_batch(self, context: LLMContext):
         """
-        This method is made asynchronous in case we make underlying
-        queue bounded (to mitigate backpressure for example).
+        In the bounded mode raises `BatcherOverloaded` instead of waiting
+        for the free space in the queue, so the client can be told to retry
+        before any worker time is spent on it.
         """
         if not self._is_running:
             raise RuntimeError("Trying to batch context with stopped ContextBatcher")
 
+        if self._capacity:
+            self._check_admission()
+
         logger.info("Adding context %r to batch", context)
-        await self._queue.put((time.monotonic(), context))
+        now = time.monotonic()
+        self._policy.record_arrival(now)
+        self._queue.put_nowait((now, context))
+        self._queued.add(context.id)
         queue_size_gauge.inc()
 
+    async def cancel(self, context: LLMContext):
+        """
+        Drops the context, if it hasn't been enqueued yet.
+        Otherwise it's up to the worker.
+        """
+        if context.id in self._queued:
+            self._cancelled.add(context.id)
+
     async def __aenter__(self) -> "ContextBatcher":
         if self._is_running:
             raise RuntimeError("Trying to launch running ContextBatcher")
@@ -116,3 +487,193 @@ class ContextBatcher:
 
     async def __aexit__(self, exc_type, exc_val, exc_tb):
         await self.stop()
+
+
+class SharedContextBatcher(ContextBatcher):
+    """
+    Batcher shared by all API processes (uvicorn workers and replicas).
+
+    Contexts are pushed to the Redis list, instead of the local queue.
+    The process holding the leader lease moves them from the list
+    to its local queue, so batches are formed out of the traffic
+    of the whole API tier. Lease is renewed while the leader is alive,
+    and taken over by another process within `LEASE_MS` otherwise.
+    """
+
+    QUEUE_KEY = "batcher:contexts"
+    LEADER_KEY = "batcher:leader"
+    LEASE_MS = 3000
+    # Max number of contexts moved from Redis in one round trip
+    PULL_SIZE = 64
+    # How often the leader checks the full local queue for free slots
+    FULL_QUEUE_INTERVAL = 0.05
+
+    def __init__(self, redis: Redis, *args, **kwargs):
+        super().__init__(redis, *args, **kwargs)
+        self._instance_id = uuid4().hex.encode()
+        self._is_leader = False
+        self._is_stopping = False
+        self._lead_task: Optional[asyncio.Task] = None
+
+    def is_leader(self) -> bool:
+        return self._is_leader
+
+    async def _refresh_leadership(self) -> bool:
+        if await self._redis.set(
+            self.LEADER_KEY, self._instance_id, nx=True, px=self.LEASE_MS
+        ):
+            return True
+
+        # Renew the lease, only if it is still ours
+        async with self._redis.pipeline(transaction=True) as pipe:
+            try:
+                await pipe.watch(self.LEADER_KEY)
+                if await pipe.get(self.LEADER_KEY) != self._instance_id:
+                    return False
+                pipe.multi()
+                pipe.pexpire(self.LEADER_KEY, self.LEASE_MS)
+                await pipe.execute()
+                return True
+            except WatchError:
+                return False
+
+    async def _release_leadership(self):
+        async with self._redis.pipeline(transaction=True) as pipe:
+            with contextlib.suppress(WatchError):
+                await pipe.watch(self.LEADER_KEY)
+                if await pipe.get(self.LEADER_KEY) == self._instance_id:
+                    pipe.multi()
+                    pipe.delete(self.LEADER_KEY)
+                    await pipe.execute()
+
+    async def _lead(self):
+        # Blocking pop has to wake up in time to renew the lease
+        pull_timeout = max(self.LEASE_MS // 3000, 1)
+        try:
+            while not self._is_stopping:
+                is_leader = await self._refresh_leadership()
+                if is_leader != self._is_leader:
+                    logger.info("Batcher leadership changed: %s", is_leader)
+                    self._is_leader = is_leader
+
+                if not is_leader:
+                    await asyncio.sleep(self.LEASE_MS / 3000)
+                    continue
+
+                pull_size = self.PULL_SIZE
+                if self._capacity:
+                    # The rest waits in Redis, instead of overflowing the queue
+                    pull_size = min(pull_size, self._capacity - self._queue.qsize())
+                if pull_size <= 0:
+                    await asyncio.sleep(self.FULL_QUEUE_INTERVAL)
+                    continue
+
+                response = await self._redis.blpop(self.QUEUE_KEY, pull_timeout)
+                if response is None:
+                    continue
+                items = [response[1]]
+                if pull_size > 1:
+                    items.extend(
+                        await self._redis.lpop(self.QUEUE_KEY, pull_size - 1) or []
+                    )
+                self._put_shared(items)
+        except BaseException:
+            self._is_running = False
+            raise
+
+    def _put_shared(self, items: list[bytes]):
+        now, wall_now = time.monotonic(), time.time()
+        for item in items:
+            pushed_at, context = pickle.loads(item)
+            # Arrival time is translated to the local monotonic clock
+            arrived = now - max(wall_now - pushed_at, 0.0)
+            self._policy.record_arrival(arrived)
+            self._queue.put_nowait((arrived, context))
+            self._queued.add(context.id)
+        queue_size_gauge.set(self._queue.qsize())
+
+    async def start(self):
+        if self._is_running:
+            return
+
+        self._is_stopping = False
+        await super().start()
+        self._lead_task = spawn(self._lead())
+        self._background_tasks.append(self._lead_task)
+
+    async def stop(self):
+        if not self._is_running:
+            return
+
+        # Blocking pop is never cancelled, otherwise
+        # the context popped at the same moment would be lost
+        self._is_stopping = True
+        await self._lead_task
+        await self._release_leadership()
+        self._is_leader = False
+        await super().stop()
+
+        # Contexts that haven't made it into a batch are handed over
+        leftovers = [*self._carry_over]
+        while not self._queue.empty():
+            leftovers.append(self._queue.get_nowait())
+        if leftovers:
+            await self._redis.lpush(
+                self.QUEUE_KEY,
+                *(
+                    pickle.dumps((time.time() - (time.monotonic() - arrived), ctx))
+                    for arrived, ctx in reversed(leftovers)
+                ),
+            )
+
+    async def add_context_to_batch(self, context: LLMContext):
+        """
+        In the bounded mode admission is based on the length of the shared
+        list, because the local queue of a follower is always empty.
+        """
+        if not self._is_running:
+            raise RuntimeError("Trying to batch context with stopped ContextBatcher")
+
+        if self._capacity:
+            self._check_admission(await self._redis.llen(self.QUEUE_KEY))
+
+        logger.info("Adding context %r to shared batch", context)
+        await self._redis.rpush(self.QUEUE_KEY, pickle.dumps((time.time(), context)))
+
+
+class ContextQueue:
+    """
+    Replaces the batcher in the "pull" worker mode: contexts are pushed
+    straight to the Redis list, and workers form batches themselves.
+    """
+
+    def __init__(self, redis: Redis):
+        self._redis = redis
+        self._is_running = False
+
+    async def start(self):
+        self._is_running = True
+
+    async def stop(self):
+        self._is_running = False
+
+    def is_running(self) -> bool:
+        return self._is_running
+
+    async def add_context_to_batch(self, context: LLMContext):
+        if not self._is_running:
+            raise RuntimeError("Trying to queue context with stopped ContextQueue")
+
+        logger.info("Pushing context %r to workers", context)
+        context.mark("batched")
+        await infer.push_context_async(self._redis, context)
+
+    async def cancel(self, context: LLMContext):
+        """Queued contexts are pruned by workers"""
+
+    async def __aenter__(self) -> "ContextQueue":
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.stop()
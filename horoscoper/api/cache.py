@@ -0,0 +1,69 @@
+import hashlib
+import json
+import logging
+import time
+from typing import Optional
+
+from prometheus_client import Counter
+from redis.asyncio import Redis
+
+logger = logging.getLogger(__name__)
+
+cache_hits = Counter("response_cache_hits", "Responses served from the cache")
+cache_misses = Counter("response_cache_misses", "Responses missing in the cache")
+cache_evictions = Counter("response_cache_evictions", "Responses evicted from cache")
+
+
+class ResponseCache:
+    """
+    Model output is deterministic in the prefix, so finished responses
+    are cached in Redis and shared by all API instances.
+
+    Every response (list of chunks) is stored under the prefix hash with TTL.
+    Sorted set of the keys scored by the last access time bounds the cache
+    with `max_entries`, evicting the least recently used responses.
+    """
+
+    INDEX_KEY = b"cache:index"
+
+    def __init__(self, redis: Redis, ttl: int, max_entries: int):
+        self._redis = redis
+        self._ttl = ttl
+        self._max_entries = max_entries
+
+    @staticmethod
+    def key(prefix: str) -> bytes:
+        return b"cache:" + hashlib.sha256(prefix.encode()).digest()
+
+    async def get(self, prefix: str) -> Optional[list[str]]:
+        key = self.key(prefix)
+        async with self._redis.pipeline(transaction=False) as pipe:
+            pipe.get(key)
+            pipe.zadd(self.INDEX_KEY, {key: time.time()}, xx=True)
+            cached, _ = await pipe.execute()
+
+        if cached is None:
+            cache_misses.inc()
+            return None
+
+        cache_hits.inc()
+        return json.loads(cached)
+
+    async def set(self, prefix: str, chunks: list[str]):
+        key = self.key(prefix)
+        async with self._redis.pipeline(transaction=False) as pipe:
+            pipe.set(key, json.dumps(chunks), ex=self._ttl)
+            pipe.zadd(self.INDEX_KEY, {key: time.time()})
+            pipe.zcard(self.INDEX_KEY)
+            *_, size = await pipe.execute()
+
+        if size > self._max_entries:
+            await self._evict(size - self._max_entries)
+
+    async def _evict(self, count: int):
+        # Expired responses are evicted as well, since they are never touched
+        evicted = await self._redis.zpopmin(self.INDEX_KEY, count)
+        if evicted:
+            await self._redis.delete(*(key for key, _ in evicted))
+            cache_evictions.inc(len(evicted))
+            logger.info("Evicted %d responses from the cache", len(evicted))
@@ -4,27 +4,93 @@ import redis.asyncio as redis
 from fastapi import FastAPI
 from starlette_exporter import PrometheusMiddleware, handle_metrics
 
+from horoscoper.horoscope import get_index
+from horoscoper.llm import LLMContext
 from horoscoper.settings import settings, setup_logging
 
-from .batcher import ContextBatcher
+from .batcher import (
+    AdaptiveBatchingPolicy,
+    ContextBatcher,
+    ContextQueue,
+    SharedContextBatcher,
+)
+from .cache import ResponseCache
+from .pubsub import PubSubMultiplexer
+from .singleflight import FlightRegistry
 from .state import AppState
+from .tracing import Tracer
 from .views import router
 
 
+def estimate_length(context: LLMContext) -> int:
+    return get_index().predict_length(context.prefix)
+
+
 @asynccontextmanager
 async def lifespan(app_: FastAPI):
     setup_logging()
     async with AsyncExitStack() as stack:
-        batcher = await stack.enter_async_context(
-            ContextBatcher(
-                batch_size=settings.batcher_batch_size,
-                window_size_ms=settings.batcher_window_ms,
+        policy = None
+        if settings.batcher_adaptive:
+            policy = AdaptiveBatchingPolicy(
+                min_batch_size=settings.batcher_min_batch_size,
+                max_batch_size=settings.batcher_max_batch_size,
+                min_window_size_ms=settings.scaled(settings.batcher_min_window_ms),
+                max_window_size_ms=settings.scaled(settings.batcher_max_window_ms),
             )
-        )
+        if settings.batcher_length_aware:
+            get_index()  # Cache index in memory
         redis_client = await stack.enter_async_context(
             redis.from_url(settings.redis_url)
         )
-        app_.state.app_state = AppState(batcher=batcher, redis=redis_client)
+        pubsub = await stack.enter_async_context(PubSubMultiplexer(redis_client))
+        batcher_kwargs = dict(
+            batch_size=settings.batcher_batch_size,
+            window_size_ms=settings.scaled(settings.batcher_window_ms),
+            policy=policy,
+            capacity=settings.batcher_queue_capacity,
+            estimate_length=(
+                estimate_length if settings.batcher_length_aware else None
+            ),
+            lookahead=settings.batcher_lookahead,
+        )
+        if settings.transport == "batch" and (
+            settings.worker_mode == "pull" or settings.batcher_shared
+        ):
+            # Batch channel has to be subscribed by the process, that batches
+            raise RuntimeError("Batch transport requires local ContextBatcher")
+
+        if settings.worker_mode == "pull":
+            batcher = ContextQueue(redis_client)
+        elif settings.batcher_shared:
+            batcher = SharedContextBatcher(redis_client, **batcher_kwargs)
+        else:
+            batcher = ContextBatcher(
+                redis_client,
+                **batcher_kwargs,
+                pubsub=pubsub if settings.transport == "batch" else None,
+            )
+        await stack.enter_async_context(batcher)
+        cache = None
+        if settings.cache_enabled:
+            cache = ResponseCache(
+                redis_client,
+                ttl=settings.cache_ttl,
+                max_entries=settings.cache_max_entries,
+            )
+        tracer = None
+        if settings.tracing_enabled:
+            tracer = await stack.enter_async_context(
+                Tracer(trace_file=settings.trace_file)
+            )
+        app_.state.app_state = AppState(
+            batcher=batcher,
+            redis=redis_client,
+            pubsub=pubsub,
+            cache=cache,
+            flights=FlightRegistry() if settings.singleflight_enabled else None,
+            tracer=tracer,
+        )
         yield
 
 
@@ -0,0 +1,281 @@
+import asyncio
+import contextlib
+import logging
+from typing import Optional
+
+from prometheus_client import Gauge
+from redis.asyncio import Redis
+from redis.asyncio.client import PubSub
+
+from horoscoper.tasks.infer import decode_batch_message
+from horoscoper.utils import spawn
+
+logger = logging.getLogger(__name__)
+
+channels_gauge = Gauge("pubsub_channels", "Channels subscribed by PubSubMultiplexer")
+
+
+class Subscription:
+    """
+    Per-request view on the shared Pub/Sub connection.
+    Messages published to the channel are collected in a local queue.
+    """
+
+    def __init__(self, multiplexer: "PubSubMultiplexer", channel: bytes):
+        self.channel = channel
+        self._multiplexer = multiplexer
+        self._queue: asyncio.Queue[bytes] = asyncio.Queue()
+        self._confirmed = asyncio.get_running_loop().create_future()
+        # Set for subscriptions, which are delivered within a batch channel
+        self._local = False
+        self._batch: Optional["BatchSubscription"] = None
+
+    def _deliver(self, data: bytes):
+        self._queue.put_nowait(data)
+
+    async def get_message(self, timeout: Optional[float] = None) -> Optional[bytes]:
+        """Returns data of the next message or `None` on timeout"""
+        with contextlib.suppress(asyncio.TimeoutError):
+            return await asyncio.wait_for(self._queue.get(), timeout=timeout)
+        return None
+
+    def close(self):
+        self._multiplexer._unsubscribe(self)
+
+    async def __aenter__(self) -> "Subscription":
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class BatchSubscription(Subscription):
+    """
+    Subscription to the batch channel, where every message holds chunks
+    of all the contexts in the batch. They are demultiplexed
+    to the local subscriptions of the contexts.
+    """
+
+    def __init__(
+        self, multiplexer: "PubSubMultiplexer", channel: bytes, members: set[bytes]
+    ):
+        super().__init__(multiplexer, channel)
+        self.members = members
+
+    def _deliver(self, data: bytes):
+        for channel, message in decode_batch_message(data):
+            subscription = self._multiplexer._subscriptions.get(channel)
+            if subscription is not None:
+                subscription._deliver(message)
+
+
+class PubSubMultiplexer:
+    """
+    Every request used to open its own Pub/Sub connection, which means
+    thousands of Redis connections under the load.
+
+    This class owns one long-lived Pub/Sub connection per API process
+    and routes incoming messages to per-request queues by channel.
+    Channels requested by the concurrent requests are (un)subscribed
+    with a single command in the background.
+    """
+
+    # Max time to wait for Redis to confirm the subscription
+    CONFIRMATION_TIMEOUT = 5.0
+
+    def __init__(self, redis: Redis):
+        self._redis = redis
+        self._pubsub: Optional[PubSub] = None
+        self._subscriptions: dict[bytes, Subscription] = {}
+        self._to_subscribe: set[bytes] = set()
+        self._to_unsubscribe: set[bytes] = set()
+        self._changed = asyncio.Event()
+        self._is_running = False
+        self._background_tasks: list[asyncio.Task] = []
+
+    async def _read(self):
+        try:
+            while True:
+                message = await self._pubsub.get_message(timeout=None)
+                if message is None:
+                    continue
+
+                subscription = self._subscriptions.get(message["channel"])
+                if subscription is None:
+                    # Late message for the closed subscription
+                    continue
+
+                if message["type"] == "subscribe":
+                    if not subscription._confirmed.done():
+                        subscription._confirmed.set_result(None)
+                elif message["type"] == "message":
+                    subscription._deliver(message["data"])
+        except BaseException as exc:
+            self._fail_pending(exc)
+            raise
+        finally:
+            self._is_running = False
+
+    async def _sync_channels(self):
+        try:
+            while True:
+                await self._changed.wait()
+                # Let concurrent requests join the same round trip
+                await asyncio.sleep(0)
+                self._changed.clear()
+
+                to_unsubscribe, self._to_unsubscribe = self._to_unsubscribe, set()
+                to_subscribe, self._to_subscribe = self._to_subscribe, set()
+
+                if to_unsubscribe:
+                    await self._pubsub.unsubscribe(*to_unsubscribe)
+                if to_subscribe:
+                    await self._pubsub.subscribe(*to_subscribe)
+
+                channels_gauge.set(len(self._subscriptions))
+        except BaseException as exc:
+            self._fail_pending(exc)
+            raise
+        finally:
+            self._is_running = False
+
+    def _fail_pending(self, exc: BaseException):
+        """Subscriptions won't be confirmed, once background tasks are gone"""
+        if not isinstance(exc, Exception):
+            exc = RuntimeError("PubSubMultiplexer is stopped")
+        for subscription in list(self._subscriptions.values()):
+            if not subscription._confirmed.done():
+                subscription._confirmed.set_exception(exc)
+
+    async def subscribe(self, channel: bytes) -> Subscription:
+        """
+        Subscribes to the channel and waits until Redis confirms it,
+        so that no message published afterwards is lost.
+        """
+        subscription = Subscription(multiplexer=self, channel=channel)
+        await self._subscribe(subscription)
+        return subscription
+
+    def register(self, channel: bytes) -> Subscription:
+        """
+        Creates a local subscription, that isn't subscribed in Redis.
+        Messages are delivered to it once the batch channel,
+        the channel belongs to, is subscribed with `subscribe_batch`.
+        """
+        if channel in self._subscriptions:
+            raise RuntimeError(f"Channel {channel!r} is already subscribed")
+
+        subscription = Subscription(multiplexer=self, channel=channel)
+        subscription._local = True
+        subscription._confirmed.set_result(None)
+        self._subscriptions[channel] = subscription
+        return subscription
+
+    async def subscribe_batch(
+        self, channel: bytes, members: list[bytes]
+    ) -> Optional[BatchSubscription]:
+        """
+        Subscribes to the batch channel and routes its messages to the
+        registered `members`. It is unsubscribed once all of them are closed.
+        Returns `None`, if they are all closed before the batch is subscribed.
+        """
+        members = {
+            member
+            for member in members
+            if member in self._subscriptions and self._subscriptions[member]._local
+        }
+        if not members:
+            # All requests are already gone
+            return None
+
+        subscription = BatchSubscription(
+            multiplexer=self, channel=channel, members=members
+        )
+        for member in members:
+            self._subscriptions[member]._batch = subscription
+
+        await self._subscribe(subscription)
+        if self._subscriptions.get(channel) is not subscription:
+            # Members are closed, while waiting for the confirmation
+            return None
+        return subscription
+
+    async def _subscribe(self, subscription: Subscription):
+        if not self._is_running:
+            raise RuntimeError("Trying to subscribe with stopped PubSubMultiplexer")
+
+        channel = subscription.channel
+        if channel in self._subscriptions:
+            raise RuntimeError(f"Channel {channel!r} is already subscribed")
+
+        self._subscriptions[channel] = subscription
+        self._to_unsubscribe.discard(channel)
+        self._to_subscribe.add(channel)
+        self._changed.set()
+
+        try:
+            await asyncio.wait_for(
+                subscription._confirmed, timeout=self.CONFIRMATION_TIMEOUT
+            )
+        except BaseException:
+            subscription.close()
+            raise
+
+    def _unsubscribe(self, subscription: Subscription):
+        channel = subscription.channel
+        if self._subscriptions.get(channel) is not subscription:
+            return
+
+        del self._subscriptions[channel]
+        if not subscription._confirmed.done():
+            # Nobody waits for the confirmation of the closed subscription
+            subscription._confirmed.set_result(None)
+
+        if subscription._local:
+            batch = subscription._batch
+            if batch is not None:
+                batch.members.discard(channel)
+                if not batch.members:
+                    batch.close()
+            return
+
+        if channel in self._to_subscribe:
+            self._to_subscribe.discard(channel)
+        else:
+            self._to_unsubscribe.add(channel)
+        self._changed.set()
+
+    async def start(self):
+        if self._is_running:
+            return
+
+        self._pubsub = self._redis.pubsub()
+        await self._pubsub.connect()
+        self._is_running = True
+        self._background_tasks = [spawn(self._read()), spawn(self._sync_channels())]
+
+    async def stop(self):
+        if not self._is_running:
+            return
+
+        logger.info("Gracefully stopping PubSubMultiplexer")
+        for task in self._background_tasks:
+            task.cancel()
+        for task in self._background_tasks:
+            with contextlib.suppress(asyncio.CancelledError):
+                await task
+
+        await self._pubsub.close()
+
+    def is_running(self) -> bool:
+        return self._is_running
+
+    async def __aenter__(self) -> "PubSubMultiplexer":
+        if self._is_running:
+            raise RuntimeError("Trying to launch running PubSubMultiplexer")
+
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.stop()
@@ -0,0 +1,143 @@
+import asyncio
+import logging
+from typing import AsyncIterator, Awaitable, Callable, Optional
+
+from prometheus_client import Counter
+
+from horoscoper.llm import LLMContext
+from horoscoper.tasks.infer import InferMessageStatus, message_status
+from horoscoper.utils import spawn
+
+logger = logging.getLogger(__name__)
+
+# Message source yields `(event_id, raw_message)` pairs or `None` on timeout
+MessageSource = AsyncIterator[Optional[tuple[Optional[str], bytes]]]
+
+joined_flights = Counter(
+    "singleflight_joined", "Requests attached to the in-flight context"
+)
+
+
+class Flight:
+    """
+    Inference of one context shared by all the requests with the same prefix.
+    Messages are read from the source in the background and kept,
+    so that late joiners get the whole response replayed.
+    """
+
+    def __init__(self, registry: "FlightRegistry", context: LLMContext):
+        self.context = context
+        self._registry = registry
+        self._messages: list[Optional[tuple[Optional[str], bytes]]] = []
+        self._appended = asyncio.Event()
+        self._started = asyncio.get_running_loop().create_future()
+        self._reader: Optional[asyncio.Task] = None
+        self._is_done = False
+        self._listeners = 0
+
+    async def wait_started(self) -> bool:
+        """Returns `False` if the context has never made it to the batcher"""
+        return await asyncio.shield(self._started)
+
+    def start(
+        self,
+        messages: MessageSource,
+        close: Optional[Callable[[], None]],
+        on_cancel: Optional[Callable[[], Awaitable[None]]] = None,
+    ):
+        """
+        `on_cancel` is called, if the flight is over
+        before the inference (no listeners left or timeout).
+        """
+        self._reader = spawn(self._read(messages, close, on_cancel))
+        self._started.set_result(True)
+
+    def abort(self):
+        self._registry._remove(self)
+        self._started.set_result(False)
+
+    async def _read(
+        self,
+        messages: MessageSource,
+        close: Optional[Callable],
+        on_cancel: Optional[Callable],
+    ):
+        finished = False
+        try:
+            async for message in messages:
+                self._messages.append(message)
+                self._appended.set()
+                self._appended = asyncio.Event()
+
+                if message is None:
+                    break
+                if message_status(message[1]) in (
+                    InferMessageStatus.ERROR,
+                    InferMessageStatus.FINISHED,
+                ):
+                    finished = True
+                    break
+        finally:
+            self._is_done = True
+            self._appended.set()
+            self._registry._remove(self)
+
+            await messages.aclose()
+            if close is not None:
+                close()
+            if not finished and on_cancel is not None:
+                spawn(on_cancel())
+
+    async def listen(self) -> MessageSource:
+        self._listeners += 1
+        try:
+            position = 0
+            while True:
+                while position < len(self._messages):
+                    yield self._messages[position]
+                    position += 1
+
+                if self._is_done:
+                    return
+                await self._appended.wait()
+        finally:
+            self._listeners -= 1
+            # Nobody is interested anymore
+            if self._listeners == 0 and not self._is_done:
+                self._reader.cancel()
+
+
+class FlightRegistry:
+    """
+    Single-flight registry of the contexts that are queued or being
+    generated by their prefix. Identical requests join the existing
+    flight instead of taking another batch slot.
+    """
+
+    def __init__(self):
+        self._flights: dict[str, Flight] = {}
+
+    async def join(self, context: LLMContext) -> tuple[Flight, bool]:
+        """
+        Returns the flight for the context prefix and whether the caller
+        leads it, i.e. has to start the inference of the `context`.
+        """
+        while True:
+            flight = self._flights.get(context.prefix)
+            if flight is None:
+                flight = Flight(registry=self, context=context)
+                self._flights[context.prefix] = flight
+                return flight, True
+
+            if await flight.wait_started():
+                logger.info("Joining %r to %r", context, flight.context)
+                joined_flights.inc()
+                return flight, False
+            # Otherwise the leader has failed, and the flight is gone
+
+    def _remove(self, flight: Flight):
+        if self._flights.get(flight.context.prefix) is flight:
+            del self._flights[flight.context.prefix]
+
+    def __len__(self) -> int:
+        return len(self._flights)
@@ -1,10 +1,14 @@
 from dataclasses import dataclass
-from typing import Annotated
+from typing import Annotated, Optional, Union
 
 from fastapi import Depends, Request
 from redis.asyncio import Redis
 
-from .batcher import ContextBatcher
+from .batcher import ContextBatcher, ContextQueue
+from .cache import ResponseCache
+from .pubsub import PubSubMultiplexer
+from .singleflight import FlightRegistry
+from .tracing import Tracer
 
 
 @dataclass
@@ -21,8 +25,12 @@ class AppState:
     stored in `Application` object itself and initialized during `lifespan` call.
     """
 
-    batcher: ContextBatcher
+    batcher: Union[ContextBatcher, ContextQueue]
     redis: Redis
+    pubsub: PubSubMultiplexer
+    cache: Optional[ResponseCache] = None
+    flights: Optional[FlightRegistry] = None
+    tracer: Optional[Tracer] = None
 
 
 def get_app_state(request: Request) -> AppState:
@@ -0,0 +1,138 @@
+import asyncio
+import contextlib
+import json
+import logging
+from pathlib import Path
+from typing import IO, Optional
+
+from prometheus_client import Histogram
+
+from horoscoper.llm import LLMContext
+from horoscoper.utils import spawn
+
+logger = logging.getLogger(__name__)
+
+# Stage of the inference and the timestamps it is measured between:
+#   * batcher - waiting in the API batcher (or the shared queue);
+#   * queue - waiting in the worker queue till the worker picks the batch up;
+#   * first_step - the first decode step of the batch;
+#   * delivery - publishing the first chunk and delivering it to the API;
+#   * generation - the rest of the response.
+STAGES = [
+    ("batcher", "received", "batched"),
+    ("queue", "batched", "picked"),
+    ("first_step", "picked", "first_step"),
+    ("delivery", "first_step", "delivered"),
+    ("generation", "delivered", "finished"),
+]
+
+stage_latency = Histogram(
+    "api_infer_stage_latency", "Latency of the inference stages", ["stage"]
+)
+
+
+class Tracer:
+    """
+    Traced contexts collect UNIX timestamps of the pipeline stages:
+    API, batcher and workers mark them on the context, and workers
+    send them back with the first chunk. Once the response is over,
+    stage latencies are observed and the trace is appended
+    to `trace_file` (JSON lines), if given.
+
+    Stages, that span API and workers, rely on their clocks being in sync.
+    Traces are written by a background task in a thread, so the event loop
+    never waits for the disk. They are only written while it's running.
+    """
+
+    def __init__(self, trace_file: Optional[Path] = None):
+        self._trace_file = trace_file
+        self._file: Optional[IO[str]] = None
+        # Lines to be written, `None` stops the writer
+        self._lines: Optional[asyncio.Queue[Optional[str]]] = None
+        self._is_running = False
+        self._writer_task: Optional[asyncio.Task] = None
+
+    def trace(self, context: LLMContext):
+        context.timings = {}
+        context.mark("received")
+
+    def export(self, context: LLMContext, outcome: str):
+        timings = context.timings
+        if timings is None:
+            return
+
+        for stage, start, end in STAGES:
+            if start in timings and end in timings:
+                stage_latency.labels(stage=stage).observe(
+                    max(timings[end] - timings[start], 0.0)
+                )
+
+        if self._trace_file is not None and self._is_running:
+            trace = {
+                "context_id": str(context.id),
+                "outcome": outcome,
+                "timings": timings,
+            }
+            self._lines.put_nowait(json.dumps(trace) + "\n")
+
+    async def _write(self):
+        try:
+            while True:
+                lines = [await self._lines.get()]
+                # Everything exported meanwhile is written at once
+                while not self._lines.empty():
+                    lines.append(self._lines.get_nowait())
+
+                is_stopping = lines[-1] is None
+                lines = [line for line in lines if line is not None]
+                if lines:
+                    await asyncio.to_thread(self._write_lines, lines)
+                if is_stopping:
+                    return
+        finally:
+            self._is_running = False
+
+    def _write_lines(self, lines: list[str]):
+        if self._file is None:
+            # Line buffered, so that traces can be tailed by a collector
+            self._file = open(self._trace_file, "a", buffering=1)
+        self._file.writelines(lines)
+
+    async def start(self):
+        if self._is_running:
+            return
+
+        self._lines = asyncio.Queue()
+        self._is_running = True
+        if self._trace_file is not None:
+            self._writer_task = spawn(self._write())
+
+    async def stop(self):
+        if not self._is_running:
+            return
+
+        logger.info("Gracefully stopping Tracer")
+        self._is_running = False
+        if self._writer_task is not None:
+            # Exported traces are written before the file is closed
+            self._lines.put_nowait(None)
+            with contextlib.suppress(Exception):
+                await self._writer_task
+            self._writer_task = None
+
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def is_running(self) -> bool:
+        return self._is_running
+
+    async def __aenter__(self) -> "Tracer":
+        if self._is_running:
+            raise RuntimeError("Trying to launch running Tracer")
+
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.stop()
@@ -1,19 +1,36 @@
+import asyncio
+import functools
 import logging
 import time
 from pathlib import Path
+from typing import Annotated, Awaitable, Callable, Optional
+from uuid import UUID
 
-from fastapi import APIRouter, HTTPException, Request
+from fastapi import APIRouter, Header, HTTPException, Request
 from fastapi.responses import HTMLResponse
 from fastapi.templating import Jinja2Templates
 from prometheus_client import Counter, Histogram
 from pydantic import BaseModel, Field
+from redis.asyncio import Redis
 from sse_starlette.sse import EventSourceResponse, ServerSentEvent
+from starlette.background import BackgroundTask
 
 from horoscoper.llm import LLMContext
 from horoscoper.settings import settings
-from horoscoper.tasks.infer import InferMessage, InferMessageStatus
+from horoscoper.tasks.infer import (
+    InferMessage,
+    InferMessageStatus,
+    render_message,
+    stream_id,
+)
+from horoscoper.utils import spawn
 
-from .state import State
+from .batcher import BatcherOverloaded
+from .cache import ResponseCache
+from .pubsub import Subscription
+from .singleflight import MessageSource
+from .state import AppState, State
+from .tracing import Tracer
 
 API_DIR = Path(__file__).parent
 
@@ -23,6 +40,9 @@ infer_first_response = Histogram(
 infer_messages_count = Counter(
     "api_infer_messages_count", "InferMessage counter in API", ["status"]
 )
+infer_cancelled_count = Counter(
+    "api_infer_cancelled_count", "Inferences cancelled before they are finished"
+)
 
 logger = logging.getLogger(__name__)
 router = APIRouter()
@@ -36,7 +56,7 @@ async def index(request: Request):
 
 @router.get("/healthcheck", include_in_schema=False)
 async def healthcheck(state: State):
-    if not state.batcher.is_running():
+    if not state.batcher.is_running() or not state.pubsub.is_running():
         raise HTTPException(status_code=500, detail="API unhealthy")
 
 
@@ -44,56 +64,280 @@ class APIInferRequest(BaseModel):
     prefix: str = Field(max_length=1024)
 
 
+async def iter_pubsub_messages(
+    subscription: Subscription, context: LLMContext
+) -> MessageSource:
+    async with subscription:
+        while True:
+            json_data = await subscription.get_message(
+                timeout=context.time_left(settings.scaled(settings.infer_job_ttl))
+            )
+            if json_data is None:
+                yield None
+                return
+            yield None, json_data
+
+
+async def iter_stream_messages(
+    redis: Redis, context: LLMContext, last_seq: int = 0
+) -> MessageSource:
+    last_id = stream_id(last_seq)
+    while True:
+        timeout = context.time_left(settings.scaled(settings.infer_job_ttl))
+        if timeout <= 0:
+            response = None
+        else:
+            # Zero would block forever
+            response = await redis.xread(
+                {context.stream_key: last_id}, block=max(int(timeout * 1000), 1)
+            )
+        if not response:
+            yield None
+            return
+
+        for _, entries in response:
+            for entry_id, fields in entries:
+                last_id = entry_id
+                _, seq = entry_id.decode().split("-")
+                yield seq, fields[b"data"]
+
+
+async def iter_infer_response(
+    request: Request,
+    context: LLMContext,
+    messages: MessageSource,
+    cache: Optional[ResponseCache] = None,
+    on_cancel: Optional[Callable[[], Awaitable[None]]] = None,
+    tracer: Optional[Tracer] = None,
+):
+    """
+    `on_cancel` is called in the background, if the response
+    is over before the inference (client is gone or timeout).
+    `tracer` exports the stage timings of the context afterwards.
+    """
+    first_message = True
+    start_infer = time.monotonic()
+    # Rendered messages of the response, cached once it is finished
+    rendered_messages: list[str] = []
+    finished = False
+    outcome = "cancelled"
+
+    try:
+        async for message in messages:
+            # In case client drops the connection
+            if await request.is_disconnected():
+                return
+
+            # Timeout case
+            if message is None:
+                logger.info("Timeout inference for %r", context)
+                outcome = "timeout"
+                error_msg = InferMessage(
+                    status=InferMessageStatus.ERROR,
+                    text="",
+                    error="Timeout inference",
+                )
+                yield ServerSentEvent(data=error_msg.model_dump_json())
+                infer_messages_count.labels(status=str(InferMessageStatus.ERROR)).inc()
+                return
+
+            event_id, raw_message = message
+            status, json_data, timings = render_message(raw_message)
+
+            # Metrics
+            infer_messages_count.labels(status=str(status)).inc()
+            if first_message:
+                infer_first_response.observe(time.monotonic() - start_infer)
+                first_message = False
+            if timings is not None and tracer is not None:
+                # Worker's copy of the context has seen more stages
+                context.timings.update(timings)
+                context.mark("delivered")
+
+            yield ServerSentEvent(data=json_data, id=event_id)
+            if cache is not None:
+                rendered_messages.append(json_data)
+
+            if status == InferMessageStatus.FINISHED and cache is not None:
+                chunks = [
+                    InferMessage.model_validate_json(json_data).text
+                    for json_data in rendered_messages
+                ]
+                await cache.set(context.prefix, chunks)
+
+            if status in (
+                InferMessageStatus.ERROR,
+                InferMessageStatus.FINISHED,
+            ):
+                finished = True
+                outcome = str(status.value).lower()
+                context.mark("finished")
+                return
+    finally:
+        if not finished and on_cancel is not None:
+            spawn(on_cancel())
+        if tracer is not None:
+            tracer.export(context, outcome)
+
+
+async def iter_cached_response(request: Request, chunks: list[str]):
+    for seq, text in enumerate(chunks, start=1):
+        if await request.is_disconnected():
+            return
+
+        if seq > 1 and settings.cache_pacing_ms:
+            # Pretend the response is generated
+            await asyncio.sleep(settings.scaled(settings.cache_pacing_ms / 1000))
+
+        status = (
+            InferMessageStatus.FINISHED
+            if seq == len(chunks)
+            else InferMessageStatus.IN_PROGRESS
+        )
+        infer_messages_count.labels(status=str(status)).inc()
+        yield ServerSentEvent(
+            data=InferMessage(text=text, status=status, seq=seq).model_dump_json()
+        )
+
+
+async def add_context_to_batch(state: AppState, context: LLMContext):
+    try:
+        await state.batcher.add_context_to_batch(context)
+    except BatcherOverloaded as e:
+        logger.info("Rejecting %r: %s", context, e)
+        raise HTTPException(
+            status_code=429,
+            detail="Too many requests",
+            headers={"Retry-After": str(e.retry_after)},
+        )
+
+
+async def cancel_inference(state: AppState, context: LLMContext):
+    """
+    Removes the context from the batcher queue or, if it has already
+    been enqueued, tells workers to drop it between steps.
+    """
+    logger.info("Cancelling %r", context)
+    infer_cancelled_count.inc()
+    await state.batcher.cancel(context)
+    await state.redis.set(context.cancel_key, 1, ex=settings.cancel_ttl)
+
+
+def get_cancel_callback(
+    state: AppState, context: LLMContext
+) -> Optional[Callable[[], Awaitable[None]]]:
+    # Streams can be resumed, so the client might be back
+    if not settings.cancellation_enabled or settings.transport == "streams":
+        return None
+    return functools.partial(cancel_inference, state, context)
+
+
+async def start_inference(
+    state: AppState, context: LLMContext
+) -> tuple[MessageSource, Optional[Callable[[], None]]]:
+    """
+    Batches the context and returns the source of its messages
+    with the callback releasing the source, if it has never been started.
+    """
+    if settings.transport == "streams":
+        await add_context_to_batch(state, context)
+        return iter_stream_messages(state.redis, context), None
+
+    # Subscribe before the context is batched, otherwise
+    # the first messages could be published to nowhere.
+    # Batch channel is subscribed by the batcher on behalf of the request
+    if settings.transport == "batch":
+        subscription = state.pubsub.register(context.redis_key)
+    else:
+        subscription = await state.pubsub.subscribe(context.redis_key)
+    try:
+        await add_context_to_batch(state, context)
+    except BaseException:
+        subscription.close()
+        raise
+
+    return iter_pubsub_messages(subscription, context), subscription.close
+
+
 @router.post("/api/v1/infer")
 async def infer(request: Request, state: State, infer_request: APIInferRequest):
-    context = LLMContext(prefix=infer_request.prefix)
-    await state.batcher.add_context_to_batch(context)
+    context = LLMContext(
+        prefix=infer_request.prefix,
+        deadline=(
+            time.time() + settings.scaled(settings.infer_deadline)
+            if settings.infer_deadline
+            else None
+        ),
+    )
+    headers = {"X-Context-Id": str(context.id)}
+    if state.tracer is not None:
+        state.tracer.trace(context)
 
-    start_infer = time.monotonic()
+    if state.cache is not None:
+        chunks = await state.cache.get(context.prefix)
+        if chunks is not None:
+            # Cached response never takes a batch slot
+            return EventSourceResponse(
+                iter_cached_response(request, chunks), headers=headers
+            )
+
+    if state.flights is None:
+        messages, close = await start_inference(state, context)
+        # Generator might never start if the client is gone early
+        return EventSourceResponse(
+            iter_infer_response(
+                request,
+                context,
+                messages,
+                cache=state.cache,
+                on_cancel=get_cancel_callback(state, context),
+                tracer=state.tracer,
+            ),
+            headers=headers,
+            background=BackgroundTask(close) if close is not None else None,
+        )
+
+    flight, is_leader = await state.flights.join(context)
+    if is_leader:
+        try:
+            messages, close = await start_inference(state, context)
+            flight.start(messages, close, on_cancel=get_cancel_callback(state, context))
+        except BaseException:
+            flight.abort()
+            raise
+
+    return EventSourceResponse(
+        iter_infer_response(
+            request,
+            flight.context,
+            flight.listen(),
+            cache=state.cache if is_leader else None,
+            tracer=state.tracer if is_leader else None,
+        ),
+        headers={"X-Context-Id": str(flight.context.id)},
+    )
+
+
+@router.get("/api/v1/infer/{context_id}")
+async def resume_infer(
+    request: Request,
+    state: State,
+    context_id: UUID,
+    last_event_id: Annotated[Optional[int], Header(ge=0)] = None,
+):
+    """
+    Resumes the inference stream after the `Last-Event-ID` chunk.
+    Available only with `streams` transport.
+    """
+    if settings.transport != "streams":
+        raise HTTPException(status_code=404, detail="Resuming is not supported")
 
-    async def iter_infer_response():
-        first_message = True
-
-        async with state.redis.pubsub() as pubsub:
-            await pubsub.subscribe(context.redis_key)
-
-            while True:
-                # In case client drops the connection
-                if await request.is_disconnected():
-                    return
-
-                raw_message = await pubsub.get_message(timeout=settings.infer_job_ttl)
-                # Timeout case
-                if raw_message is None:
-                    logger.info("Timeout inference for %r", context)
-                    error_msg = InferMessage(
-                        status=InferMessageStatus.ERROR,
-                        text="",
-                        error="Timeout inference",
-                    )
-                    yield ServerSentEvent(data=error_msg.model_dump_json())
-                    infer_messages_count.labels(
-                        status=str(InferMessageStatus.ERROR)
-                    ).inc()
-                    return
-
-                if raw_message["type"] == "subscribe":
-                    continue
-
-                json_data = raw_message["data"]
-                infer_message = InferMessage.model_validate_json(json_data)
-
-                # Metrics
-                infer_messages_count.labels(status=str(infer_message.status)).inc()
-                if first_message:
-                    infer_first_response.observe(time.monotonic() - start_infer)
-                    first_message = False
-
-                yield ServerSentEvent(data=json_data.decode())
-                if infer_message.status in (
-                    InferMessageStatus.ERROR,
-                    InferMessageStatus.FINISHED,
-                ):
-                    return
-
-    return EventSourceResponse(iter_infer_response())
+    context = LLMContext(id=context_id)
+    return EventSourceResponse(
+        iter_infer_response(
+            request,
+            context,
+            iter_stream_messages(state.redis, context, last_seq=last_event_id or 0),
+        ),
+        headers={"X-Context-Id": str(context.id)},
+    )
@@ -1,13 +1,30 @@
+import argparse
 import csv
 import hashlib
+import mmap
+import os
 import random
+import struct
 import time
 from enum import Enum
-from functools import cache
+from functools import cache, lru_cache
 from pathlib import Path
-from typing import Iterable
+from typing import Callable, Iterable, Optional, Union
 
-from horoscoper.llm import LLM, LLMContext, LLMInferBatchResult, LLMInferResult
+try:
+    import numpy as np
+except ImportError:
+    # Batches are predicted in pure Python without NumPy
+    np = None
+
+from horoscoper.latency import LatencyModel, get_latency_model
+from horoscoper.llm import (
+    LLM,
+    KeepContexts,
+    LLMContext,
+    LLMInferBatchResult,
+    LLMInferResult,
+)
 from horoscoper.settings import settings
 from horoscoper.utils import produce_n_delays
 
@@ -27,15 +44,67 @@ class Sign(str, Enum):
     PISCES = "PISCES"
 
 
+SIGNS = list(Sign)
+
+
+def get_prefix_hash(prefix: str) -> int:
+    return int.from_bytes(hashlib.sha256(prefix.encode()).digest(), "big")
+
+
+def digests_mod(digests: "np.ndarray", moduli) -> "np.ndarray":
+    """
+    Remainders of the 256-bit digests (rows of big-endian 32-bit limbs)
+    divided by the moduli below 2**32. Computed limb by limb, so that
+    intermediate values never exceed 64 bits.
+    """
+    remainders = np.zeros(len(digests), dtype=np.uint64)
+    for limb in digests.T:
+        remainders = ((remainders << np.uint64(32)) | limb) % moduli
+    return remainders
+
+
+# Smaller batches are faster in pure Python, than NumPy call overhead
+VECTORIZED_MIN_BATCH_SIZE = 128
+
+
+def select_texts(prefixes: list[str], sign_texts: list[tuple[int, int]]) -> list[int]:
+    """
+    Chooses the text for every prefix the same way `predict_by_prefix` does.
+    `sign_texts` are the first text and the number of texts of every sign,
+    the result is the number of the text or -1, if the sign has no texts.
+    """
+    if np is None or len(prefixes) < VECTORIZED_MIN_BATCH_SIZE:
+        selected = []
+        for prefix in prefixes:
+            prefix_hash = get_prefix_hash(prefix)
+            first_text, text_count = sign_texts[prefix_hash % len(SIGNS)]
+            selected.append(first_text + prefix_hash % text_count if text_count else -1)
+        return selected
+
+    digests = b"".join(hashlib.sha256(prefix.encode()).digest() for prefix in prefixes)
+    limbs = np.frombuffer(digests, dtype=">u4").reshape(-1, 8).astype(np.uint64)
+    table = np.array(sign_texts, dtype=np.uint64)
+
+    signs = digests_mod(limbs, np.uint64(len(SIGNS)))
+    first_texts, text_counts = table[signs, 0], table[signs, 1]
+    texts = first_texts + digests_mod(limbs, np.maximum(text_counts, 1))
+    return np.where(text_counts > 0, texts.astype(np.int64), -1).tolist()
+
+
 class HoroscopeIndex:
     def __init__(self, horoscopes: dict[Sign, list[str]]):
         self._horoscopes = horoscopes
+        # Texts of all signs in a row, and the range of every sign there
+        self._texts = [text for sign in SIGNS for text in horoscopes[sign]]
+        self._sign_texts = []
+        for sign in SIGNS:
+            first_text = sum(count for _, count in self._sign_texts)
+            self._sign_texts.append((first_text, len(horoscopes[sign])))
 
     def predict_by_prefix(self, prefix: str) -> str:
-        prefix_hash = int(hashlib.sha256(prefix.encode()).hexdigest(), 16)
-        signs = list(Sign)
+        prefix_hash = get_prefix_hash(prefix)
 
-        chosen_sign = signs[prefix_hash % len(signs)]
+        chosen_sign = SIGNS[prefix_hash % len(SIGNS)]
         predictions = self._horoscopes[chosen_sign]
 
         if len(predictions) > 0:
@@ -43,6 +112,47 @@ class HoroscopeIndex:
         else:
             return ""
 
+    def predict_batch(self, prefixes: list[str]) -> list[str]:
+        """Same as `predict_by_prefix` for every prefix, but in one pass"""
+        return [
+            self._texts[text] if text >= 0 else ""
+            for text in select_texts(prefixes, self._sign_texts)
+        ]
+
+    def predict_words(self, prefix: str) -> list[str]:
+        """Chunks generated for the prefix"""
+        return self.predict_by_prefix(prefix).split(" ")
+
+    def predict_length(self, prefix: str) -> int:
+        """Number of chunks generated for the prefix"""
+        return len(self.predict_words(prefix))
+
+    def compile(self, index_path: Path):
+        """Writes the index in the `CompiledHoroscopeIndex` format"""
+        signs = CompiledHoroscopeIndex.SIGN
+        texts = CompiledHoroscopeIndex.TEXT
+        tables, blob = [], bytearray()
+
+        text_count = 0
+        for sign in SIGNS:
+            tables.append(signs.pack(text_count, len(self._horoscopes[sign])))
+            text_count += len(self._horoscopes[sign])
+        for sign in SIGNS:
+            for text in self._horoscopes[sign]:
+                encoded_text = text.encode()
+                word_count = len(text.split(" "))
+                tables.append(texts.pack(len(blob), len(encoded_text), word_count))
+                blob += encoded_text
+
+        header = CompiledHoroscopeIndex.HEADER.pack(
+            CompiledHoroscopeIndex.MAGIC, text_count
+        )
+        # Workers might be loading the previous version
+        tmp_path = index_path.with_name(index_path.name + ".tmp")
+        with open(tmp_path, "wb") as index_file:
+            index_file.write(b"".join((header, *tables, blob)))
+        os.replace(tmp_path, index_path)
+
     @staticmethod
     def load_from_csv(csv_path: Path) -> "HoroscopeIndex":
         horoscopes = {sign: [] for sign in Sign}
@@ -56,73 +166,296 @@ class HoroscopeIndex:
         return HoroscopeIndex(horoscopes=horoscopes)
 
 
+class CompiledHoroscopeIndex:
+    """
+    Read-only index compiled from the CSV by `HoroscopeIndex.compile`.
+    It's memory-mapped, so nothing is parsed on load, and all the worker
+    processes share its pages. Number of words of every text is counted
+    in advance, and the words are a single split of the text away.
+
+    Layout (little-endian unsigned 32-bit integers after the magic):
+        * header: magic and number of texts;
+        * signs: first text and number of texts of every sign in `Sign` order;
+        * texts: offset and length in the blob, and number of words;
+        * blob: UTF-8 encoded texts.
+    """
+
+    MAGIC = b"HRSCIDX1"
+    HEADER = struct.Struct("<8sI")
+    SIGN = struct.Struct("<II")
+    TEXT = struct.Struct("<III")
+
+    def __init__(self, buffer: Union[bytes, mmap.mmap]):
+        magic, text_count = self.HEADER.unpack_from(buffer)
+        if magic != self.MAGIC:
+            raise ValueError("Not a compiled horoscope index")
+
+        self._buffer = buffer
+        self._signs_offset = self.HEADER.size
+        self._texts_offset = self._signs_offset + self.SIGN.size * len(SIGNS)
+        self._blob_offset = self._texts_offset + self.TEXT.size * text_count
+        self._sign_texts = [
+            self.SIGN.unpack_from(buffer, self._signs_offset + self.SIGN.size * i)
+            for i in range(len(SIGNS))
+        ]
+
+    def _get_text(self, prefix: str) -> Optional[tuple[int, int, int]]:
+        """Offset, length and number of words of the text chosen for the prefix"""
+        prefix_hash = get_prefix_hash(prefix)
+        first_text, text_count = self.SIGN.unpack_from(
+            self._buffer,
+            self._signs_offset + self.SIGN.size * (prefix_hash % len(SIGNS)),
+        )
+        if text_count == 0:
+            return None
+
+        text = first_text + prefix_hash % text_count
+        return self.TEXT.unpack_from(
+            self._buffer, self._texts_offset + self.TEXT.size * text
+        )
+
+    def predict_by_prefix(self, prefix: str) -> str:
+        text = self._get_text(prefix)
+        if text is None:
+            return ""
+
+        offset, length, _ = text
+        start = self._blob_offset + offset
+        return self._buffer[start : start + length].decode()
+
+    def predict_batch(self, prefixes: list[str]) -> list[str]:
+        predictions = []
+        for text in select_texts(prefixes, self._sign_texts):
+            if text < 0:
+                predictions.append("")
+                continue
+
+            offset, length, _ = self.TEXT.unpack_from(
+                self._buffer, self._texts_offset + self.TEXT.size * text
+            )
+            start = self._blob_offset + offset
+            predictions.append(self._buffer[start : start + length].decode())
+        return predictions
+
+    def predict_words(self, prefix: str) -> list[str]:
+        return self.predict_by_prefix(prefix).split(" ")
+
+    def predict_length(self, prefix: str) -> int:
+        """Number of words is known without decoding the text"""
+        text = self._get_text(prefix)
+        return text[2] if text is not None else 1
+
+    @staticmethod
+    def load(index_path: Path) -> "CompiledHoroscopeIndex":
+        with open(index_path, "rb") as index_file:
+            # Mapping outlives the file descriptor
+            buffer = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ)
+        return CompiledHoroscopeIndex(buffer)
+
+
+AnyHoroscopeIndex = Union[HoroscopeIndex, CompiledHoroscopeIndex]
+
+
+@lru_cache(maxsize=4096)
+def render_chunks(words: tuple[str, ...]) -> tuple[LLMInferResult, ...]:
+    """
+    Chunks of the prediction rendered once and shared by all the contexts
+    with the same prediction, so generation allocates nothing per chunk.
+    """
+    last = len(words) - 1
+    return tuple(
+        LLMInferResult(f"{word} " if i < last else word, i == last)
+        for i, word in enumerate(words)
+    )
+
+
+def load_index(
+    horoscope_csv_file: Path, horoscope_index_file: Optional[Path] = None
+) -> AnyHoroscopeIndex:
+    """Compiled index is preferred to the CSV, if it's given"""
+    if horoscope_index_file is not None:
+        return CompiledHoroscopeIndex.load(horoscope_index_file)
+    return HoroscopeIndex.load_from_csv(horoscope_csv_file)
+
+
 class HoroscopeLLM(LLM):
     """
     Represents dummy LLM, that generates horoscope based on supplied context(s).
     Generation process is artificially slowed down to mimic real LLM behaviour.
     Overall spent time for inference will be in:
-        [MIN_RESPONSE_TIME_MS, MAX_RESPONSE_TIME_MS] interval.
+        [MIN_RESPONSE_TIME_MS, MAX_RESPONSE_TIME_MS] interval,
+    unless the `latency_model` is given, which charges the prefill
+    and every decode step depending on the batch.
     """
 
     MIN_RESPONSE_TIME_MS = 500
     MAX_RESPONSE_TIME_MS = 3000
 
-    def __init__(self, horoscope_csv_file: Path):
-        self._horoscope_index = HoroscopeIndex.load_from_csv(horoscope_csv_file)
+    def __init__(
+        self,
+        horoscope_csv_file: Path,
+        time_scale: float = 1.0,
+        latency_model: Optional[LatencyModel] = None,
+        horoscope_index_file: Optional[Path] = None,
+    ):
+        """Generation is `time_scale` times faster than the real time"""
+        self._horoscope_index = load_index(horoscope_csv_file, horoscope_index_file)
+        self._time_scale = time_scale
+        self._latency_model = latency_model
+
+    def _sleep(self, delay_ms: float):
+        time.sleep(delay_ms / 1000 / self._time_scale)
 
     def _infer(self, context: LLMContext) -> list[str]:
-        prediction = self._horoscope_index.predict_by_prefix(context.prefix)
-        words = prediction.split(" ")
-        return words
+        return self._horoscope_index.predict_words(context.prefix)
+
+    def _render(self, context: LLMContext) -> tuple[LLMInferResult, ...]:
+        return render_chunks(tuple(self._infer(context)))
 
     def infer(self, context: LLMContext) -> Iterable[LLMInferResult]:
         """Generate horoscope based on the supplied context"""
-        words = self._infer(context)
-
-        overall_time = random.randint(
-            self.MIN_RESPONSE_TIME_MS, self.MAX_RESPONSE_TIME_MS
-        )
-        delays = produce_n_delays(overall_time=overall_time, n=len(words))
-
-        for i, (word, delay) in enumerate(zip(words, delays)):
-            time.sleep(delay / 1000)
+        words = self._render(context)
 
-            is_last_chunk = i == len(words) - 1
-            text = f"{word} " if not is_last_chunk else word
-            yield LLMInferResult(
-                text=text,
-                is_last_chunk=is_last_chunk,
+        if self._latency_model is None:
+            overall_time = random.randint(
+                self.MIN_RESPONSE_TIME_MS, self.MAX_RESPONSE_TIME_MS
             )
+            delays = produce_n_delays(overall_time=overall_time, n=len(words))
+        else:
+            delays = [self._latency_model.decode_ms(1) for _ in words]
+            delays[0] += self._latency_model.prefill_ms([len(context.prefix)])
+
+        for chunk, delay in zip(words, delays):
+            self._sleep(delay)
+            yield chunk
 
-    def infer_batch(self, contexts: list[LLMContext]) -> Iterable[LLMInferBatchResult]:
-        """Generate horoscope for multiple contexts"""
+    def infer_batch(
+        self, contexts: list[LLMContext], keep: Optional[KeepContexts] = None
+    ) -> Iterable[LLMInferBatchResult]:
+        """
+        Generate horoscope for multiple contexts. Contexts not returned
+        by `keep` are dropped before the step, and the batch is over
+        once no context is left.
+        """
 
-        words_batch = [(context, self._infer(context)) for context in contexts]
+        words_batch = [(context, self._render(context)) for context in contexts]
 
         max_words = max(len(words) for _, words in words_batch)
-        overall_time = random.randint(
-            self.MIN_RESPONSE_TIME_MS, self.MAX_RESPONSE_TIME_MS
-        )
-        delays = produce_n_delays(overall_time=overall_time, n=max_words)
+        if self._latency_model is None:
+            overall_time = random.randint(
+                self.MIN_RESPONSE_TIME_MS, self.MAX_RESPONSE_TIME_MS
+            )
+            delays = produce_n_delays(overall_time=overall_time, n=max_words)
 
         for i in range(max_words):
-            time.sleep(delays[i] / 1000)
+            words_batch = [(ctx, words) for ctx, words in words_batch if i < len(words)]
+            if keep is not None and words_batch:
+                kept = {ctx.id for ctx in keep([ctx for ctx, _ in words_batch])}
+                words_batch = [
+                    (ctx, words) for ctx, words in words_batch if ctx.id in kept
+                ]
+            if not words_batch:
+                return
 
-            batch = []
-            for context, words in words_batch:
-                if i < len(words):
-                    is_last_chunk = i == len(words) - 1
-                    text = f"{words[i]} " if not is_last_chunk else words[i]
-
-                    result = LLMInferResult(
-                        is_last_chunk=is_last_chunk,
-                        text=text,
+            if self._latency_model is None:
+                self._sleep(delays[i])
+            else:
+                delay = self._latency_model.decode_ms(len(words_batch))
+                if i == 0:
+                    delay += self._latency_model.prefill_ms(
+                        [len(ctx.prefix) for ctx, _ in words_batch]
                     )
-                    batch.append((context, result))
+                self._sleep(delay)
+
+            # All the contexts left have the chunk `i`
+            yield [(context, words[i]) for context, words in words_batch]
+
+    def infer_continuous(
+        self,
+        admit: Callable[[int], list[LLMContext]],
+        max_batch_size: int,
+        keep: Optional[KeepContexts] = None,
+    ) -> Iterable[LLMInferBatchResult]:
+        """
+        Generate horoscopes using continuous (iteration-level) batching.
+
+        Before every step `admit` is called with the number of free slots
+        and may return new contexts, which join the running batch at once.
+        Contexts that produced their last chunk release their slots right
+        after the step. Every context keeps its own delays, and the step
+        lasts as long as the slowest active row.
+        Generation is over when the batch is empty and nothing was admitted.
+        Contexts not returned by `keep` are dropped before every step.
+        """
+        # Each row is [context, rendered chunks, delays, position]
+        rows = []
+
+        while True:
+            # Prefill of the admitted contexts stalls the step
+            prefix_lengths = []
+            free_slots = max_batch_size - len(rows)
+            if free_slots > 0:
+                for context in admit(free_slots):
+                    words = self._render(context)
+                    delays = None
+                    if self._latency_model is None:
+                        overall_time = random.randint(
+                            self.MIN_RESPONSE_TIME_MS, self.MAX_RESPONSE_TIME_MS
+                        )
+                        delays = produce_n_delays(
+                            overall_time=overall_time, n=len(words)
+                        )
+                    prefix_lengths.append(len(context.prefix))
+                    rows.append([context, words, delays, 0])
+
+            if keep is not None and rows:
+                kept = {context.id for context in keep([row[0] for row in rows])}
+                rows = [row for row in rows if row[0].id in kept]
 
+            if not rows:
+                return
+
+            if self._latency_model is None:
+                self._sleep(max(delays[i] for _, _, delays, i in rows))
+            else:
+                self._sleep(
+                    self._latency_model.prefill_ms(prefix_lengths)
+                    + self._latency_model.decode_ms(len(rows))
+                )
+
+            batch = []
+            for row in rows:
+                context, words, _, i = row
+                batch.append((context, words[i]))
+                row[3] += 1
+
+            rows = [row for row in rows if row[3] < len(row[1])]
             yield batch
 
 
+@cache
+def get_index() -> AnyHoroscopeIndex:
+    return load_index(settings.horoscope_csv_file, settings.horoscope_index_file)
+
+
 @cache
 def get_model() -> HoroscopeLLM:
-    return HoroscopeLLM(horoscope_csv_file=settings.horoscope_csv_file)
+    return HoroscopeLLM(
+        horoscope_csv_file=settings.horoscope_csv_file,
+        time_scale=settings.time_scale,
+        latency_model=get_latency_model(),
+        horoscope_index_file=settings.horoscope_index_file,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compiles the horoscope index")
+    parser.add_argument("--csv", type=Path, default=settings.horoscope_csv_file)
+    parser.add_argument(
+        "--output",
+        type=Path,
+        default=settings.horoscope_index_file
+        or settings.horoscope_csv_file.with_suffix(".idx"),
+    )
+    args = parser.parse_args()
+    HoroscopeIndex.load_from_csv(args.csv).compile(args.output)
@@ -0,0 +1,108 @@
+import os
+import random
+import weakref
+from abc import ABC, abstractmethod
+from typing import Optional
+
+from horoscoper.settings import settings
+
+
+class LatencyModel(ABC):
+    """
+    Cost of the simulated LLM operations in milliseconds. Unlike
+    the random response time, it depends on the amount of work done,
+    so batching experiments carry over to real models.
+    """
+
+    @abstractmethod
+    def prefill_ms(self, prefix_lengths: list[int]) -> float:
+        """Processing of the prefixes of the contexts joining the batch"""
+
+    @abstractmethod
+    def decode_ms(self, rows: int) -> float:
+        """One decode step of the batch with `rows` active contexts"""
+
+
+class LinearLatencyModel(LatencyModel):
+    """
+    Prefill is linear in the total length of the prefixes (so it grows
+    with the batch size), decode step is linear in the number of rows:
+    a bigger batch makes every step slower, but far less than proportionally.
+
+    Every cost is perturbed by up to `jitter` (relative) using its own
+    random generator, so the same `seed` reproduces the same latencies.
+    Forked processes (RQ work horses) would replay the same sequence,
+    so the generator is reseeded in the child: with the seed and
+    the number of the fork, or randomly without the seed.
+    """
+
+    def __init__(
+        self,
+        prefill_base_ms: float,
+        prefill_per_char_ms: float,
+        decode_base_ms: float,
+        decode_per_row_ms: float,
+        jitter: float = 0.0,
+        seed: Optional[int] = None,
+    ):
+        self._prefill_base_ms = prefill_base_ms
+        self._prefill_per_char_ms = prefill_per_char_ms
+        self._decode_base_ms = decode_base_ms
+        self._decode_per_row_ms = decode_per_row_ms
+        self._jitter = jitter
+        self._seed = seed
+        self._random = random.Random(seed)
+        self._forks = 0
+        _jittered_models.add(self)
+
+    def _reseed_after_fork(self):
+        if self._seed is None:
+            self._random.seed()
+        else:
+            self._random.seed(f"{self._seed}:{self._forks}")
+
+    def _perturb(self, cost_ms: float) -> float:
+        if not self._jitter:
+            return cost_ms
+        return cost_ms * (1 + self._random.uniform(-self._jitter, self._jitter))
+
+    def prefill_ms(self, prefix_lengths: list[int]) -> float:
+        if not prefix_lengths:
+            return 0.0
+        return self._perturb(
+            self._prefill_base_ms + self._prefill_per_char_ms * sum(prefix_lengths)
+        )
+
+    def decode_ms(self, rows: int) -> float:
+        return self._perturb(self._decode_base_ms + self._decode_per_row_ms * rows)
+
+
+_jittered_models: "weakref.WeakSet[LinearLatencyModel]" = weakref.WeakSet()
+
+
+def _count_fork():
+    for model in _jittered_models:
+        model._forks += 1
+
+
+def _reseed_after_fork():
+    for model in _jittered_models:
+        model._reseed_after_fork()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(before=_count_fork, after_in_child=_reseed_after_fork)
+
+
+def get_latency_model() -> Optional[LatencyModel]:
+    """`None` stands for the random response time spread over the chunks"""
+    if settings.latency_model == "linear":
+        return LinearLatencyModel(
+            prefill_base_ms=settings.latency_prefill_base_ms,
+            prefill_per_char_ms=settings.latency_prefill_per_char_ms,
+            decode_base_ms=settings.latency_decode_base_ms,
+            decode_per_row_ms=settings.latency_decode_per_row_ms,
+            jitter=settings.latency_jitter,
+            seed=settings.latency_seed,
+        )
+    return None
@@ -1,30 +1,104 @@
+import time
 from abc import ABC, abstractmethod
-from dataclasses import dataclass, field
-from typing import Iterable
+from dataclasses import MISSING, dataclass, field, fields
+from typing import Callable, Iterable, NamedTuple, Optional
 from uuid import UUID, uuid4
 
 
+def with_slots(cls: type) -> type:
+    """
+    Recreates the dataclass with `__slots__` of its fields, like
+    `dataclass(slots=True)` does on Python 3.10+: instances have no `__dict__`.
+    """
+    namespace = dict(cls.__dict__)
+    field_names = tuple(f.name for f in fields(cls))
+    for name in field_names:
+        # Defaults live in `__init__`, and would conflict with the slots
+        namespace.pop(name, None)
+    namespace.pop("__dict__", None)
+    namespace.pop("__weakref__", None)
+    namespace["__slots__"] = field_names
+    return type(cls)(cls.__name__, cls.__bases__, namespace)
+
+
+@with_slots
 @dataclass
 class LLMContext:
     id: UUID = field(default_factory=uuid4)
     prefix: str = ""
+    # Set by the API batcher, when results are published per batch
+    batch_id: Optional[UUID] = None
+    # UNIX time, after which nobody waits for the result
+    deadline: Optional[float] = None
+    # Stage -> UNIX time it was reached, `None` if the context isn't traced
+    timings: Optional[dict[str, float]] = None
+
+    def __setstate__(self, state):
+        """
+        Accepts the `__dict__` of the contexts pickled before they were slotted
+        (missing fields get their defaults), so the queues needn't be drained
+        during a rolling deploy of mixed-version API and workers.
+        """
+        if isinstance(state, tuple):
+            dict_state, slots_state = state
+            state = {**(dict_state or {}), **(slots_state or {})}
+
+        for f in fields(self):
+            if f.name in state:
+                value = state[f.name]
+            elif f.default_factory is not MISSING:
+                value = f.default_factory()
+            else:
+                value = f.default
+            object.__setattr__(self, f.name, value)
+
+    def mark(self, stage: str, now: Optional[float] = None):
+        """Records the time the traced context reached the pipeline `stage`"""
+        if self.timings is not None:
+            self.timings[stage] = now if now is not None else time.time()
+
+    def is_expired(self, now: Optional[float] = None) -> bool:
+        if self.deadline is None:
+            return False
+        return (now if now is not None else time.time()) >= self.deadline
+
+    def time_left(self, timeout: float) -> float:
+        """Returns `timeout` capped by the time left till the deadline"""
+        if self.deadline is None:
+            return timeout
+        return max(min(timeout, self.deadline - time.time()), 0.0)
 
     @property
     def redis_key(self) -> bytes:
         return self.id.bytes
 
+    @property
+    def cancel_key(self) -> bytes:
+        return b"cancel:" + self.id.bytes
+
+    @property
+    def batch_key(self) -> bytes:
+        return b"batch:" + self.batch_id.bytes
+
+    @property
+    def stream_key(self) -> bytes:
+        return b"stream:" + self.id.bytes
+
     def __repr__(self) -> str:
         return f"LLMContext({self.id}, prefix: {self.prefix})"
 
 
-@dataclass
-class LLMInferResult:
+class LLMInferResult(NamedTuple):
+    """Immutable, so rendered chunks are shared between the contexts"""
+
     text: str
     is_last_chunk: bool = False
 
 
 # This type represents `inference slice` produced from multiple contexts
 LLMInferBatchResult = list[tuple[LLMContext, LLMInferResult]]
+# Called with the running contexts before every step, returns ones to keep
+KeepContexts = Callable[[list[LLMContext]], list[LLMContext]]
 
 
 class LLM(ABC):
@@ -33,5 +107,19 @@ class LLM(ABC):
         """Produce some text based on one context"""
 
     @abstractmethod
-    def infer_batch(self, contexts: list[LLMContext]) -> Iterable[LLMInferBatchResult]:
+    def infer_batch(
+        self, contexts: list[LLMContext], keep: Optional[KeepContexts] = None
+    ) -> Iterable[LLMInferBatchResult]:
         """Produce mixed output from multiple contexts at once"""
+
+    @abstractmethod
+    def infer_continuous(
+        self,
+        admit: Callable[[int], list[LLMContext]],
+        max_batch_size: int,
+        keep: Optional[KeepContexts] = None,
+    ) -> Iterable[LLMInferBatchResult]:
+        """
+        Produce mixed output from the running batch of contexts, where
+        new contexts are admitted and finished ones retired on every step
+        """
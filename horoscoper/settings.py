@@ -1,4 +1,5 @@
 from pathlib import Path
+from typing import Optional
 
 from pydantic_settings import BaseSettings
 
@@ -38,10 +39,87 @@ def setup_logging():
 class Settings(BaseSettings):
     batcher_batch_size: int = 4
     batcher_window_ms: int = 250
+    # Adaptive batching adjusts window and batch size within the bounds below
+    batcher_adaptive: bool = False
+    batcher_min_batch_size: int = 1
+    batcher_max_batch_size: int = 8
+    batcher_min_window_ms: int = 5
+    batcher_max_window_ms: int = 250
+    # Non-zero capacity enables admission control (429 on overload)
+    batcher_queue_capacity: int = 0
+    # Length-aware batcher groups contexts with similar output length,
+    # choosing from up to `batcher_lookahead` batches of candidates
+    batcher_length_aware: bool = False
+    batcher_lookahead: int = 4
+    # Shared batcher forms batches out of contexts of all API processes
+    batcher_shared: bool = False
     infer_job_ttl: int = 7
+    # Overall time the API waits for the whole response (0 - no deadline),
+    # contexts are skipped or pruned by the batcher and workers afterwards
+    infer_deadline: int = 30
+    # "static" runs every RQ job (batch) to completion,
+    # "continuous" admits contexts into the running batch on every step,
+    # "pull" skips API batcher: workers pull batches from the context list
+    worker_mode: str = "static"
+    worker_max_batch_size: int = 8
+    worker_idle_timeout: int = 5
+    # `rq.Worker` forks a work horse per job, `rq.SimpleWorker` doesn't
+    worker_fork: bool = True
+    # Non-zero interval coalesces chunks of every context, so they are
+    # published at most once per interval or every `max_chars`. Chunks are
+    # published between decode steps, so they may wait one step longer
+    worker_flush_interval_ms: int = 0
+    worker_flush_max_chars: int = 64
+    # Number of worker processes (concurrent batches) per container
+    worker_concurrency: int = 1
+    # "pubsub" is fire-and-forget, "streams" keeps chunks
+    # in a capped per-context stream, so SSE can be resumed,
+    # "batch" publishes chunks of the whole batch in one Pub/Sub message
+    transport: str = "pubsub"
+    stream_maxlen: int = 1024
+    stream_ttl: int = 60
+    # Format of the messages published by workers: "json" or compact "binary"
+    # frames. API accepts both, so workers can be switched one by one
+    message_format: str = "json"
+    # Finished responses are cached by prefix and streamed
+    # with `cache_pacing_ms` between the chunks
+    cache_enabled: bool = False
+    cache_ttl: int = 3600
+    cache_max_entries: int = 10000
+    cache_pacing_ms: int = 0
+    # Contexts of disconnected clients are dropped by the batcher,
+    # or by workers between steps (cancel keys live for `cancel_ttl`)
+    cancellation_enabled: bool = True
+    cancel_ttl: int = 60
+    # Requests with the prefix that is already in flight join its response
+    singleflight_enabled: bool = False
+    # Contexts carry timestamps of the pipeline stages, that are observed
+    # as `api_infer_stage_latency` and appended to `trace_file` (JSON lines)
+    tracing_enabled: bool = True
+    trace_file: Optional[Path] = None
+    # "random" spreads 0.5-3s over the response regardless of the batch,
+    # "linear" charges prefill by the prefix length and every decode step
+    # by the number of batch rows (`latency_seed` makes jitter reproducible)
+    latency_model: str = "random"
+    latency_prefill_base_ms: float = 30
+    latency_prefill_per_char_ms: float = 0.5
+    latency_decode_base_ms: float = 40
+    latency_decode_per_row_ms: float = 6
+    latency_jitter: float = 0.1
+    latency_seed: Optional[int] = None
+    # Speeds up the model and the timings around it (batching windows,
+    # timeouts and deadlines) by the same factor, keeping their proportions
+    time_scale: float = 1.0
     horoscope_csv_file: Path = ROOT / "etc" / "data" / "horoscopes.csv"
+    # Index compiled from the CSV (`python -m horoscoper.horoscope`),
+    # memory-mapped and shared by the worker processes
+    horoscope_index_file: Optional[Path] = None
     redis_url: str = "redis://localhost:6379/0"
     log_level: str = "INFO"
 
+    def scaled(self, duration: float) -> float:
+        """Wall-clock duration of the model time `duration` (in any units)"""
+        return duration / self.time_scale
+
 
 settings = Settings()
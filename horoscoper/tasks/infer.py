@@ -1,17 +1,32 @@
+import contextlib
+import json
 import logging
+import math
+import multiprocessing
+import multiprocessing.connection
 import os
+import pickle
+import signal
+import struct
+import time
+from collections import deque
 from enum import Enum
 from functools import cache
-from typing import Optional
+from typing import Iterator, Optional
+from uuid import UUID
 
+import redis.asyncio
 import rq
 from pydantic import BaseModel
 from redis import Redis
 from redis.utils import pipeline
+from rq.exceptions import NoSuchJobError
+from rq.job import Job
+from rq.utils import utcnow
 
-from horoscoper.horoscope import LLMContext, get_model
+from horoscoper.horoscope import get_model
+from horoscoper.llm import LLMContext, LLMInferBatchResult, LLMInferResult
 from horoscoper.settings import settings, setup_logging
-from horoscoper.utils import sync_to_async
 
 logger = logging.getLogger(__name__)
 
@@ -30,6 +45,90 @@ class InferMessage(BaseModel, extra="allow"):
     text: str
     status: InferMessageStatus
     error: Optional[str] = None
+    # Number of the chunk within the context, starting from 1
+    seq: Optional[int] = None
+
+
+# Binary frame: status byte, sequence number and UTF-8 text
+FRAME_HEADER = struct.Struct(">BI")
+FRAME_STATUSES = list(InferMessageStatus)
+FRAME_STATUS_CODES = {status: code for code, status in enumerate(FRAME_STATUSES)}
+# Status byte flag of the frames, that carry JSON stage timings
+# (prefixed by their length) between the header and the text
+FRAME_TIMINGS_FLAG = 0x80
+FRAME_TIMINGS_LENGTH = struct.Struct(">H")
+# Same layout as `InferMessage.model_dump_json()`
+FRAME_JSON_TEMPLATES = [
+    '{"text":%%s,"status":"%s","error":null,"seq":%%d}' % status.value
+    for status in FRAME_STATUSES
+]
+# JSON messages are recognized by the first byte, which is never a status code
+JSON_PREFIX = b"{"
+
+
+def encode_message(
+    text: str,
+    status: InferMessageStatus,
+    seq: int,
+    message_format: str,
+    timings: Optional[dict[str, float]] = None,
+) -> bytes:
+    """`timings` of the traced context are attached to its first message"""
+    if message_format == "binary":
+        code = FRAME_STATUS_CODES[status]
+        if timings is None:
+            return FRAME_HEADER.pack(code, seq) + text.encode()
+
+        encoded_timings = json.dumps(timings).encode()
+        return b"".join(
+            (
+                FRAME_HEADER.pack(code | FRAME_TIMINGS_FLAG, seq),
+                FRAME_TIMINGS_LENGTH.pack(len(encoded_timings)),
+                encoded_timings,
+                text.encode(),
+            )
+        )
+
+    # Timings are an extra field, so other messages keep their layout
+    extra = {"timings": timings} if timings is not None else {}
+    message = InferMessage(text=text, status=status, seq=seq, **extra)
+    return message.model_dump_json().encode()
+
+
+def message_status(raw_message: bytes) -> InferMessageStatus:
+    if raw_message[:1] == JSON_PREFIX:
+        return InferMessage.model_validate_json(raw_message).status
+    return FRAME_STATUSES[raw_message[0] & ~FRAME_TIMINGS_FLAG]
+
+
+def render_message(
+    raw_message: bytes,
+) -> tuple[InferMessageStatus, str, Optional[dict[str, float]]]:
+    """
+    Returns status, JSON representation of the `InferMessage` received
+    from a worker in any format and the stage timings, if attached.
+    Binary frames are rendered without pydantic, as they are forwarded
+    to the client as is. Timings are never forwarded to the client.
+    """
+    if raw_message[:1] == JSON_PREFIX:
+        infer_message = InferMessage.model_validate_json(raw_message)
+        timings = infer_message.model_extra.pop("timings", None)
+        if timings is None:
+            return infer_message.status, raw_message.decode(), None
+        return infer_message.status, infer_message.model_dump_json(), timings
+
+    code, seq = FRAME_HEADER.unpack_from(raw_message)
+    offset = FRAME_HEADER.size
+    timings = None
+    if code & FRAME_TIMINGS_FLAG:
+        code &= ~FRAME_TIMINGS_FLAG
+        (length,) = FRAME_TIMINGS_LENGTH.unpack_from(raw_message, offset)
+        offset += FRAME_TIMINGS_LENGTH.size
+        timings = json.loads(raw_message[offset : offset + length])
+        offset += length
+
+    text = json.dumps(raw_message[offset:].decode(), ensure_ascii=False)
+    return FRAME_STATUSES[code], FRAME_JSON_TEMPLATES[code] % (text, seq), timings
 
 
 @cache
@@ -55,39 +154,615 @@ def enqueue(contexts: list[LLMContext], **kwargs):
     return get_queue().enqueue(process, contexts, **kwargs)
 
 
-enqueue_async = sync_to_async(enqueue)
+async def enqueue_many_async(
+    redis_client: redis.asyncio.Redis, batches: list[list[LLMContext]], **kwargs
+) -> list[Job]:
+    """
+    Enqueues multiple batches in one round trip using `redis_client`
+    of the API, so the event loop isn't blocked.
+    It mirrors what `rq.Queue.enqueue` writes to Redis (job hash,
+    TTL and queue push), so jobs are processed by regular RQ workers.
+    """
+    logger.info("Enqueue batches of contexts: %r", batches)
+    queue = get_queue()
+    jobs = []
+
+    async with redis_client.pipeline(transaction=True) as pipe:
+        pipe.sadd(rq.Queue.redis_queues_keys, queue.key)
+        for contexts in batches:
+            # Job creation doesn't touch Redis, only serializes the call
+            job = queue.create_job(process, args=(contexts,), **kwargs)
+            job.enqueued_at = utcnow()
+
+            pipe.hset(job.key, mapping=job.to_dict())
+            if job.ttl:
+                pipe.expire(job.key, job.ttl)
+            pipe.rpush(queue.key, job.id)
+            jobs.append(job)
+
+        await pipe.execute()
+
+    return jobs
+
+
+async def enqueue_async(
+    redis_client: redis.asyncio.Redis, contexts: list[LLMContext], **kwargs
+) -> Job:
+    [job] = await enqueue_many_async(redis_client, [contexts], **kwargs)
+    return job
+
+
+async def get_queue_depth_async(redis_client: redis.asyncio.Redis) -> int:
+    return await redis_client.llen(get_queue().key)
+
+
+# Batch message is a sequence of entries: context channel,
+# length of the message and the message itself
+BATCH_ENTRY_HEADER = struct.Struct(">16sI")
+
+
+def encode_batch_message(entries: list[tuple[bytes, bytes]]) -> bytes:
+    return b"".join(
+        BATCH_ENTRY_HEADER.pack(channel, len(message)) + message
+        for channel, message in entries
+    )
+
+
+def decode_batch_message(batch_message: bytes) -> Iterator[tuple[bytes, bytes]]:
+    offset = 0
+    while offset < len(batch_message):
+        channel, length = BATCH_ENTRY_HEADER.unpack_from(batch_message, offset)
+        offset += BATCH_ENTRY_HEADER.size
+        yield channel, batch_message[offset : offset + length]
+        offset += length
+
+
+def stream_id(seq: int) -> str:
+    """Stream entry ID of the chunk with the sequence number `seq`"""
+    return f"0-{seq}"
+
+
+class ChunkCoalescer:
+    """
+    Buffers chunks of every context and releases them as one chunk
+    once `flush_interval_ms` passed since the previous release
+    or `max_chars` are buffered. The first chunk (nothing to wait for)
+    and the last one (nothing to wait for anymore) are released at once.
+
+    Workers are synchronous, so chunks are released between decode steps:
+    buffered text may wait up to one step longer than the interval.
+    Contexts without a chunk in the step are released as well, once due.
+    """
+
+    def __init__(self, flush_interval_ms: float, max_chars: int):
+        self._flush_interval = flush_interval_ms / 1000
+        self._max_chars = max_chars
+        # Context ID -> context with the buffered texts,
+        # and the time of the previous release
+        self._buffers: dict[UUID, tuple[LLMContext, list[str]]] = {}
+        self._flushed_at: dict[UUID, float] = {}
+
+    def _is_due(self, context: LLMContext, now: float) -> bool:
+        flushed_at = self._flushed_at.get(context.id, -math.inf)
+        return now - flushed_at >= self._flush_interval
+
+    def coalesce(self, batch: LLMInferBatchResult) -> LLMInferBatchResult:
+        now = time.monotonic()
+        coalesced = []
+
+        for context, infer_result in batch:
+            _, buffer = self._buffers.setdefault(context.id, (context, []))
+            buffer.append(infer_result.text)
+
+            if infer_result.is_last_chunk:
+                self._flushed_at.pop(context.id, None)
+            elif (
+                not self._is_due(context, now)
+                and sum(map(len, buffer)) < self._max_chars
+            ):
+                continue
+            else:
+                self._flushed_at[context.id] = now
+
+            del self._buffers[context.id]
+            coalesced.append(
+                (context, LLMInferResult("".join(buffer), infer_result.is_last_chunk))
+            )
+
+        # Everything left is buffered before this step
+        stepped = {context.id for context, _ in batch}
+        for context_id, (context, buffer) in list(self._buffers.items()):
+            if context_id not in stepped and self._is_due(context, now):
+                self._flushed_at[context_id] = now
+                del self._buffers[context_id]
+                coalesced.append((context, LLMInferResult("".join(buffer))))
+
+        return coalesced
+
+    def forget(self, context: LLMContext):
+        self._buffers.pop(context.id, None)
+        self._flushed_at.pop(context.id, None)
+
+
+class InferPublisher:
+    """
+    Streams inference results back to the API using configured transport.
+    Keeps track of the sequence numbers of the chunks for every context.
+    """
+
+    def __init__(
+        self,
+        redis_client: Redis,
+        transport: str,
+        message_format: str = "json",
+        coalescer: Optional[ChunkCoalescer] = None,
+    ):
+        self._redis_client = redis_client
+        self._transport = transport
+        self._message_format = message_format
+        self._coalescer = coalescer
+        self._seqs: dict[UUID, int] = {}
+
+    def forget(self, context: LLMContext) -> int:
+        """
+        Releases state of the context, that won't be finished.
+        Returns the number of chunks published so far.
+        """
+        if self._coalescer is not None:
+            self._coalescer.forget(context)
+        return self._seqs.pop(context.id, 0)
+
+    def publish(self, batch: LLMInferBatchResult):
+        if self._coalescer is not None:
+            batch = self._coalescer.coalesce(batch)
+            if not batch:
+                return
+
+        now = time.time()
+        # Batch channel -> entries of the batch message
+        batch_messages: dict[bytes, list[tuple[bytes, bytes]]] = {}
+
+        with pipeline(self._redis_client) as pipe:
+            for context, infer_result in batch:
+                seq = self._seqs.get(context.id, 0) + 1
+                if infer_result.is_last_chunk:
+                    self._seqs.pop(context.id, None)
+                    status = InferMessageStatus.FINISHED
+                else:
+                    self._seqs[context.id] = seq
+                    status = InferMessageStatus.IN_PROGRESS
+
+                timings = None
+                if seq == 1 and context.timings is not None:
+                    context.mark("first_step", now)
+                    timings = context.timings
+
+                message = encode_message(
+                    infer_result.text, status, seq, self._message_format, timings
+                )
+
+                if self._transport == "streams":
+                    pipe.xadd(
+                        context.stream_key,
+                        {"data": message},
+                        id=stream_id(seq),
+                        maxlen=settings.stream_maxlen,
+                        approximate=False,
+                    )
+                    pipe.expire(context.stream_key, settings.stream_ttl)
+                elif self._transport == "batch" and context.batch_id is not None:
+                    batch_messages.setdefault(context.batch_key, []).append(
+                        (context.redis_key, message)
+                    )
+                else:
+                    pipe.publish(channel=context.redis_key, message=message)
+
+            for channel, entries in batch_messages.items():
+                pipe.publish(channel=channel, message=encode_batch_message(entries))
+
+
+class ContextPruner:
+    """
+    Drops contexts between decode steps, so they don't occupy batch rows:
+        * expired ones, whose deadline has passed (the client gave up);
+        * cancelled by the API (the client is gone), if `check_cancelled`.
+
+    Pruned contexts are counted in the `PRUNED_STATS_KEY` hash, by the reason
+    and whether they were pruned before the first chunk or mid-generation.
+    """
+
+    PRUNED_STATS_KEY = "stats:pruned_contexts"
+
+    def __init__(
+        self, redis_client: Redis, publisher: InferPublisher, check_cancelled: bool
+    ):
+        self._redis_client = redis_client
+        self._publisher = publisher
+        self._check_cancelled = check_cancelled
+
+    def __call__(self, contexts: list[LLMContext]) -> list[LLMContext]:
+        now = time.time()
+        pruned: list[tuple[LLMContext, str]] = []
+        kept = []
+        for context in contexts:
+            if context.is_expired(now):
+                pruned.append((context, "expired"))
+            else:
+                kept.append(context)
+
+        if self._check_cancelled and kept:
+            cancelled = self._redis_client.mget(
+                [context.cancel_key for context in kept]
+            )
+            pruned.extend(
+                (context, "cancelled")
+                for context, is_cancelled in zip(kept, cancelled)
+                if is_cancelled is not None
+            )
+            kept = [
+                context
+                for context, is_cancelled in zip(kept, cancelled)
+                if is_cancelled is None
+            ]
+
+        if pruned:
+            with pipeline(self._redis_client) as pipe:
+                for context, reason in pruned:
+                    published = self._publisher.forget(context)
+                    stage = "running" if published else "queued"
+                    logger.info("Pruning %s context %r (%s)", reason, context, stage)
+                    pipe.hincrby(self.PRUNED_STATS_KEY, f"{reason}:{stage}", 1)
+        return kept
+
+
+def get_publisher() -> InferPublisher:
+    coalescer = None
+    if settings.worker_flush_interval_ms > 0:
+        coalescer = ChunkCoalescer(
+            flush_interval_ms=settings.scaled(settings.worker_flush_interval_ms),
+            max_chars=settings.worker_flush_max_chars,
+        )
+
+    return InferPublisher(
+        get_redis(),
+        transport=settings.transport,
+        message_format=settings.message_format,
+        coalescer=coalescer,
+    )
 
 
 def process(contexts: list[LLMContext]):
     logger.info("Starting to process batch of contexts (%r)", contexts)
 
     horoscope_model = get_model()
-    redis_client = get_redis()
+    publisher = get_publisher()
 
-    for batch in horoscope_model.infer_batch(contexts=contexts):
-        with pipeline(redis_client) as pipe:
-            for context, infer_result in batch:
-                status = (
-                    InferMessageStatus.IN_PROGRESS
-                    if not infer_result.is_last_chunk
-                    else InferMessageStatus.FINISHED
-                )
+    now = time.time()
+    for context in contexts:
+        context.mark("picked", now)
 
-                pipe.publish(
-                    channel=context.redis_key,
-                    message=InferMessage(
-                        text=infer_result.text, status=status
-                    ).model_dump_json(),
-                )
+    keep = ContextPruner(
+        get_redis(), publisher, check_cancelled=settings.cancellation_enabled
+    )
+
+    for batch in horoscope_model.infer_batch(contexts=contexts, keep=keep):
+        publisher.publish(batch)
 
     logger.info("Finished processing batch of contexts (%r)", contexts)
 
 
+# Redis list, that API pushes contexts to in the "pull" worker mode
+CONTEXT_QUEUE_KEY = "infer:contexts"
+
+
+async def push_context_async(redis_client: redis.asyncio.Redis, context: LLMContext):
+    await redis_client.rpush(CONTEXT_QUEUE_KEY, pickle.dumps(context))
+
+
+SHUTDOWN_SIGNALS = (signal.SIGTERM, signal.SIGINT)
+
+
+class StoppableWorker:
+    """
+    Like `rq.Worker`, the first SIGTERM or SIGINT requests a warm shutdown:
+    no more contexts are taken, but the running batch is finished.
+    The second one exits at once (cold shutdown).
+    """
+
+    def __init__(self):
+        self._is_stopping = False
+
+    def request_stop(self):
+        logger.info("Warm shutdown requested, finishing the running batch")
+        self._is_stopping = True
+
+    def _handle_signal(self, signum, frame):
+        if self._is_stopping:
+            logger.warning("Cold shutdown, the running batch is dropped")
+            raise SystemExit(128 + signum)
+        self.request_stop()
+
+    @contextlib.contextmanager
+    def _handle_signals(self):
+        previous_handlers = {
+            signum: signal.signal(signum, self._handle_signal)
+            for signum in SHUTDOWN_SIGNALS
+        }
+        try:
+            yield
+        finally:
+            for signum, handler in previous_handlers.items():
+                signal.signal(signum, handler)
+
+
+class PullWorker(StoppableWorker):
+    """
+    Worker, that forms batches by itself: it pulls up to `batch_size`
+    contexts straight from the Redis list, once it's free.
+
+    An idle worker starts right away with whatever is there, instead of
+    waiting for the API batching window, while under the load
+    the list is long enough for the full batches.
+    """
+
+    def __init__(self, redis_client: Redis, batch_size: int, idle_timeout: int):
+        super().__init__()
+        self._redis_client = redis_client
+        self._batch_size = batch_size
+        self._idle_timeout = idle_timeout
+
+    def pull_contexts(self, block: bool = True) -> list[LLMContext]:
+        if block:
+            response = self._redis_client.blpop(CONTEXT_QUEUE_KEY, self._idle_timeout)
+            items = [response[1]] if response is not None else []
+        else:
+            item = self._redis_client.lpop(CONTEXT_QUEUE_KEY)
+            items = [item] if item is not None else []
+
+        if items and self._batch_size > 1:
+            # Everything else that is already there joins the batch
+            items.extend(
+                self._redis_client.lpop(CONTEXT_QUEUE_KEY, self._batch_size - 1) or []
+            )
+        if items and self._is_stopping:
+            # Stop is requested during the blocking pop, so they are handed over
+            self._redis_client.lpush(CONTEXT_QUEUE_KEY, *reversed(items))
+            return []
+        return [pickle.loads(item) for item in items]
+
+    def work(self, burst: bool = False):
+        """
+        Process batches until interrupted. In `burst` mode
+        the worker exits as soon as the list is drained.
+        """
+        with self._handle_signals():
+            while not self._is_stopping:
+                contexts = self.pull_contexts(block=not burst)
+                if contexts:
+                    process(contexts)
+                elif burst:
+                    return
+
+
+class ContinuousWorker(StoppableWorker):
+    """
+    Worker with continuous (iteration-level) batching.
+
+    Unlike `rq.Worker` it doesn't run jobs one by one: jobs enqueued
+    by the API are popped straight from the RQ queue and their contexts
+    are admitted into the running batch between decode steps,
+    whenever there are free slots.
+    """
+
+    def __init__(
+        self,
+        queue: rq.Queue,
+        max_batch_size: int,
+        idle_timeout: int,
+    ):
+        super().__init__()
+        self._queue = queue
+        self._max_batch_size = max_batch_size
+        self._idle_timeout = idle_timeout
+        self._pending: deque[LLMContext] = deque()
+        self._burst = False
+
+    def _pop_job_id(self, block: bool) -> Optional[str]:
+        connection = self._queue.connection
+        if block:
+            result = connection.blpop(self._queue.key, self._idle_timeout)
+            job_id = result[1] if result is not None else None
+        else:
+            job_id = connection.lpop(self._queue.key)
+
+        return job_id.decode() if job_id is not None else None
+
+    def _pull_contexts(self, free_slots: int, block: bool):
+        while len(self._pending) < free_slots:
+            job_id = self._pop_job_id(block=block and not self._pending)
+            if job_id is None:
+                return
+            if self._is_stopping:
+                # Stop is requested during the blocking pop
+                self._queue.connection.lpush(self._queue.key, job_id)
+                return
+
+            try:
+                job = Job.fetch(job_id, connection=self._queue.connection)
+            except NoSuchJobError:
+                # Job has expired (TTL) while waiting in the queue
+                continue
+
+            contexts = job.args[0]
+            # Contexts are owned by the worker from now on
+            job.delete()
+
+            logger.info("Admitting contexts: %r", contexts)
+            self._pending.extend(contexts)
+
+    def _admit(self, free_slots: int) -> list[LLMContext]:
+        if self._is_stopping:
+            return []
+
+        # Block only if the worker is idle, otherwise
+        # running contexts would be stalled
+        block = free_slots == self._max_batch_size and not self._burst
+        self._pull_contexts(free_slots, block=block)
+
+        admitted = []
+        now = time.time()
+        while self._pending and len(admitted) < free_slots:
+            context = self._pending.popleft()
+            context.mark("picked", now)
+            admitted.append(context)
+        return admitted
+
+    def work(self, burst: bool = False):
+        """
+        Process contexts until interrupted. In `burst` mode
+        the worker exits as soon as the queue is drained.
+        """
+        self._burst = burst
+        horoscope_model = get_model()
+        publisher = get_publisher()
+        keep = ContextPruner(
+            get_redis(), publisher, check_cancelled=settings.cancellation_enabled
+        )
+
+        with self._handle_signals():
+            while not self._is_stopping:
+                for batch in horoscope_model.infer_continuous(
+                    admit=self._admit, max_batch_size=self._max_batch_size, keep=keep
+                ):
+                    publisher.publish(batch)
+
+                if burst:
+                    break
+
+        if self._pending:
+            self._hand_over_pending()
+
+    def _hand_over_pending(self):
+        """Contexts that weren't admitted go back to the front of the queue"""
+        contexts = list(self._pending)
+        self._pending.clear()
+        logger.info("Handing over contexts: %r", contexts)
+        self._queue.enqueue(
+            process,
+            contexts,
+            ttl=math.ceil(settings.scaled(settings.infer_job_ttl)),
+            at_front=True,
+        )
+
+
+def run_worker(worker_name: str, burst: bool = False):
+    queue = get_queue()
+    if settings.worker_mode == "pull":
+        worker = PullWorker(
+            get_redis(),
+            batch_size=settings.worker_max_batch_size,
+            idle_timeout=settings.worker_idle_timeout,
+        )
+        worker.work(burst=burst)
+    elif settings.worker_mode == "continuous":
+        worker = ContinuousWorker(
+            queue,
+            max_batch_size=settings.worker_max_batch_size,
+            idle_timeout=settings.worker_idle_timeout,
+        )
+        worker.work(burst=burst)
+    else:
+        # `rq.SimpleWorker` runs jobs in the worker process itself,
+        # so the model and Redis connections stay warm across jobs
+        worker_class = rq.Worker if settings.worker_fork else rq.SimpleWorker
+        worker = worker_class([queue], name=worker_name, connection=get_redis())
+        worker.work(burst=burst)
+
+
+# Delay before a crashed worker of the pool is restarted, so a worker
+# that can't start (e.g. Redis is down) doesn't spin the supervisor
+POOL_RESTART_DELAY = 1.0
+
+
+def run_pool_worker(worker_name: str):
+    # Signal handlers and mask of the supervisor are inherited
+    # by the restarted workers
+    for signum in SHUTDOWN_SIGNALS:
+        signal.signal(signum, signal.SIG_DFL)
+    signal.pthread_sigmask(signal.SIG_UNBLOCK, SHUTDOWN_SIGNALS)
+    run_worker(worker_name)
+
+
+def run_worker_pool(concurrency: int):
+    """
+    Runs `concurrency` long-lived worker processes in the container.
+    They are forked only once, after the model is loaded,
+    so its memory pages are shared between them.
+    Workers that exit unexpectedly (OOM, crash) are restarted,
+    until the shutdown begins.
+    """
+    hostname = os.getenv("HOSTNAME", "localhost")
+    mp_context = multiprocessing.get_context("fork")
+    is_stopping = False
+    # A worker killed by SIGKILL stays registered in RQ until its key expires,
+    # so every start of the worker gets a new name
+    generations = [0] * concurrency
+
+    def start_worker(i: int) -> multiprocessing.Process:
+        worker_name = f"worker-{hostname}-{i}.{generations[i]}"
+        generations[i] += 1
+        process = mp_context.Process(target=run_pool_worker, args=(worker_name,))
+        process.start()
+        return process
+
+    processes = [start_worker(i) for i in range(concurrency)]
+
+    def forward_signal(signum, frame):
+        nonlocal is_stopping
+        is_stopping = True
+        for process in processes:
+            if process.is_alive():
+                os.kill(process.pid, signum)
+
+    def stop_on_interrupt(signum, frame):
+        # Terminal delivers SIGINT to the whole process group by itself
+        nonlocal is_stopping
+        is_stopping = True
+
+    signal.signal(signal.SIGTERM, forward_signal)
+    signal.signal(signal.SIGINT, stop_on_interrupt)
+
+    while True:
+        alive = [process for process in processes if process.is_alive()]
+        if is_stopping and not alive:
+            return
+        if alive:
+            multiprocessing.connection.wait(
+                [process.sentinel for process in alive], timeout=POOL_RESTART_DELAY
+            )
+
+        for i, process in enumerate(processes):
+            if is_stopping or process.is_alive():
+                continue
+            logger.warning(
+                "Worker %s exited with code %s, restarting",
+                process.pid,
+                process.exitcode,
+            )
+            time.sleep(POOL_RESTART_DELAY)
+            if not is_stopping:
+                # Signals are handled, once the worker is in the list
+                signal.pthread_sigmask(signal.SIG_BLOCK, SHUTDOWN_SIGNALS)
+                try:
+                    processes[i] = start_worker(i)
+                finally:
+                    signal.pthread_sigmask(signal.SIG_UNBLOCK, SHUTDOWN_SIGNALS)
+
+
 if __name__ == "__main__":
     setup_logging()
     get_model()  # Cache model in memory
-    queue = get_queue()
-    redis = get_redis()
-    worker_name = f"worker-{os.getenv('HOSTNAME', 'localhost')}"
-    worker = rq.Worker([queue], name=worker_name, connection=redis)
-    worker.work()
+    if settings.worker_concurrency > 1:
+        run_worker_pool(settings.worker_concurrency)
+    else:
+        run_worker(f"worker-{os.getenv('HOSTNAME', 'localhost')}")
@@ -3,21 +3,44 @@ import asyncio
 import time
 
 import pytest
-
-from horoscoper.api.batcher import ContextBatcher
+from fakeredis import FakeServer
+from fakeredis.aioredis import FakeRedis
+
+from horoscoper.api.batcher import (
+    AdaptiveBatchingPolicy,
+    BatcherOverloaded,
+    ContextBatcher,
+    SharedContextBatcher,
+)
+from horoscoper.api.pubsub import PubSubMultiplexer
 from horoscoper.horoscope import LLMContext
+from horoscoper.settings import settings
 
 
 class FakeInfer:
     def __init__(self):
         self.enqueued = []
+        self.queue_depth = 0
+        self.round_trips = 0
+        self.redis_client = None
 
     def enqueue(self, contexts: list[LLMContext], **kwargs):
         self.enqueued.append(contexts)
 
-    async def enqueue_async(self, contexts: list[LLMContext], **kwargs):
+    async def enqueue_async(self, redis_client, contexts: list[LLMContext], **kwargs):
         self.enqueue(contexts)
 
+    async def enqueue_many_async(
+        self, redis_client, batches: list[list[LLMContext]], **kwargs
+    ):
+        self.redis_client = redis_client
+        self.round_trips += 1
+        for contexts in batches:
+            self.enqueue(contexts)
+
+    async def get_queue_depth_async(self, redis_client):
+        return self.queue_depth
+
 
 @pytest.fixture
 def fake_infer(monkeypatch):
@@ -26,14 +49,19 @@ def fake_infer(monkeypatch):
     return fake_infer
 
 
+@pytest.fixture
+def fake_async_redis():
+    return FakeRedis()
+
+
 @pytest.mark.anyio
-async def test_batcher_asap_enqueue(fake_infer: FakeInfer):
+async def test_batcher_asap_enqueue(fake_infer: FakeInfer, fake_async_redis):
     batch_size = 4
     window_size = 1000
 
     contexts = [LLMContext() for _ in range(batch_size)]
     async with ContextBatcher(
-        batch_size=batch_size, window_size_ms=window_size
+        fake_async_redis, batch_size=batch_size, window_size_ms=window_size
     ) as batcher:
         for context in contexts:
             await batcher.add_context_to_batch(context)
@@ -44,16 +72,19 @@ async def test_batcher_asap_enqueue(fake_infer: FakeInfer):
         assert (
             fake_infer.enqueued[0] == contexts
         ), "Contexts are enqueued ASAP if batch size is reached"
+        assert (
+            fake_infer.redis_client is fake_async_redis
+        ), "Jobs are enqueued with the client of the batcher"
 
 
 @pytest.mark.anyio
-async def test_batcher_wait_for_window(fake_infer: FakeInfer):
+async def test_batcher_wait_for_window(fake_infer: FakeInfer, fake_async_redis):
     batch_size = 4
     window_size = 50
 
     contexts = [LLMContext() for _ in range(batch_size // 2)]
     async with ContextBatcher(
-        batch_size=batch_size, window_size_ms=window_size
+        fake_async_redis, batch_size=batch_size, window_size_ms=window_size
     ) as batcher:
         for context in contexts:
             await batcher.add_context_to_batch(context)
@@ -70,14 +101,16 @@ async def test_batcher_wait_for_window(fake_infer: FakeInfer):
 
 
 @pytest.mark.anyio
-async def test_batcher_stale_contexts(fake_infer: FakeInfer, monkeypatch):
+async def test_batcher_stale_contexts(
+    fake_infer: FakeInfer, fake_async_redis, monkeypatch
+):
     batch_size = 4
     window_size = 25
 
     contexts = [LLMContext() for _ in range(batch_size // 2)]
 
     async with ContextBatcher(
-        batch_size=batch_size, window_size_ms=window_size
+        fake_async_redis, batch_size=batch_size, window_size_ms=window_size
     ) as batcher:
         now = time.monotonic()
 
@@ -93,14 +126,14 @@ async def test_batcher_stale_contexts(fake_infer: FakeInfer, monkeypatch):
 
 
 @pytest.mark.anyio
-async def test_batcher_long_run(fake_infer: FakeInfer):
+async def test_batcher_long_run(fake_infer: FakeInfer, fake_async_redis):
     batch_size = 4
     window_size = 50
 
     contexts = [LLMContext() for _ in range(batch_size * 2)]
 
     async with ContextBatcher(
-        batch_size=batch_size, window_size_ms=window_size
+        fake_async_redis, batch_size=batch_size, window_size_ms=window_size
     ) as batcher:
         for context in contexts[:2]:
             await batcher.add_context_to_batch(context)
@@ -122,3 +155,325 @@ async def test_batcher_long_run(fake_infer: FakeInfer):
         assert (
             fake_infer.enqueued[2] == contexts[6:]
         ), "Last 2 after next window expiration"
+
+
+def test_adaptive_policy_low_traffic():
+    policy = AdaptiveBatchingPolicy(
+        min_batch_size=1, max_batch_size=8, min_window_size_ms=5, max_window_size_ms=250
+    )
+
+    # One context per second
+    for i in range(10):
+        policy.record_arrival(float(i))
+
+    assert policy.window_size == 0.005, "Nothing to wait for at low traffic"
+
+
+def test_adaptive_policy_high_traffic():
+    policy = AdaptiveBatchingPolicy(
+        min_batch_size=1, max_batch_size=8, min_window_size_ms=5, max_window_size_ms=250
+    )
+
+    # Workers have a backlog
+    for _ in range(10):
+        policy.record_queue_depth(3)
+    assert policy.batch_size == 8, "Batch size grows up to the upper bound"
+
+    # 100 contexts per second
+    for i in range(10):
+        policy.record_arrival(i / 100)
+    assert policy.window_size == pytest.approx(0.07), "Window is the time to fill"
+
+    # 10 contexts per second
+    for i in range(100):
+        policy.record_arrival(1 + i / 10)
+    assert policy.window_size == 0.25, "Window is bounded"
+
+    # Workers are idle
+    for _ in range(10):
+        policy.record_queue_depth(0)
+    assert policy.batch_size == 1, "Batch size shrinks down to the lower bound"
+    assert policy.window_size == 0.005
+
+
+@pytest.mark.anyio
+async def test_batcher_adaptive_policy(fake_infer: FakeInfer, fake_async_redis):
+    policy = AdaptiveBatchingPolicy(
+        min_batch_size=2, max_batch_size=4, min_window_size_ms=5, max_window_size_ms=50
+    )
+    fake_infer.queue_depth = 10
+
+    contexts = [LLMContext() for _ in range(5)]
+    async with ContextBatcher(
+        fake_async_redis, batch_size=4, window_size_ms=1000, policy=policy
+    ) as batcher:
+        for context in contexts[:2]:
+            await batcher.add_context_to_batch(context)
+        await asyncio.sleep(0.01)
+
+        for context in contexts[2:]:
+            await batcher.add_context_to_batch(context)
+        await asyncio.sleep(0.01)
+
+        assert fake_infer.enqueued == [
+            contexts[:2],
+            contexts[2:],
+        ], "Batch size grows with worker queue depth"
+
+
+@pytest.mark.anyio
+async def test_batcher_bounded_queue(fake_infer: FakeInfer, fake_async_redis):
+    async with ContextBatcher(
+        fake_async_redis, batch_size=4, window_size_ms=1000, capacity=2
+    ) as batcher:
+        await batcher.add_context_to_batch(LLMContext())
+        await batcher.add_context_to_batch(LLMContext())
+
+        with pytest.raises(BatcherOverloaded) as exc_info:
+            await batcher.add_context_to_batch(LLMContext())
+
+        assert exc_info.value.retry_after >= 1
+
+
+@pytest.mark.anyio
+async def test_batcher_admission_control(
+    fake_infer: FakeInfer, fake_async_redis, monkeypatch
+):
+    monkeypatch.setattr(settings, "infer_job_ttl", 7)
+    now = 0.0
+    monkeypatch.setattr("time.monotonic", lambda: now)
+
+    batcher = ContextBatcher(
+        fake_async_redis, batch_size=4, window_size_ms=1000, capacity=100
+    )
+    # Jobs are consumed with 2 jobs per second
+    for depth in (30, 28, 26):
+        fake_infer.queue_depth = depth
+        await batcher._sample_queue_depth()
+        now += 1.0
+
+    assert batcher.estimate_wait_time() == pytest.approx(13)
+    batcher._is_running = True
+
+    with pytest.raises(BatcherOverloaded) as exc_info:
+        await batcher.add_context_to_batch(LLMContext())
+    assert exc_info.value.retry_after == 6, "Retry when the wait fits into TTL"
+
+    fake_infer.queue_depth = 10
+    await batcher._sample_queue_depth()
+    await batcher.add_context_to_batch(LLMContext())
+
+
+@pytest.mark.anyio
+async def test_batcher_admission_after_idle(
+    fake_infer: FakeInfer, fake_async_redis, monkeypatch
+):
+    monkeypatch.setattr(settings, "infer_job_ttl", 7)
+    now = 0.0
+    monkeypatch.setattr("time.monotonic", lambda: now)
+
+    batcher = ContextBatcher(
+        fake_async_redis, batch_size=4, window_size_ms=1000, capacity=100
+    )
+    for depth in (4, 2, 0):
+        fake_infer.queue_depth = depth
+        await batcher._sample_queue_depth()
+        now += 1.0
+    # Idle for an hour
+    for _ in range(7200):
+        await batcher._sample_queue_depth()
+        now += 0.5
+
+    assert batcher._jobs_per_second == pytest.approx(2)
+    batcher._is_running = True
+    for _ in range(8):
+        await batcher.add_context_to_batch(LLMContext())
+
+
+@pytest.mark.anyio
+async def test_batcher_length_aware(fake_infer: FakeInfer, fake_async_redis):
+    lengths = [10, 50, 12, 48, 30]
+    contexts = [LLMContext(prefix=str(length)) for length in lengths]
+
+    async with ContextBatcher(
+        fake_async_redis,
+        batch_size=2,
+        window_size_ms=50,
+        estimate_length=lambda ctx: int(ctx.prefix),
+        lookahead=2,
+    ) as batcher:
+        for context in contexts:
+            await batcher.add_context_to_batch(context)
+
+        await asyncio.sleep(0)
+        assert fake_infer.enqueued == [
+            [contexts[0], contexts[2]],
+        ], "Contexts with similar lengths are batched together"
+
+        await asyncio.sleep(0.05 + 0.01)
+        assert fake_infer.enqueued[1:] == [
+            [contexts[1], contexts[3]],
+            [contexts[4]],
+        ], "Contexts left out are batched first, after the window is over"
+
+
+@pytest.mark.anyio
+async def test_batcher_bulk_enqueue(fake_infer: FakeInfer, fake_async_redis):
+    batch_size = 2
+    contexts = [LLMContext() for _ in range(batch_size * 3)]
+
+    async with ContextBatcher(
+        fake_async_redis, batch_size=batch_size, window_size_ms=1000
+    ) as batcher:
+        for context in contexts:
+            await batcher.add_context_to_batch(context)
+
+        await asyncio.sleep(0)
+        assert fake_infer.enqueued == [
+            contexts[0:2],
+            contexts[2:4],
+            contexts[4:6],
+        ]
+        assert fake_infer.round_trips == 1, "Ready batches are enqueued at once"
+
+
+@pytest.mark.anyio
+async def test_batcher_batch_channel(fake_infer: FakeInfer, fake_async_redis):
+    contexts = [LLMContext() for _ in range(2)]
+
+    async with PubSubMultiplexer(fake_async_redis) as pubsub:
+        subscriptions = [pubsub.register(context.redis_key) for context in contexts]
+        async with ContextBatcher(
+            fake_async_redis, batch_size=2, window_size_ms=1000, pubsub=pubsub
+        ) as batcher:
+            for context in contexts:
+                await batcher.add_context_to_batch(context)
+            await asyncio.sleep(0.1)
+
+        assert fake_infer.enqueued == [contexts]
+        batch_key = contexts[0].batch_key
+        assert all(context.batch_key == batch_key for context in contexts)
+        assert await fake_async_redis.pubsub_numsub(batch_key) == [
+            (batch_key, 1)
+        ], "One channel is subscribed for the whole batch before enqueue"
+
+        for subscription in subscriptions:
+            subscription.close()
+
+
+@pytest.mark.anyio
+async def test_batcher_cancel(fake_infer: FakeInfer, fake_async_redis):
+    contexts = [LLMContext() for _ in range(3)]
+
+    async with ContextBatcher(
+        fake_async_redis, batch_size=4, window_size_ms=50
+    ) as batcher:
+        for context in contexts:
+            await batcher.add_context_to_batch(context)
+        await asyncio.sleep(0)
+        await batcher.cancel(contexts[1])
+
+        await asyncio.sleep(0.05 + 0.01)
+        assert fake_infer.enqueued == [
+            [contexts[0], contexts[2]]
+        ], "Cancelled context is dropped before the batch is formed"
+
+        await batcher.add_context_to_batch(contexts[1])
+        await batcher.cancel(contexts[1])
+        await asyncio.sleep(0.05 + 0.01)
+        assert len(fake_infer.enqueued) == 1, "Nothing left to enqueue"
+        assert batcher._queued == batcher._cancelled == set()
+
+
+@pytest.mark.anyio
+async def test_batcher_expired(fake_infer: FakeInfer, fake_async_redis):
+    contexts = [LLMContext(deadline=time.time() + 0.02), LLMContext()]
+
+    async with ContextBatcher(
+        fake_async_redis, batch_size=4, window_size_ms=50
+    ) as batcher:
+        for context in contexts:
+            await batcher.add_context_to_batch(context)
+
+        await asyncio.sleep(0.05 + 0.01)
+        assert fake_infer.enqueued == [
+            contexts[1:]
+        ], "Context expired while waiting for the window is dropped"
+
+
+@pytest.mark.anyio
+async def test_shared_batcher(fake_infer: FakeInfer):
+    server = FakeServer()
+    first, second = (
+        SharedContextBatcher(
+            FakeRedis(server=server), batch_size=4, window_size_ms=1000
+        )
+        for _ in range(2)
+    )
+    contexts = [LLMContext() for _ in range(8)]
+
+    async with first, second:
+        await asyncio.sleep(0.01)
+        assert [first.is_leader(), second.is_leader()] == [True, False]
+
+        # Traffic is split between the API processes
+        for context in contexts[:4]:
+            batcher = first if contexts.index(context) % 2 else second
+            await batcher.add_context_to_batch(context)
+        await asyncio.sleep(0.05)
+        assert fake_infer.enqueued == [contexts[:4]], "Batch is full"
+
+        # Leader is gone, so the second one takes over
+        await first.stop()
+        for context in contexts[4:]:
+            await second.add_context_to_batch(context)
+        # Followers check the lease every third of it
+        await asyncio.sleep(SharedContextBatcher.LEASE_MS / 3000 + 0.1)
+
+        assert second.is_leader()
+        assert fake_infer.enqueued == [contexts[:4], contexts[4:]]
+
+
+@pytest.mark.anyio
+async def test_shared_batcher_bounded(fake_infer: FakeInfer, monkeypatch):
+    server = FakeServer()
+    leader, follower = (
+        SharedContextBatcher(
+            FakeRedis(server=server), batch_size=4, window_size_ms=100, capacity=8
+        )
+        for _ in range(2)
+    )
+    # Batching is stalled, so contexts pile up in the local queue
+    resumed = asyncio.Event()
+    run = leader._run
+
+    async def stalled_run():
+        await resumed.wait()
+        await run()
+
+    monkeypatch.setattr(leader, "_run", stalled_run)
+
+    async with leader, follower:
+        await asyncio.sleep(0.01)
+        assert leader.is_leader()
+
+        accepted, rejected = [], 0
+        for _ in range(30):
+            context = LLMContext()
+            try:
+                await follower.add_context_to_batch(context)
+                accepted.append(context)
+            except BatcherOverloaded:
+                rejected += 1
+            await asyncio.sleep(0)
+        await asyncio.sleep(0.1)
+
+        assert leader.is_running()
+        assert leader._queue.qsize() <= 8, "Local queue is never overflown"
+        assert rejected >= 14, "Admission is based on the shared list"
+
+        resumed.set()
+        await asyncio.sleep(0.3)
+        assert sorted(
+            context.id for batch in fake_infer.enqueued for context in batch
+        ) == sorted(context.id for context in accepted), "No context is lost"
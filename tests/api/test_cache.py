@@ -0,0 +1,44 @@
+import asyncio
+
+import pytest
+from fakeredis.aioredis import FakeRedis
+
+from horoscoper.api.cache import ResponseCache, cache_hits, cache_misses
+
+
+@pytest.fixture
+def fake_async_redis():
+    yield FakeRedis()
+
+
+@pytest.mark.anyio
+async def test_cache_hit_and_miss(fake_async_redis):
+    cache = ResponseCache(fake_async_redis, ttl=10, max_entries=10)
+    hits, misses = cache_hits._value.get(), cache_misses._value.get()
+
+    assert await cache.get("Hey!") is None
+    await cache.set("Hey!", ["Hello ", "world"])
+    assert await cache.get("Hey!") == ["Hello ", "world"]
+
+    assert cache_hits._value.get() == hits + 1
+    assert cache_misses._value.get() == misses + 1
+    assert 0 < await fake_async_redis.ttl(ResponseCache.key("Hey!")) <= 10
+
+
+@pytest.mark.anyio
+async def test_cache_evicts_least_recently_used(fake_async_redis):
+    cache = ResponseCache(fake_async_redis, ttl=10, max_entries=2)
+
+    for prefix in ("first", "second"):
+        await cache.set(prefix, [prefix])
+        await asyncio.sleep(0.01)
+
+    # Touch the oldest one, so that the second is evicted instead
+    await cache.get("first")
+    await asyncio.sleep(0.01)
+    await cache.set("third", ["third"])
+
+    assert await cache.get("first") == ["first"]
+    assert await cache.get("second") is None
+    assert await cache.get("third") == ["third"]
+    assert await fake_async_redis.zcard(ResponseCache.INDEX_KEY) == 2
@@ -0,0 +1,135 @@
+import asyncio
+from uuid import uuid4
+
+import pytest
+from fakeredis.aioredis import FakeRedis
+from redis.exceptions import ConnectionError
+
+from horoscoper.api.pubsub import PubSubMultiplexer
+from horoscoper.tasks.infer import encode_batch_message
+
+
+@pytest.fixture
+def fake_async_redis():
+    yield FakeRedis()
+
+
+@pytest.mark.anyio
+async def test_pubsub_routes_messages(fake_async_redis):
+    async with PubSubMultiplexer(fake_async_redis) as pubsub:
+        first, second = await asyncio.gather(
+            pubsub.subscribe(b"first"), pubsub.subscribe(b"second")
+        )
+
+        await fake_async_redis.publish(b"second", b"world")
+        await fake_async_redis.publish(b"first", b"hello")
+
+        assert await first.get_message(timeout=1) == b"hello"
+        assert await second.get_message(timeout=1) == b"world"
+        assert (
+            await first.get_message(timeout=0.01) is None
+        ), "Only messages from the subscribed channel are received"
+
+
+@pytest.mark.anyio
+async def test_pubsub_batches_commands(fake_async_redis, monkeypatch):
+    async with PubSubMultiplexer(fake_async_redis) as pubsub:
+        commands = []
+        execute_command = pubsub._pubsub.execute_command
+
+        async def spy_execute_command(*args):
+            commands.append(args)
+            return await execute_command(*args)
+
+        monkeypatch.setattr(pubsub._pubsub, "execute_command", spy_execute_command)
+
+        channels = [f"channel-{i}".encode() for i in range(10)]
+        subscriptions = await asyncio.gather(*map(pubsub.subscribe, channels))
+        assert len(commands) == 1, "Channels are subscribed with a single command"
+        assert commands[0][0] == "SUBSCRIBE"
+        assert sorted(commands[0][1:]) == channels
+
+        for subscription in subscriptions:
+            subscription.close()
+        await asyncio.sleep(0.01)
+
+        assert commands[1][0] == "UNSUBSCRIBE"
+        assert sorted(commands[1][1:]) == channels
+        assert await fake_async_redis.pubsub_numsub(*channels) == [
+            (channel, 0) for channel in channels
+        ]
+
+
+@pytest.mark.anyio
+async def test_pubsub_demultiplexes_batch(fake_async_redis):
+    first_key, second_key = uuid4().bytes, uuid4().bytes
+
+    async with PubSubMultiplexer(fake_async_redis) as pubsub:
+        first, second = pubsub.register(first_key), pubsub.register(second_key)
+        await pubsub.subscribe_batch(b"batch", [first_key, second_key])
+        assert await fake_async_redis.pubsub_numsub(b"batch", first_key) == [
+            (b"batch", 1),
+            (first_key, 0),
+        ], "Only the batch channel is subscribed in Redis"
+
+        await fake_async_redis.publish(
+            b"batch",
+            encode_batch_message([(second_key, b"world"), (first_key, b"hello")]),
+        )
+        assert await first.get_message(timeout=1) == b"hello"
+        assert await second.get_message(timeout=1) == b"world"
+
+        first.close()
+        await asyncio.sleep(0.01)
+        assert await fake_async_redis.pubsub_numsub(b"batch") == [(b"batch", 1)]
+
+        second.close()
+        await asyncio.sleep(0.01)
+        assert await fake_async_redis.pubsub_numsub(b"batch") == [
+            (b"batch", 0)
+        ], "Batch channel is unsubscribed, once all contexts are done"
+
+
+@pytest.mark.anyio
+async def test_pubsub_batch_members_closed_before_confirmation(fake_async_redis):
+    async with PubSubMultiplexer(fake_async_redis) as pubsub:
+        local = pubsub.register(b"ctx")
+        subscribing = asyncio.create_task(pubsub.subscribe_batch(b"batch:1", [b"ctx"]))
+        await asyncio.sleep(0)
+
+        # Client is gone during the SUBSCRIBE round trip
+        local.close()
+        assert await asyncio.wait_for(subscribing, timeout=1) is None
+        assert not pubsub._subscriptions
+
+        await asyncio.sleep(0.01)
+        assert await fake_async_redis.pubsub_numsub(b"batch:1") == [(b"batch:1", 0)]
+
+
+@pytest.mark.anyio
+async def test_pubsub_connection_error(fake_async_redis, monkeypatch):
+    async with PubSubMultiplexer(fake_async_redis) as pubsub:
+
+        async def broken_subscribe(*channels):
+            raise ConnectionError("Connection reset by peer")
+
+        monkeypatch.setattr(pubsub._pubsub, "subscribe", broken_subscribe)
+
+        with pytest.raises(ConnectionError):
+            await asyncio.wait_for(pubsub.subscribe(b"channel"), timeout=1)
+        assert not pubsub.is_running()
+
+
+@pytest.mark.anyio
+async def test_pubsub_confirmation_timeout(fake_async_redis, monkeypatch):
+    async with PubSubMultiplexer(fake_async_redis) as pubsub:
+
+        async def lost_subscribe(*channels):
+            """Subscription is never confirmed"""
+
+        monkeypatch.setattr(pubsub._pubsub, "subscribe", lost_subscribe)
+        monkeypatch.setattr(pubsub, "CONFIRMATION_TIMEOUT", 0.05)
+
+        with pytest.raises(asyncio.TimeoutError):
+            await pubsub.subscribe(b"channel")
+        assert not pubsub._subscriptions
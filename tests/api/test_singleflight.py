@@ -0,0 +1,81 @@
+import asyncio
+
+import pytest
+
+from horoscoper.api.singleflight import FlightRegistry
+from horoscoper.llm import LLMContext
+from horoscoper.tasks.infer import InferMessage, InferMessageStatus
+
+MESSAGES = [
+    (None, InferMessage(status=status, text=text).model_dump_json().encode())
+    for text, status in (
+        ("Hello ", InferMessageStatus.IN_PROGRESS),
+        ("World", InferMessageStatus.FINISHED),
+    )
+]
+
+
+async def collect(messages) -> list:
+    return [message async for message in messages]
+
+
+@pytest.mark.anyio
+async def test_flight_replays_to_late_joiners():
+    registry = FlightRegistry()
+    source_queue = asyncio.Queue()
+
+    async def source():
+        while True:
+            yield await source_queue.get()
+
+    flight, is_leader = await registry.join(LLMContext(prefix="Hey!"))
+    assert is_leader
+    flight.start(source(), close=None)
+    leader = asyncio.create_task(collect(flight.listen()))
+
+    source_queue.put_nowait(MESSAGES[0])
+    await asyncio.sleep(0.01)
+
+    joined, is_leader = await registry.join(LLMContext(prefix="Hey!"))
+    assert joined is flight and not is_leader, "Identical prefix joins the flight"
+    follower = asyncio.create_task(collect(flight.listen()))
+
+    source_queue.put_nowait(MESSAGES[1])
+    assert await leader == MESSAGES
+    assert await follower == MESSAGES, "Emitted messages are replayed"
+    assert len(registry) == 0, "Finished flight is gone"
+
+
+@pytest.mark.anyio
+async def test_flight_aborted_leader():
+    registry = FlightRegistry()
+    flight, _ = await registry.join(LLMContext(prefix="Hey!"))
+
+    follower = asyncio.create_task(registry.join(LLMContext(prefix="Hey!")))
+    await asyncio.sleep(0)
+    flight.abort()
+
+    new_flight, is_leader = await follower
+    assert new_flight is not flight
+    assert is_leader, "Follower leads, when the leader has failed"
+
+
+@pytest.mark.anyio
+async def test_flight_released_without_listeners():
+    registry = FlightRegistry()
+    closed = asyncio.Event()
+
+    async def source():
+        await asyncio.sleep(10)
+        yield MESSAGES[0]
+
+    flight, _ = await registry.join(LLMContext(prefix="Hey!"))
+    flight.start(source(), close=closed.set)
+
+    # Client is gone while waiting for the first message
+    listener = asyncio.create_task(collect(flight.listen()))
+    await asyncio.sleep(0)
+    listener.cancel()
+
+    await asyncio.wait_for(closed.wait(), timeout=1)
+    assert len(registry) == 0
@@ -0,0 +1,53 @@
+import json
+
+import pytest
+from prometheus_client import REGISTRY
+
+from horoscoper.api.tracing import Tracer
+from horoscoper.llm import LLMContext
+
+
+def get_stage_count(stage: str) -> float:
+    return (
+        REGISTRY.get_sample_value("api_infer_stage_latency_count", {"stage": stage})
+        or 0.0
+    )
+
+
+def test_tracer_observes_stages():
+    tracer = Tracer()
+    context = LLMContext()
+    tracer.trace(context)
+    context.timings.update(batched=context.timings["received"] + 0.5)
+
+    batcher_count = get_stage_count("batcher")
+    queue_count = get_stage_count("queue")
+    tracer.export(context, "timeout")
+
+    assert get_stage_count("batcher") == batcher_count + 1
+    assert get_stage_count("queue") == queue_count, "Unreached stages are skipped"
+
+
+def test_untraced_context():
+    context = LLMContext()
+    context.mark("batched")
+    assert context.timings is None
+
+    Tracer(trace_file=None).export(context, "finished")
+
+
+@pytest.mark.anyio
+async def test_tracer_writes_in_background(tmp_path):
+    trace_file = tmp_path / "traces.jsonl"
+    contexts = [LLMContext() for _ in range(3)]
+
+    async with Tracer(trace_file=trace_file) as tracer:
+        for context in contexts:
+            tracer.trace(context)
+            tracer.export(context, "finished")
+        assert not trace_file.exists(), "Export doesn't touch the disk"
+
+    traces = list(map(json.loads, trace_file.read_text().splitlines()))
+    assert [trace["context_id"] for trace in traces] == [
+        str(context.id) for context in contexts
+    ], "Exported traces are written on stop"
@@ -1,14 +1,23 @@
-from contextlib import contextmanager
-from unittest.mock import AsyncMock
+import asyncio
+import json
+import time
+from unittest.mock import AsyncMock, Mock
 
 import pytest
 from fakeredis.aioredis import FakeRedis
 from httpx import AsyncClient
 
+from horoscoper.api.batcher import BatcherOverloaded
+from horoscoper.api.cache import ResponseCache
 from horoscoper.api.main import app
+from horoscoper.api.pubsub import PubSubMultiplexer
+from horoscoper.api.singleflight import FlightRegistry
 from horoscoper.api.state import AppState, get_app_state
+from horoscoper.api.tracing import Tracer
 from horoscoper.api.views import APIInferRequest
-from horoscoper.tasks.infer import InferMessage, InferMessageStatus
+from horoscoper.llm import LLMContext
+from horoscoper.settings import settings
+from horoscoper.tasks.infer import InferMessage, InferMessageStatus, encode_message
 
 
 @pytest.fixture
@@ -17,67 +26,69 @@ def fake_async_redis():
 
 
 @pytest.fixture
-async def client(fake_async_redis):
+async def pubsub(fake_async_redis):
+    async with PubSubMultiplexer(fake_async_redis) as pubsub:
+        yield pubsub
+
+
+@pytest.fixture
+async def client(fake_async_redis, pubsub):
     class FakeState(AppState):
         def __init__(self, *args, **kwargs):
             self.redis = fake_async_redis
+            self.pubsub = pubsub
             self.batcher = AsyncMock()
+            self.batcher.is_running = Mock(return_value=True)
 
     app_state = FakeState()
     app.dependency_overrides[get_app_state] = lambda: app_state
 
     async with AsyncClient(app=app, base_url="http://test") as client:
+        client.app_state = app_state
         yield client
 
     app.dependency_overrides.clear()
 
 
-class FakePubSub:
-    def __init__(self, messages: list[dict]):
-        self.messages = messages
-        self.i = 0
+def publish_on_batch(client, fake_async_redis, messages: list[bytes]):
+    """Emulates worker, that replies as soon as context is batched"""
 
-    async def get_message(self, *args, **kwargs):
-        if self.i >= len(self.messages):
-            raise RuntimeError("Trying to get messages from a closed PubSub")
-        msg = self.messages[self.i]
-        self.i += 1
-        return msg
+    async def add_context_to_batch(context: LLMContext):
+        for message in messages:
+            await fake_async_redis.publish(context.redis_key, message)
 
-    async def subscribe(self, *args, **kwargs):
-        pass
+    client.app_state.batcher.add_context_to_batch.side_effect = add_context_to_batch
 
-    def __call__(self, *args, **kwargs):
-        return self
 
-    async def __aenter__(self):
-        return self
+@pytest.mark.anyio
+async def test_healthcheck(client):
+    response = await client.get("/healthcheck")
+    assert response.status_code == 200
 
-    async def __aexit__(self, exc_type, exc, traceback):
-        pass
 
+async def read_sse_lines(client, prefix: str = "Hey!") -> list[str]:
+    request_body = APIInferRequest(prefix=prefix).model_dump()
 
-@contextmanager
-def fake_pubsub_messages(fake_async_redis, messages: list[dict]):
-    fake_pub_sub = FakePubSub(messages=messages)
-    old_pub_sub = fake_async_redis.pubsub
-    try:
-        fake_async_redis.pubsub = fake_pub_sub
-        yield
-    finally:
-        fake_async_redis.pubsub = old_pub_sub
+    async with client.stream(
+        "POST",
+        "/api/v1/infer",
+        json=request_body,
+    ) as response:
+        assert response.status_code == 200
 
+        response_lines = []
+        async for line in response.aiter_lines():
+            # Separator between messages
+            if line != "":
+                response_lines.append(line)
 
-@pytest.mark.anyio
-async def test_healthcheck(client):
-    response = await client.get("/healthcheck")
-    assert response.status_code == 200
+    return response_lines
 
 
 @pytest.mark.anyio
-async def test_infer_sse(client, monkeypatch, fake_async_redis):
+async def test_infer_sse(client, fake_async_redis):
     """
-    This test covers logic inside stream response without redis and queue.
+    This test covers logic inside stream response without queue.
     """
     infer_messages = [
         InferMessage(status=InferMessageStatus.IN_PROGRESS, text="Hello "),
@@ -85,54 +96,244 @@ async def test_infer_sse(client, monkeypatch, fake_async_redis):
         InferMessage(status=InferMessageStatus.FINISHED, text="!"),
     ]
 
-    pubsub_messages = [
-        {"type": "subscribe", "data": 1},
-        *[
-            {"type": "message", "data": im.model_dump_json().encode()}
-            for im in infer_messages
+    publish_on_batch(
+        client, fake_async_redis, [im.model_dump_json() for im in infer_messages]
+    )
+
+    response_lines = await read_sse_lines(client)
+    assert response_lines == [f"data: {im.model_dump_json()}" for im in infer_messages]
+
+
+@pytest.mark.anyio
+async def test_infer_sse_binary_frames(client, fake_async_redis):
+    chunks = [
+        ("Hello ", InferMessageStatus.IN_PROGRESS),
+        ("Wörld", InferMessageStatus.IN_PROGRESS),
+        ("!", InferMessageStatus.FINISHED),
+    ]
+
+    publish_on_batch(
+        client,
+        fake_async_redis,
+        [
+            encode_message(text, status, seq, "binary")
+            for seq, (text, status) in enumerate(chunks, start=1)
         ],
+    )
+
+    response_lines = await read_sse_lines(client)
+    assert response_lines == [
+        f"data: {InferMessage(text=text, status=status, seq=seq).model_dump_json()}"
+        for seq, (text, status) in enumerate(chunks, start=1)
+    ], "Frames are rendered exactly like JSON messages"
+
+
+@pytest.mark.anyio
+async def test_infer_sse_timeout(client, monkeypatch):
+    monkeypatch.setattr(settings, "infer_job_ttl", 0.05)
+
+    response_lines = await read_sse_lines(client)
+    assert len(response_lines) == 1
+    assert "error" in response_lines[0]
+
+
+@pytest.mark.anyio
+async def test_infer_sse_timeout_cancels(client, fake_async_redis, monkeypatch):
+    monkeypatch.setattr(settings, "infer_job_ttl", 0.05)
+    batcher = client.app_state.batcher
+
+    await read_sse_lines(client)
+    await asyncio.sleep(0.01)
+
+    [context], _ = batcher.cancel.call_args
+    assert batcher.cancel.await_count == 1, "Context is removed from the batcher"
+    assert await fake_async_redis.exists(
+        context.cancel_key
+    ), "Workers are told to drop the context"
+
+
+@pytest.mark.anyio
+async def test_infer_sse_shares_pubsub(client, fake_async_redis, pubsub):
+    finished = InferMessage(status=InferMessageStatus.FINISHED, text="!")
+    publish_on_batch(client, fake_async_redis, [finished.model_dump_json()])
+
+    connections_before = len(fake_async_redis.connection_pool._in_use_connections)
+    responses = await asyncio.gather(*(read_sse_lines(client) for _ in range(10)))
+    connections_after = len(fake_async_redis.connection_pool._in_use_connections)
+
+    assert all(lines == [f"data: {finished.model_dump_json()}"] for lines in responses)
+    assert connections_before == connections_after, "No extra connections are made"
+    assert pubsub._subscriptions == {}, "Channels are released after the response"
+
+
+@pytest.mark.anyio
+async def test_infer_sse_cached(client, fake_async_redis):
+    client.app_state.cache = ResponseCache(fake_async_redis, ttl=10, max_entries=10)
+    infer_messages = [
+        InferMessage(status=InferMessageStatus.IN_PROGRESS, text="Hello ", seq=1),
+        InferMessage(status=InferMessageStatus.FINISHED, text="World", seq=2),
     ]
+    publish_on_batch(
+        client, fake_async_redis, [im.model_dump_json() for im in infer_messages]
+    )
+    expected_lines = [f"data: {im.model_dump_json()}" for im in infer_messages]
 
-    with fake_pubsub_messages(fake_async_redis, pubsub_messages):
-        request_body = APIInferRequest(prefix="Hey!").model_dump()
+    assert await read_sse_lines(client, prefix="Cached") == expected_lines
+    assert client.app_state.batcher.add_context_to_batch.call_count == 1
 
-        async with client.stream(
-            "POST",
-            "/api/v1/infer",
-            json=request_body,
-        ) as response:
-            assert response.status_code == 200
+    assert (
+        await read_sse_lines(client, prefix="Cached") == expected_lines
+    ), "Response is the same"
+    assert (
+        client.app_state.batcher.add_context_to_batch.call_count == 1
+    ), "Cached response is not batched"
+
+
+@pytest.mark.anyio
+async def test_infer_sse_singleflight(client, fake_async_redis, pubsub):
+    client.app_state.flights = FlightRegistry()
+    infer_messages = [
+        InferMessage(status=InferMessageStatus.IN_PROGRESS, text="Hello "),
+        InferMessage(status=InferMessageStatus.FINISHED, text="World"),
+    ]
+    publish_on_batch(
+        client, fake_async_redis, [im.model_dump_json() for im in infer_messages]
+    )
+
+    responses = await asyncio.gather(*(read_sse_lines(client) for _ in range(5)))
+    assert all(
+        lines == [f"data: {im.model_dump_json()}" for im in infer_messages]
+        for lines in responses
+    )
+    assert (
+        client.app_state.batcher.add_context_to_batch.call_count == 1
+    ), "Identical prefixes are batched once"
+    assert pubsub._subscriptions == {}, "Channel is released"
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("message_format", ["json", "binary"])
+async def test_infer_sse_traced(client, fake_async_redis, tmp_path, message_format):
+    trace_file = tmp_path / "traces.jsonl"
+    client.app_state.tracer = Tracer(trace_file=trace_file)
+    await client.app_state.tracer.start()
+    chunks = [
+        ("Hello ", InferMessageStatus.IN_PROGRESS),
+        ("World", InferMessageStatus.FINISHED),
+    ]
+
+    async def add_context_to_batch(context: LLMContext):
+        context.mark("batched")
+        # Worker marks its copy of the context
+        timings = {**context.timings, "picked": time.time()}
+        timings["first_step"] = time.time()
+        for seq, (text, status) in enumerate(chunks, start=1):
+            message = encode_message(
+                text, status, seq, message_format, timings if seq == 1 else None
+            )
+            await fake_async_redis.publish(context.redis_key, message)
+
+    client.app_state.batcher.add_context_to_batch.side_effect = add_context_to_batch
+
+    assert await read_sse_lines(client) == [
+        f"data: {InferMessage(text=text, status=status, seq=seq).model_dump_json()}"
+        for seq, (text, status) in enumerate(chunks, start=1)
+    ], "Timings are not sent to the client"
+    await client.app_state.tracer.stop()
+
+    [trace] = map(json.loads, trace_file.read_text().splitlines())
+    assert trace["outcome"] == "finished"
+    assert list(trace["timings"]) == [
+        "received",
+        "batched",
+        "picked",
+        "first_step",
+        "delivered",
+        "finished",
+    ]
+
+
+@pytest.mark.anyio
+async def test_infer_overloaded(client, pubsub):
+    batcher = client.app_state.batcher
+    batcher.add_context_to_batch.side_effect = BatcherOverloaded(retry_after=3)
+
+    request_body = APIInferRequest(prefix="Hey!").model_dump()
+    response = await client.post("/api/v1/infer", json=request_body)
+
+    assert response.status_code == 429
+    assert response.headers["Retry-After"] == "3"
+    assert pubsub._subscriptions == {}, "Channel is released"
+
+
+@pytest.fixture
+def streams_transport(monkeypatch, fake_async_redis):
+    monkeypatch.setattr(settings, "transport", "streams")
+    monkeypatch.setattr(settings, "infer_job_ttl", 1)
+    xread = fake_async_redis.xread
+
+    async def polling_xread(streams, block=None, **kwargs):
+        # fakeredis doesn't support blocking XREAD
+        for _ in range(block // 10):
+            if await fake_async_redis.exists(*streams):
+                response = await xread(streams, **kwargs)
+                if response:
+                    return response
+            await asyncio.sleep(0.01)
+        return []
+
+    monkeypatch.setattr(fake_async_redis, "xread", polling_xread)
+
+
+STREAM_MESSAGES = [
+    InferMessage(status=InferMessageStatus.IN_PROGRESS, text="Hello ", seq=1),
+    InferMessage(status=InferMessageStatus.IN_PROGRESS, text="World", seq=2),
+    InferMessage(status=InferMessageStatus.FINISHED, text="!", seq=3),
+]
+
+
+async def write_stream(fake_async_redis, context: LLMContext):
+    for im in STREAM_MESSAGES:
+        await fake_async_redis.xadd(
+            context.stream_key, {"data": im.model_dump_json()}, id=f"0-{im.seq}"
+        )
+
+
+@pytest.mark.anyio
+async def test_infer_sse_streams(client, fake_async_redis, streams_transport):
+    async def add_context_to_batch(context: LLMContext):
+        await write_stream(fake_async_redis, context)
+
+    client.app_state.batcher.add_context_to_batch.side_effect = add_context_to_batch
+
+    response_lines = await read_sse_lines(client)
+    assert response_lines == [
+        line
+        for im in STREAM_MESSAGES
+        for line in (f"id: {im.seq}", f"data: {im.model_dump_json()}")
+    ], "Every event has an ID to resume from"
+
+
+@pytest.mark.anyio
+async def test_infer_sse_resume(client, fake_async_redis, streams_transport):
+    context = LLMContext()
+    await write_stream(fake_async_redis, context)
 
-            response_lines = []
-            async for line in response.aiter_lines():
-                # Separator between messages
-                if line != "":
-                    response_lines.append(line)
+    async with client.stream(
+        "GET", f"/api/v1/infer/{context.id}", headers={"Last-Event-ID": "1"}
+    ) as response:
+        assert response.status_code == 200
+        response_lines = [line async for line in response.aiter_lines() if line]
 
-            assert response_lines == [
-                f"data: {im.model_dump_json()}" for im in infer_messages
-            ]
+    assert response_lines == [
+        line
+        for im in STREAM_MESSAGES[1:]
+        for line in (f"id: {im.seq}", f"data: {im.model_dump_json()}")
+    ], "Stream is resumed after the last received event"
+    client.app_state.batcher.add_context_to_batch.assert_not_called()
 
 
 @pytest.mark.anyio
-async def test_infer_sse_timeout(client, fake_async_redis):
-    pubsub_messages = [{"type": "subscribe", "data": ""}, None]
-
-    with fake_pubsub_messages(fake_async_redis, messages=pubsub_messages):
-        request_body = APIInferRequest(prefix="Hey!").model_dump()
-
-        async with client.stream(
-            "POST",
-            "/api/v1/infer",
-            json=request_body,
-        ) as response:
-            assert response.status_code == 200
-
-            response_lines = []
-            async for line in response.aiter_lines():
-                # Separator between messages
-                if line != "":
-                    response_lines.append(line)
-
-            assert len(response_lines) == 1
-            assert "error" in response_lines[0]
+async def test_infer_sse_resume_pubsub(client):
+    response = await client.get(f"/api/v1/infer/{LLMContext().id}")
+    assert response.status_code == 404
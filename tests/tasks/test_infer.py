@@ -1,19 +1,62 @@
+import os
+import pickle
+import signal
+import time
+from collections import deque
+from uuid import uuid4
+
 import fakeredis
+import fakeredis.aioredis
 import pytest
+import rq
 
 import horoscoper.tasks.infer
 from horoscoper.horoscope import HoroscopeLLM
-from horoscoper.llm import LLMContext
-from horoscoper.tasks.infer import InferMessage, InferMessageStatus, process
+from horoscoper.llm import LLMContext, LLMInferResult
+from horoscoper.settings import settings
+from horoscoper.tasks.infer import (
+    CONTEXT_QUEUE_KEY,
+    ChunkCoalescer,
+    ContextPruner,
+    ContinuousWorker,
+    InferMessage,
+    InferMessageStatus,
+    InferPublisher,
+    PullWorker,
+    decode_batch_message,
+    enqueue_many_async,
+    process,
+    push_context_async,
+    render_message,
+    run_worker,
+    run_worker_pool,
+)
+
+
+@pytest.fixture
+def fake_server():
+    yield fakeredis.FakeServer()
 
 
 @pytest.fixture
-def patch_redis(monkeypatch):
-    fake_redis = fakeredis.FakeRedis()
+def patch_redis(monkeypatch, fake_server):
+    fake_redis = fakeredis.FakeRedis(server=fake_server)
     monkeypatch.setattr(horoscoper.tasks.infer, "get_redis", lambda: fake_redis)
     yield fake_redis
 
 
+@pytest.fixture
+def fake_async_redis(fake_server):
+    yield fakeredis.aioredis.FakeRedis(server=fake_server)
+
+
+@pytest.fixture
+def patch_queue(monkeypatch, patch_redis):
+    queue = rq.Queue(name="infer", connection=patch_redis)
+    monkeypatch.setattr(horoscoper.tasks.infer, "get_queue", lambda: queue)
+    yield queue
+
+
 @pytest.fixture
 def patch_get_model(monkeypatch):
     class FakeHoroscopeLLM(HoroscopeLLM):
@@ -21,7 +64,8 @@ def patch_get_model(monkeypatch):
         MAX_RESPONSE_TIME_MS = 10
 
         def __init__(self, *args, **kwargs):
-            pass
+            self._time_scale = 1.0
+            self._latency_model = None
 
         def _infer(self, context: LLMContext):
             return ["Hello", "world", "!"]
@@ -31,6 +75,33 @@ def patch_get_model(monkeypatch):
     yield fake_horoscope_llm
 
 
+def read_from_pubsub(pubsub):
+    received_messages = []
+    while True:
+        raw_message = pubsub.get_message()
+        if raw_message["type"] == "subscribe":
+            continue
+
+        json_data = raw_message["data"]
+        infer_message = InferMessage.model_validate_json(json_data)
+
+        received_messages.append(infer_message)
+
+        if infer_message.status in (
+            InferMessageStatus.ERROR,
+            InferMessageStatus.FINISHED,
+        ):
+            break
+    return received_messages
+
+
+EXPECTED_MESSAGES = [
+    InferMessage(text="Hello ", status=InferMessageStatus.IN_PROGRESS, seq=1),
+    InferMessage(text="world ", status=InferMessageStatus.IN_PROGRESS, seq=2),
+    InferMessage(text="!", status=InferMessageStatus.FINISHED, seq=3),
+]
+
+
 def test_infer_process(patch_get_model, patch_redis):
     contexts = [LLMContext(prefix="random"), LLMContext(prefix="cat")]
 
@@ -43,35 +114,466 @@ def test_infer_process(patch_get_model, patch_redis):
     pubsub_1.subscribe(context_key_1)
     pubsub_2.subscribe(context_key_2)
 
-    def read_from_pubsub(pubsub):
-        received_messages = []
-        while True:
-            raw_message = pubsub.get_message()
-            if raw_message["type"] == "subscribe":
-                continue
+    process(contexts=contexts)
+
+    received_messages_1 = read_from_pubsub(pubsub_1)
+    received_messages_2 = read_from_pubsub(pubsub_2)
+
+    assert (
+        received_messages_1 == EXPECTED_MESSAGES
+    ), "First subscriber received all messages"
+    assert (
+        received_messages_2 == EXPECTED_MESSAGES
+    ), "Second subscriber received all messages"
+
+
+def test_continuous_worker(patch_get_model, patch_redis):
+    queue = rq.Queue(name="infer", connection=patch_redis)
+    batches = [
+        [LLMContext(prefix="random"), LLMContext(prefix="cat")],
+        [LLMContext(prefix="dog")],
+        [LLMContext(prefix="expired")],
+    ]
+
+    pubsubs = []
+    for batch in batches[:2]:
+        for context in batch:
+            pubsub = patch_redis.pubsub()
+            pubsub.subscribe(context.redis_key)
+            pubsubs.append(pubsub)
+
+    for batch in batches:
+        queue.enqueue(process, batch)
+    # Emulate expired TTL of the last job
+    expired_job = queue.get_jobs()[-1]
+    expired_job.delete(remove_from_queue=False)
+
+    worker = ContinuousWorker(queue, max_batch_size=2, idle_timeout=1)
+    worker.work(burst=True)
 
-            json_data = raw_message["data"]
-            infer_message = InferMessage.model_validate_json(json_data)
+    for pubsub in pubsubs:
+        assert (
+            read_from_pubsub(pubsub) == EXPECTED_MESSAGES
+        ), "Every admitted context received all messages"
+
+    assert len(queue) == 0, "All jobs are consumed"
+    assert worker._pending == deque(), "Expired job is skipped"
+
+
+@pytest.fixture
+def sigterm_on_first_publish(monkeypatch):
+    """Emulates `docker stop` right after the first step"""
+    publish = InferPublisher.publish
+    published = []
 
-            received_messages.append(infer_message)
+    def publish_and_stop(self, batch):
+        if not published:
+            os.kill(os.getpid(), signal.SIGTERM)
+        published.append(batch)
+        publish(self, batch)
 
-            if infer_message.status in (
-                InferMessageStatus.ERROR,
-                InferMessageStatus.FINISHED,
-            ):
-                break
-        return received_messages
+    monkeypatch.setattr(InferPublisher, "publish", publish_and_stop)
+    yield published
+
+
+def test_continuous_worker_warm_shutdown(
+    patch_get_model, patch_redis, sigterm_on_first_publish
+):
+    queue = rq.Queue(name="infer", connection=patch_redis)
+    running = [LLMContext(prefix="random"), LLMContext(prefix="cat")]
+    pending = LLMContext(prefix="dog")
+    queued = LLMContext(prefix="fish")
+
+    pubsubs = []
+    for context in running:
+        pubsub = patch_redis.pubsub()
+        pubsub.subscribe(context.redis_key)
+        pubsubs.append(pubsub)
+
+    queue.enqueue(process, [*running, pending])
+    queue.enqueue(process, [queued])
+
+    worker = ContinuousWorker(queue, max_batch_size=2, idle_timeout=1)
+    # Not in the burst mode, so it returns only because of the signal
+    worker.work()
+
+    for pubsub in pubsubs:
+        assert (
+            read_from_pubsub(pubsub) == EXPECTED_MESSAGES
+        ), "Running batch is finished"
+    assert [job.args[0] for job in queue.get_jobs()] == [
+        [pending],
+        [queued],
+    ], "Contexts that weren't admitted are handed over"
+    assert signal.getsignal(signal.SIGTERM) is signal.SIG_DFL
+
+
+def test_infer_process_streams(patch_get_model, patch_redis, monkeypatch):
+    monkeypatch.setattr(settings, "transport", "streams")
+    monkeypatch.setattr(settings, "stream_maxlen", 2)
+    contexts = [LLMContext(prefix="random"), LLMContext(prefix="cat")]
 
     process(contexts=contexts)
 
-    received_messages_1 = read_from_pubsub(pubsub_1)
-    received_messages_2 = read_from_pubsub(pubsub_2)
+    for context in contexts:
+        entries = patch_redis.xrange(context.stream_key)
+        assert [
+            (entry_id, InferMessage.model_validate_json(fields[b"data"]))
+            for entry_id, fields in entries
+        ] == [
+            (b"0-2", EXPECTED_MESSAGES[1]),
+            (b"0-3", EXPECTED_MESSAGES[2]),
+        ], "Chunks are written to the capped stream with sequence IDs"
+        assert patch_redis.ttl(context.stream_key) > 0, "Streams are expiring"
+
 
-    expected = [
-        InferMessage(text="Hello ", status=InferMessageStatus.IN_PROGRESS),
-        InferMessage(text="world ", status=InferMessageStatus.IN_PROGRESS),
-        InferMessage(text="!", status=InferMessageStatus.FINISHED),
+def test_infer_process_binary_frames(patch_get_model, patch_redis, monkeypatch):
+    monkeypatch.setattr(settings, "message_format", "binary")
+    context = LLMContext(prefix="random")
+
+    pubsub = patch_redis.pubsub()
+    pubsub.subscribe(context.redis_key)
+    process([context])
+
+    pubsub.get_message()  # subscribe confirmation
+    frames = [pubsub.get_message()["data"] for _ in EXPECTED_MESSAGES]
+    assert [render_message(frame)[1] for frame in frames] == [
+        message.model_dump_json() for message in EXPECTED_MESSAGES
     ]
+    assert sum(map(len, frames)) < sum(
+        len(message.model_dump_json()) for message in EXPECTED_MESSAGES
+    ), "Frames are more compact than JSON"
+
+
+@pytest.mark.parametrize("message_format", ["json", "binary"])
+def test_infer_process_timings(
+    patch_get_model, patch_redis, monkeypatch, message_format
+):
+    monkeypatch.setattr(settings, "message_format", message_format)
+    context = LLMContext(prefix="random", timings={"received": time.time()})
+
+    pubsub = patch_redis.pubsub()
+    pubsub.subscribe(context.redis_key)
+    process([context])
+
+    pubsub.get_message()  # subscribe confirmation
+    rendered = [render_message(pubsub.get_message()["data"]) for _ in range(3)]
+    assert [json_data for _, json_data, _ in rendered] == [
+        message.model_dump_json() for message in EXPECTED_MESSAGES
+    ], "Timings are never forwarded to the client"
+
+    timings = rendered[0][2]
+    assert list(timings) == ["received", "picked", "first_step"]
+    assert timings["received"] <= timings["picked"] <= timings["first_step"]
+    assert [timings for *_, timings in rendered[1:]] == [None, None]
+
+
+def test_infer_process_batch_channel(patch_get_model, patch_redis, monkeypatch):
+    monkeypatch.setattr(settings, "transport", "batch")
+    batch_id = uuid4()
+    contexts = [
+        LLMContext(prefix="random", batch_id=batch_id),
+        LLMContext(prefix="cat", batch_id=batch_id),
+    ]
+
+    pubsub = patch_redis.pubsub()
+    pubsub.subscribe(contexts[0].batch_key)
+    process(contexts)
+
+    pubsub.get_message()  # subscribe confirmation
+    for expected_message in EXPECTED_MESSAGES:
+        batch_message = pubsub.get_message()["data"]
+        assert [
+            (channel, InferMessage.model_validate_json(message))
+            for channel, message in decode_batch_message(batch_message)
+        ] == [
+            (context.redis_key, expected_message) for context in contexts
+        ], "Chunks of all contexts are published in one message per step"
+    assert pubsub.get_message() is None
+
+
+def test_infer_process_cancelled(patch_get_model, patch_redis):
+    contexts = [LLMContext(prefix="random"), LLMContext(prefix="cat")]
+    patch_redis.set(contexts[1].cancel_key, 1)
+
+    pubsub = patch_redis.pubsub()
+    pubsub.subscribe(*(context.redis_key for context in contexts))
+    process(contexts)
+
+    assert read_from_pubsub(pubsub) == EXPECTED_MESSAGES
+    assert pubsub.get_message() is None, "Cancelled context is dropped"
+
+
+def test_infer_process_expired(patch_get_model, patch_redis):
+    contexts = [
+        LLMContext(prefix="random"),
+        LLMContext(prefix="cat", deadline=time.time() - 1),
+    ]
+
+    pubsub = patch_redis.pubsub()
+    pubsub.subscribe(*(context.redis_key for context in contexts))
+    process(contexts)
+
+    assert read_from_pubsub(pubsub) == EXPECTED_MESSAGES
+    assert pubsub.get_message() is None, "Expired context is skipped"
+    assert patch_redis.hgetall(ContextPruner.PRUNED_STATS_KEY) == {
+        b"expired:queued": b"1"
+    }
+
+
+def test_context_pruner_mid_generation(patch_redis, monkeypatch):
+    publisher = InferPublisher(patch_redis, transport="pubsub")
+    pruner = ContextPruner(patch_redis, publisher, check_cancelled=True)
+    expiring, cancelled, alive = (
+        LLMContext(deadline=time.time() + 10),
+        LLMContext(),
+        LLMContext(),
+    )
+
+    batch = [(ctx, LLMInferResult("Hello ")) for ctx in (expiring, cancelled, alive)]
+    assert pruner([expiring, cancelled, alive]) == [expiring, cancelled, alive]
+    publisher.publish(batch)
+
+    patch_redis.set(cancelled.cancel_key, 1)
+    monkeypatch.setattr("time.time", lambda: expiring.deadline)
+    assert pruner([expiring, cancelled, alive]) == [alive]
+    assert patch_redis.hgetall(ContextPruner.PRUNED_STATS_KEY) == {
+        b"expired:running": b"1",
+        b"cancelled:running": b"1",
+    }
+
+
+def test_context_pruner_coalesced(patch_redis, monkeypatch):
+    now = 0.0
+    monkeypatch.setattr("time.monotonic", lambda: now)
+
+    coalescer = ChunkCoalescer(flush_interval_ms=50, max_chars=100)
+    publisher = InferPublisher(patch_redis, transport="pubsub", coalescer=coalescer)
+    pruner = ContextPruner(patch_redis, publisher, check_cancelled=True)
+    cancelled, alive = LLMContext(), LLMContext()
+
+    pubsub = patch_redis.pubsub()
+    pubsub.subscribe(cancelled.redis_key)
+    pubsub.get_message()  # subscribe confirmation
+
+    publisher.publish([(ctx, LLMInferResult("Hello ")) for ctx in (cancelled, alive)])
+    now = 0.01
+    publisher.publish([(ctx, LLMInferResult("world ")) for ctx in (cancelled, alive)])
+    assert pubsub.get_message()["data"]
+
+    patch_redis.set(cancelled.cancel_key, 1)
+    assert pruner([cancelled, alive]) == [alive]
+
+    now = 0.06
+    publisher.publish([(alive, LLMInferResult("!", is_last_chunk=True))])
+    assert pubsub.get_message() is None, "Buffered text of pruned context is dropped"
+
+
+def test_chunk_coalescer(monkeypatch):
+    now = 0.0
+    monkeypatch.setattr("time.monotonic", lambda: now)
+
+    coalescer = ChunkCoalescer(flush_interval_ms=50, max_chars=10)
+    first, second = LLMContext(), LLMContext()
+
+    def step(first_text, second_text, is_last_chunk=False):
+        return coalescer.coalesce(
+            [
+                (first, LLMInferResult(first_text)),
+                (second, LLMInferResult(second_text, is_last_chunk)),
+            ]
+        )
+
+    assert step("a ", "b ") == [
+        (first, LLMInferResult("a ")),
+        (second, LLMInferResult("b ")),
+    ], "First chunks are released at once"
+
+    now = 0.01
+    assert step("a ", "b ") == []
+    now = 0.02
+    assert step("a ", "bbbbbbbb ") == [
+        (second, LLMInferResult("b bbbbbbbb "))
+    ], "Chunks are released when the size threshold is reached"
+
+    now = 0.06
+    assert step("a ", "b", is_last_chunk=True) == [
+        (first, LLMInferResult("a a a ")),
+        (second, LLMInferResult("b", is_last_chunk=True)),
+    ], "Chunks are released when the interval is over, last chunks at once"
+
+
+def test_chunk_coalescer_flushes_contexts_out_of_step(monkeypatch):
+    now = 0.0
+    monkeypatch.setattr("time.monotonic", lambda: now)
+
+    coalescer = ChunkCoalescer(flush_interval_ms=50, max_chars=100)
+    first, second = LLMContext(), LLMContext()
+    coalescer.coalesce([(first, LLMInferResult("a ")), (second, LLMInferResult("b "))])
+
+    now = 0.01
+    assert (
+        coalescer.coalesce(
+            [(first, LLMInferResult("a ")), (second, LLMInferResult("b "))]
+        )
+        == []
+    )
+
+    now = 0.06
+    assert coalescer.coalesce([(first, LLMInferResult("a "))]) == [
+        (first, LLMInferResult("a a ")),
+        (second, LLMInferResult("b ")),
+    ], "Buffered text isn't held past the interval without the next chunk"
+
+
+def test_infer_process_coalesced(patch_get_model, patch_redis, monkeypatch):
+    monkeypatch.setattr(settings, "worker_flush_interval_ms", 1000)
+    context = LLMContext(prefix="random")
+
+    pubsub = patch_redis.pubsub()
+    pubsub.subscribe(context.redis_key)
+    process([context])
+
+    assert read_from_pubsub(pubsub) == [
+        InferMessage(text="Hello ", status=InferMessageStatus.IN_PROGRESS, seq=1),
+        InferMessage(text="world !", status=InferMessageStatus.FINISHED, seq=2),
+    ], "Chunks within the interval are published as one message"
+
+
+def test_fork_free_worker(patch_get_model, patch_redis, patch_queue, monkeypatch):
+    monkeypatch.setattr(settings, "worker_fork", False)
+    context = LLMContext(prefix="random")
+
+    pubsub = patch_redis.pubsub()
+    pubsub.subscribe(context.redis_key)
+    patch_queue.enqueue(process, [context])
+
+    # Fake redis lives in this process, so
+    # the job is processed only without forking
+    run_worker("test-worker", burst=True)
+
+    assert read_from_pubsub(pubsub) == EXPECTED_MESSAGES
+
+
+@pytest.mark.anyio
+async def test_enqueue_many_async(
+    patch_get_model, patch_redis, fake_async_redis, patch_queue, monkeypatch
+):
+    monkeypatch.setattr(settings, "worker_fork", False)
+    contexts = [LLMContext(prefix="random"), LLMContext(prefix="cat")]
+
+    pubsub = patch_redis.pubsub()
+    pubsub.subscribe(*(context.redis_key for context in contexts))
+
+    jobs = await enqueue_many_async(
+        fake_async_redis, [[context] for context in contexts], ttl=10
+    )
+    assert patch_queue.job_ids == [job.id for job in jobs]
+    assert 0 < patch_redis.ttl(jobs[0].key) <= 10, "Job TTL is respected"
+
+    # Jobs written by the async client are picked up by a regular RQ worker
+    run_worker("test-worker", burst=True)
+
+    assert len(read_from_pubsub(pubsub)) == len(EXPECTED_MESSAGES)
+    assert len(read_from_pubsub(pubsub)) == len(EXPECTED_MESSAGES)
+
+
+@pytest.mark.anyio
+async def test_pull_worker(patch_get_model, patch_redis, fake_async_redis):
+    contexts = [LLMContext(prefix="random") for _ in range(3)]
+    for context in contexts:
+        await push_context_async(fake_async_redis, context)
+
+    worker = PullWorker(patch_redis, batch_size=2, idle_timeout=1)
+    assert worker.pull_contexts(block=False) == contexts[:2], "Full batch"
+    assert worker.pull_contexts(block=True) == contexts[2:], "Whatever is there"
+    assert worker.pull_contexts(block=False) == []
+
+    pubsub = patch_redis.pubsub()
+    pubsub.subscribe(contexts[0].redis_key)
+    await push_context_async(fake_async_redis, contexts[0])
+    worker.work(burst=True)
+
+    assert read_from_pubsub(pubsub) == EXPECTED_MESSAGES
+
+
+@pytest.mark.anyio
+async def test_pull_worker_warm_shutdown(
+    patch_get_model, patch_redis, fake_async_redis, sigterm_on_first_publish
+):
+    contexts = [LLMContext(prefix="random") for _ in range(3)]
+    for context in contexts:
+        await push_context_async(fake_async_redis, context)
+
+    pubsub = patch_redis.pubsub()
+    pubsub.subscribe(contexts[0].redis_key)
+    worker = PullWorker(patch_redis, batch_size=2, idle_timeout=1)
+    worker.work()
+
+    assert read_from_pubsub(pubsub) == EXPECTED_MESSAGES, "Running batch is finished"
+    assert patch_redis.lrange(CONTEXT_QUEUE_KEY, 0, -1) == [
+        pickle.dumps(contexts[2])
+    ], "The rest is left"
+
+
+def test_worker_pool_restarts_crashed_worker(monkeypatch, tmp_path):
+    monkeypatch.setattr(horoscoper.tasks.infer, "POOL_RESTART_DELAY", 0.01)
+
+    def crash_once(worker_name: str):
+        crashed = tmp_path / "crashed"
+        if not crashed.exists():
+            crashed.touch()
+            os._exit(1)
+
+        (tmp_path / "restarted").touch()
+        # `docker stop` once the worker is back
+        os.kill(os.getppid(), signal.SIGTERM)
+        signal.pause()
+
+    monkeypatch.setattr(horoscoper.tasks.infer, "run_worker", crash_once)
+    handlers = {
+        signum: signal.getsignal(signum) for signum in (signal.SIGTERM, signal.SIGINT)
+    }
+    try:
+        run_worker_pool(concurrency=1)
+    finally:
+        for signum, handler in handlers.items():
+            signal.signal(signum, handler)
+
+    assert (tmp_path / "restarted").exists(), "Crashed worker is restarted"
+
+
+def test_worker_pool_restarts_stale_worker(
+    patch_get_model, patch_redis, patch_queue, monkeypatch, tmp_path
+):
+    monkeypatch.setattr(horoscoper.tasks.infer, "POOL_RESTART_DELAY", 0.01)
+    monkeypatch.setattr(settings, "worker_fork", False)
+    monkeypatch.setenv("HOSTNAME", "host")
+
+    # Worker killed by SIGKILL never registers its death
+    rq.SimpleWorker(
+        [patch_queue], name="worker-host-0.0", connection=patch_redis
+    ).register_birth()
+    patch_queue.enqueue(process, [LLMContext(prefix="random")])
+
+    def run_and_stop(worker_name: str):
+        # Fake redis is copied to the forked workers, so the job is
+        # checked from the worker, that is started after the stale one
+        run_worker(worker_name, burst=True)
+        (tmp_path / worker_name).write_text(str(patch_queue.count))
+        os.kill(os.getppid(), signal.SIGTERM)
+        signal.pause()
+
+    monkeypatch.setattr(horoscoper.tasks.infer, "run_worker", run_and_stop)
+    handlers = {
+        signum: signal.getsignal(signum) for signum in (signal.SIGTERM, signal.SIGINT)
+    }
+    try:
+        run_worker_pool(concurrency=1)
+    finally:
+        for signum, handler in handlers.items():
+            signal.signal(signum, handler)
 
-    assert received_messages_1 == expected, "First subscriber received all messages"
-    assert received_messages_2 == expected, "Second subscriber received all messages"
+    assert (
+        tmp_path / "worker-host-0.1"
+    ).read_text() == "0", "Restarted worker has a new name and processes the job"
@@ -1,10 +1,19 @@
 # flake8: noqa
 
+import pickle
 import tempfile
+import time
+import tracemalloc
+from dataclasses import dataclass, field
+from typing import Optional
+from uuid import UUID, uuid4
 
 import pytest
 
-from horoscoper.horoscope import HoroscopeIndex, HoroscopeLLM
+import horoscoper.horoscope
+import horoscoper.llm
+from horoscoper.horoscope import CompiledHoroscopeIndex, HoroscopeIndex, HoroscopeLLM
+from horoscoper.latency import LatencyModel
 from horoscoper.llm import LLMContext, LLMInferResult
 
 
@@ -31,6 +40,7 @@ rambler;2019-11-14 00:00:00;ARIES;Овнов сегодня ждет ряд во
 def test_horoscope_index(monkeypatch, horoscope_file, prefix, expected):
     horoscope_index = HoroscopeIndex.load_from_csv(horoscope_file)
     assert horoscope_index.predict_by_prefix(prefix) == expected
+    assert horoscope_index.predict_length(prefix) == len(expected.split(" "))
 
 
 def test_horoscope_llm(monkeypatch, horoscope_file):
@@ -47,3 +57,210 @@ def test_horoscope_llm(monkeypatch, horoscope_file):
         LLMInferResult(text="к "),
         LLMInferResult(text="сердцу", is_last_chunk=True),
     ]
+
+
+def test_horoscope_llm_continuous(monkeypatch, horoscope_file):
+    llm = HoroscopeLLM(horoscope_file)
+    llm.MIN_RESPONSE_TIME_MS = 0
+    llm.MAX_RESPONSE_TIME_MS = 10
+
+    first, second, third = (LLMContext(prefix="abcde") for _ in range(3))
+    pending = [first]
+    arrivals = {2: [second, third]}
+    calls = 0
+
+    def admit(free_slots):
+        nonlocal calls
+        pending.extend(arrivals.get(calls, []))
+        calls += 1
+
+        admitted = pending[:free_slots]
+        del pending[:free_slots]
+        return admitted
+
+    steps = list(llm.infer_continuous(admit=admit, max_batch_size=2))
+
+    assert [[ctx for ctx, _ in step] for step in steps] == [
+        *[[first]] * 2,
+        *[[first, second]] * 4,
+        *[[second, third]] * 2,
+        *[[third]] * 4,
+    ], "Contexts join the running batch and leave it as soon as they are finished"
+    assert steps[-1] == [(third, LLMInferResult(text="сердцу", is_last_chunk=True))]
+
+
+def test_horoscope_llm_batch_keep(monkeypatch, horoscope_file):
+    llm = HoroscopeLLM(horoscope_file)
+    llm.MIN_RESPONSE_TIME_MS = 0
+    llm.MAX_RESPONSE_TIME_MS = 10
+
+    first, second = LLMContext(prefix="abcde"), LLMContext(prefix="abcde")
+    cancelled = set()
+
+    def keep(contexts):
+        return [ctx for ctx in contexts if ctx.id not in cancelled]
+
+    steps = []
+    for step in llm.infer_batch([first, second], keep=keep):
+        steps.append([ctx for ctx, _ in step])
+        if len(steps) == 2:
+            cancelled.add(second.id)
+        if len(steps) == 3:
+            cancelled.add(first.id)
+
+    assert steps == [
+        [first, second],
+        [first, second],
+        [first],
+    ], "Cancelled contexts are dropped and the batch ends once none remain"
+
+
+def test_horoscope_llm_time_scale(monkeypatch, horoscope_file):
+    llm = HoroscopeLLM(horoscope_file, time_scale=100)
+    llm.MIN_RESPONSE_TIME_MS = 1000
+    llm.MAX_RESPONSE_TIME_MS = 1000
+
+    start = time.monotonic()
+    list(llm.infer_batch([LLMContext(prefix="abcde")]))
+    assert 0.01 <= time.monotonic() - start < 0.1, "1s of the model time is 10ms"
+
+
+def test_horoscope_llm_latency_model(monkeypatch, horoscope_file):
+    class RecordingLatencyModel(LatencyModel):
+        def __init__(self):
+            self.calls = []
+
+        def prefill_ms(self, prefix_lengths):
+            self.calls.append(("prefill", prefix_lengths))
+            return 0
+
+        def decode_ms(self, rows):
+            self.calls.append(("decode", rows))
+            return 0
+
+    latency_model = RecordingLatencyModel()
+    llm = HoroscopeLLM(horoscope_file, latency_model=latency_model)
+    contexts = [LLMContext(prefix="abcde"), LLMContext(prefix="random")]
+
+    steps = list(llm.infer_batch(contexts))
+    assert len(steps) == 6
+    assert latency_model.calls == [
+        ("decode", 2),
+        ("prefill", [5, 6]),
+        *[("decode", 1)] * 5,
+    ], "Every step is charged by the active rows, the first one by prefill too"
+
+
+def test_compiled_horoscope_index(horoscope_file, tmp_path):
+    horoscope_index = HoroscopeIndex.load_from_csv(horoscope_file)
+    index_path = tmp_path / "horoscopes.idx"
+    horoscope_index.compile(index_path)
+
+    compiled_index = CompiledHoroscopeIndex.load(index_path)
+    for prefix in ["lol", "random", "abcde", *map(str, range(100))]:
+        assert compiled_index.predict_by_prefix(
+            prefix
+        ) == horoscope_index.predict_by_prefix(prefix)
+        assert compiled_index.predict_words(prefix) == horoscope_index.predict_words(
+            prefix
+        )
+        assert compiled_index.predict_length(prefix) == horoscope_index.predict_length(
+            prefix
+        )
+
+    llm = HoroscopeLLM(horoscope_file, horoscope_index_file=index_path)
+    llm.MIN_RESPONSE_TIME_MS = llm.MAX_RESPONSE_TIME_MS = 0
+    assert [result.text for result in llm.infer(LLMContext(prefix="abcde"))] == [
+        "Вы ",
+        "многое ",
+        "принимаете ",
+        "близко ",
+        "к ",
+        "сердцу",
+    ]
+
+
+def test_compiled_horoscope_index_invalid(horoscope_file):
+    with pytest.raises(ValueError):
+        CompiledHoroscopeIndex.load(horoscope_file)
+
+
+@pytest.mark.parametrize("vectorized", [True, False])
+def test_predict_batch(monkeypatch, horoscope_file, tmp_path, vectorized):
+    if vectorized:
+        pytest.importorskip("numpy")
+    else:
+        monkeypatch.setattr(horoscoper.horoscope, "np", None)
+
+    horoscope_index = HoroscopeIndex.load_from_csv(horoscope_file)
+    index_path = tmp_path / "horoscopes.idx"
+    horoscope_index.compile(index_path)
+    compiled_index = CompiledHoroscopeIndex.load(index_path)
+
+    prefixes = ["lol", "random", "", "Привет", *map(str, range(500))]
+    expected = [horoscope_index.predict_by_prefix(prefix) for prefix in prefixes]
+    assert horoscope_index.predict_batch(prefixes) == expected
+    assert compiled_index.predict_batch(prefixes) == expected
+    assert horoscope_index.predict_batch([]) == []
+
+
+def test_horoscope_llm_allocations(horoscope_file):
+    llm = HoroscopeLLM(horoscope_file)
+    llm.MIN_RESPONSE_TIME_MS = llm.MAX_RESPONSE_TIME_MS = 0
+    contexts = [LLMContext(prefix="abcde") for _ in range(8)]
+    # Chunks are rendered once per prediction
+    list(llm.infer_batch(contexts))
+
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        steps = list(llm.infer_batch(contexts))
+        after = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+
+    only_generation = [
+        tracemalloc.Filter(True, horoscoper.horoscope.__file__),
+        tracemalloc.Filter(True, horoscoper.llm.__file__),
+    ]
+    allocated_blocks = sum(
+        stat.count_diff
+        for stat in after.filter_traces(only_generation).compare_to(
+            before.filter_traces(only_generation), "filename"
+        )
+    )
+    tokens = sum(map(len, steps))
+    assert tokens == 48
+    # Pairs mostly reuse freed tuples, so it's about 0.13 blocks per token,
+    # while dataclass results and chunk strings took over 3 blocks
+    assert allocated_blocks / tokens <= 0.25
+    assert not hasattr(contexts[0], "__dict__"), "Contexts are slotted"
+
+
+def test_llm_context_unpickles_dict_state(monkeypatch):
+    @dataclass
+    class UnslottedLLMContext:
+        """Context as pickled by the previous versions"""
+
+        id: UUID = field(default_factory=uuid4)
+        prefix: str = ""
+        deadline: Optional[float] = None
+
+    UnslottedLLMContext.__module__ = LLMContext.__module__
+    UnslottedLLMContext.__qualname__ = LLMContext.__qualname__
+    old_context = UnslottedLLMContext(prefix="random", deadline=1.0)
+    with monkeypatch.context() as m:
+        m.setattr(horoscoper.llm, "LLMContext", UnslottedLLMContext)
+        data = pickle.dumps(old_context)
+
+    context = pickle.loads(data)
+    assert isinstance(context, LLMContext)
+    assert (context.id, context.prefix, context.deadline) == (
+        old_context.id,
+        "random",
+        1.0,
+    )
+    assert context.batch_id is None and context.timings is None, "Defaults"
+
+    context.timings = {"batched": 1.0}
+    assert pickle.loads(pickle.dumps(context)) == context
@@ -0,0 +1,61 @@
+import multiprocessing
+
+from horoscoper.latency import LinearLatencyModel
+
+
+def get_model(**kwargs) -> LinearLatencyModel:
+    return LinearLatencyModel(
+        prefill_base_ms=10,
+        prefill_per_char_ms=1,
+        decode_base_ms=40,
+        decode_per_row_ms=5,
+        **kwargs,
+    )
+
+
+def test_linear_latency_model():
+    model = get_model()
+
+    assert model.prefill_ms([]) == 0
+    assert model.prefill_ms([10]) == 20
+    assert model.prefill_ms([10, 30]) == 50, "Prefill grows with the batch"
+    assert [model.decode_ms(rows) for rows in (1, 4, 8)] == [45, 60, 80]
+
+
+def test_linear_latency_model_seed():
+    def sample(model: LinearLatencyModel) -> list[float]:
+        return [model.decode_ms(rows) for rows in range(1, 9)] + [
+            model.prefill_ms([8, 16])
+        ]
+
+    latencies = sample(get_model(jitter=0.2, seed=42))
+    assert latencies == sample(get_model(jitter=0.2, seed=42)), "Reproducible"
+    assert latencies != sample(get_model(jitter=0.2, seed=43))
+    assert all(
+        0.8 * exact <= latency <= 1.2 * exact
+        for latency, exact in zip(latencies, sample(get_model()))
+    )
+
+
+def sample_in_forks(model: LinearLatencyModel, forks: int = 3) -> list[float]:
+    """Latency sampled by every forked child, as by RQ work horses"""
+    mp_context = multiprocessing.get_context("fork")
+    results = mp_context.Queue()
+    latencies = []
+    for _ in range(forks):
+        child = mp_context.Process(target=lambda: results.put(model.decode_ms(4)))
+        child.start()
+        latencies.append(results.get(timeout=10))
+        child.join()
+    return latencies
+
+
+def test_linear_latency_model_fork():
+    latencies = sample_in_forks(get_model(jitter=0.2))
+    assert len(set(latencies)) == 3, "Every fork has its own jitter"
+
+    seeded_latencies = sample_in_forks(get_model(jitter=0.2, seed=42))
+    assert len(set(seeded_latencies)) == 3
+    assert seeded_latencies == sample_in_forks(
+        get_model(jitter=0.2, seed=42)
+    ), "Reproducible by the fork number"
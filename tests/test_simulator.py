@@ -0,0 +1,67 @@
+import argparse
+import importlib.util
+import random
+import time
+
+import pytest
+
+import horoscoper.api.batcher
+import horoscoper.llm
+from horoscoper.latency import LinearLatencyModel
+from horoscoper.settings import ROOT, settings
+
+spec = importlib.util.spec_from_file_location(
+    "simulator", ROOT / "etc" / "benchmarking" / "simulator.py"
+)
+simulator = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(simulator)
+
+
+@pytest.fixture
+def horoscope_file(tmp_path):
+    path = tmp_path / "horoscopes.csv"
+    path.write_text(
+        """source;ts;sign;text;type
+mailru;2019-11-10 00:00:00;ARIES;"Вы многое принимаете близко к сердцу";DEFAULT
+rambler;2019-11-14 00:00:00;LIBRA;Овнов сегодня ждет ряд волнующих моментов;DEFAULT"""
+    )
+    return path
+
+
+@pytest.mark.parametrize("worker_mode", ["static", "continuous"])
+def test_simulator_smoke(horoscope_file, worker_mode):
+    random.seed(0)
+    config = argparse.Namespace(
+        trace=None,
+        rate=4.0,
+        duration=5.0,
+        batch_size=4,
+        window_ms=250,
+        workers=2,
+        job_ttl=7,
+        deadline=30.0,
+        adaptive=False,
+        worker_mode=worker_mode,
+        worker_batch_size=8,
+    )
+    model = simulator.SimulatedLLM(
+        horoscope_file,
+        latency_model=LinearLatencyModel(
+            prefill_base_ms=30,
+            prefill_per_char_ms=0.5,
+            decode_base_ms=40,
+            decode_per_row_ms=6,
+        ),
+    )
+    job_ttl = settings.infer_job_ttl
+    arrivals = simulator.generate_arrivals(config)
+
+    report = simulator.simulate(model, config, arrivals)
+
+    assert report["requests"] == len(arrivals) > 0
+    assert report["outcomes"] == {"ok": len(arrivals)}
+    assert 0 < report["worker_utilization"] <= 1
+    assert horoscoper.api.batcher.time is time, "Patches are restored"
+    assert horoscoper.llm.time is time
+    assert horoscoper.api.batcher.infer is horoscoper.tasks.infer
+    assert settings.infer_job_ttl == job_ttl